@@ -6,6 +6,79 @@ import re
 import json
 import urllib
 import traceback
+import threading
+import Queue
+import collections
+import functools
+import random
+import contextlib
+import hashlib
+import difflib
+import sqlite3
+import io
+import os
+import atexit
+import signal
+import shutil
+import tempfile
+import resource
+import subprocess
+import pwd
+import fcntl
+
+class SubmissionTimeout(Exception):
+
+    """Raised when a submission hasn't finished executing before the
+    polling deadline.
+    """
+
+class BackendUnavailable(Exception):
+
+    """Raised instead of sending a request to ideone while its circuit
+    breaker is open.
+    """
+
+class Job(collections.namedtuple('Job', [
+        'id', 'fullname', 'was_comment', 'body', 'author', 'permalink',
+        'reddit_session', 'thing'])):
+
+    """An inbox item, or a comment that is being recompiled, reduced to
+    the fields needed to process it. Reading an attribute of a PRAW
+    object can quietly make a request to reddit to load it, so each
+    field is read once when the job is created. The PRAW object itself
+    is kept as thing and is only used to reply to the item and to mark
+    it as read. The author is stored as a username, or None if the
+    author's account has been deleted.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_thing(cls, thing, was_comment=None):
+        """Create a job from a PRAW object. Only objects from the inbox
+        have was_comment, so it must be given for any other comment.
+        """
+        if was_comment is None:
+            was_comment = thing.was_comment
+        author = thing.author
+        return cls(thing.id, thing.fullname, was_comment, thing.body,
+                   author.name if author else None,
+                   permalink(thing) if was_comment else '',
+                   thing.reddit_session, thing)
+
+def permalink(comment):
+    """Return the permalink of a comment. PRAW builds it from the
+    comment's submission, which it fetches unless the comment came with
+    one. Comments from the inbox and from get_info don't, but they do
+    come with a link to their context or the id of their submission.
+    """
+    fields = vars(comment)
+    if fields.get('context'):
+        return 'http://www.reddit.com' + fields['context'].split('?', 1)[0]
+    if fields.get('link_id'):
+        return 'http://www.reddit.com/comments/{}/_/{}'.format(
+            fields['link_id'].split('_', 1)[-1], comment.id)
+    return comment.permalink
 
 class Reply(object):
 
@@ -32,55 +105,73 @@ class CompiledReply(Reply):
     sent as replies to comments.
     """
 
-    def __init__(self, text, compile_details):
+    def __init__(self, text, compile_details, digest=None):
         Reply.__init__(self, text)
         self.compile_details = compile_details
+        # A digest of the reply without its footer, which identifies the
+        # output of the program.
+        self.digest = digest
         self.parent_comment = None
 
     def send(self, comment):
-        """Send a reply to a specific reddit comment or message."""
+        """Send a reply to the comment of a job."""
         self.parent_comment = comment
         self.recipient = comment.author
+        if SEND_QUEUE.limited():
+            SEND_QUEUE.park('reply', comment.fullname, self.text,
+                            parent=comment.id, digest=self.digest)
+            return
         try:
-            comment.reply(self.text)
+            with METRICS.span('send'):
+                throttle('reddit_write')
+                sent = comment.thing.reply(self.text)
             log("Replied to {id}".format(id=comment.id))
+            if sent is not None:
+                REPLIES.put(comment.id, sent.id, self.digest)
         except praw.errors.RateLimitExceeded as e:
-            log("Rate Limit exceeded. "
-                "Sleeping for {time} seconds".format(time=e.sleep_time))
-            # Wait and try again.
-            time.sleep(e.sleep_time)
-            self.send(comment)
+            # Retry once the rate limit window has passed.
+            SEND_QUEUE.park('reply', comment.fullname, self.text,
+                            delay=e.sleep_time, parent=comment.id,
+                            digest=self.digest)
         # Handle and log miscellaneous API exceptions
         except praw.errors.APIException as e:
             log("Exception on comment {id}, {error}".format(
                 id=comment.id, error=e))
 
     def make_edit(self, comment, parent):
-        """Edit one of the bot's existing comments."""
+        """Edit one of the bot's existing comments, which replied to the
+        comment of the parent job. The reply index is only updated once
+        the edit has been made.
+        """
         self.parent_comment = parent
         self.recipient = parent.author
-        comment.edit(self.text)
-        log("Edited comment {}".format(comment.id))
+        if SEND_QUEUE.limited():
+            SEND_QUEUE.park('edit', comment.fullname, self.text,
+                            parent=parent.id, digest=self.digest)
+            return
+        try:
+            with METRICS.span('send'):
+                throttle('reddit_write')
+                comment.edit(self.text)
+            log("Edited comment {}".format(comment.id))
+            REPLIES.put(parent.id, comment.id, self.digest)
+        except praw.errors.RateLimitExceeded as e:
+            SEND_QUEUE.park('edit', comment.fullname, self.text,
+                            delay=e.sleep_time, parent=parent.id,
+                            digest=self.digest)
 
     def detect_spam(self):
         """Scan a reply and return a list of potentially spammy attributes
         found in the comment's output.
         """
-        output = self.compile_details['output']
-        source = self.compile_details['source']
-        errors = self.compile_details['stderr']
+        return [rule for rule, field, offset in self.spam_matches()]
 
-        spam_behaviors = {
-            "Excessive line breaks": output.count('\n') > LINE_LIMIT,
-            "Excessive character count": len(output) > CHAR_LIMIT,
-            "Spam phrase detected": any([word.lower() in (source + output).lower()
-                                         for word in SPAM_PHRASES]),
-            "Illegal system call detected": "Permission denied" in errors
-        }
-        if any(spam_behaviors.values()):
-            spam_triggers = [k for k, v in spam_behaviors.iteritems() if v]
-            return spam_triggers
-        return []
+    def spam_matches(self):
+        """Scan a reply and return a list of (rule, field, offset) tuples
+        for the spam rules that fired. See SpamDetector.scan.
+        """
+        with METRICS.span('detect_spam'):
+            return spam_detector().scan(self.compile_details)
 
 class MessageReply(Reply):
 
@@ -93,21 +184,658 @@ class MessageReply(Reply):
         self.subject = subject
 
     def send(self, comment):
-        """Reply the author of a reddit comment by sending them a reply
-        via private message.
+        """Reply the author of the comment or message of a job by sending
+        them a reply via private message.
         """
         self.recipient = comment.author
-        r = comment.reddit_session
+        # Use the bot's shared session once it has logged in, otherwise
+        # the session the comment was fetched with.
+        r = SESSION.reddit or comment.reddit_session
         # If no custom subject line is given, the default will be a label
         # that identifies the comment.
         if not self.subject:
             self.subject = "Comment {id}".format(id=comment.id)
         # Prepend message subject with username
         self.subject = "{} - {}".format(R_USERNAME, self.subject)
-        r.send_message(self.recipient, self.subject, self.text)
+        if SEND_QUEUE.limited():
+            SEND_QUEUE.park('message', self.recipient, self.text,
+                            subject=self.subject)
+            return
+        try:
+            with METRICS.span('send'):
+                throttle('reddit_write')
+                r.send_message(self.recipient, self.subject, self.text)
+        except praw.errors.RateLimitExceeded as e:
+            SEND_QUEUE.park('message', self.recipient, self.text,
+                            subject=self.subject, delay=e.sleep_time)
+            return
         log("Message reply for comment {id} sent to {to}".format(
             id=comment.id, to=self.recipient))
 
+class LogFile(object):
+
+    """A log file that stays open between writes. Writes are buffered and
+    flushed at most once every flush_interval seconds. Once the file grows
+    past max_bytes it is rotated, keeping up to backups old copies named
+    with a numbered suffix.
+    """
+
+    def __init__(self, path, max_bytes=0, backups=0, flush_interval=1,
+                 clock=time.time):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self._open()
+
+    def _open(self):
+        self.file = io.open(self.path, 'a', encoding='utf-8')
+        self.size = os.path.getsize(self.path)
+        self.last_flush = self.clock()
+
+    def write(self, message):
+        # Hold the lock while writing so that lines logged by concurrent
+        # workers are not interleaved.
+        with self.lock:
+            self.file.write(message)
+            self.size += len(message)
+            if self.max_bytes and self.size >= self.max_bytes:
+                self._rotate()
+            elif self.clock() - self.last_flush >= self.flush_interval:
+                self.file.flush()
+                self.last_flush = self.clock()
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+            self.last_flush = self.clock()
+
+    def _rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            old = "{}.{}".format(self.path, i)
+            if os.path.exists(old):
+                os.rename(old, "{}.{}".format(self.path, i + 1))
+        if self.backups:
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self._open()
+
+class AlertSender(object):
+
+    """Sends alerts to the admin's reddit inbox from a background thread.
+    Alerts raised within window seconds of each other are sent together
+    in a single message. Alerts are sent with the bot's shared session
+    unless a session is given.
+    """
+
+    def __init__(self, recipient, window=5, session=None):
+        self.recipient = recipient
+        self.window = window
+        self.session = session
+        self.alerts = Queue.Queue()
+        self.wakeup = threading.Event()
+        # Serializes sending so alerts flushed at exit aren't sent twice.
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def alert(self, message):
+        """Queue a message to be sent to the admin."""
+        self.alerts.put(message)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+        self.wakeup.set()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            # Wait for any related alerts before sending.
+            time.sleep(self.window)
+            self.flush()
+
+    def flush(self):
+        """Send every queued alert in a single message."""
+        with self.lock:
+            alerts = []
+            while True:
+                try:
+                    alerts.append(self.alerts.get_nowait())
+                except Queue.Empty:
+                    break
+            if not alerts:
+                return
+            try:
+                r = self.session or SESSION.get()
+                subject = "CompileBot Alert"
+                if len(alerts) > 1:
+                    subject += " ({} alerts)".format(len(alerts))
+                throttle('reddit_write')
+                r.send_message(self.recipient, subject, '\n\n'.join(alerts))
+            except Exception as e:
+                # Only write to the log here, raising another alert would
+                # fail in the same way.
+                log("Unable to send {n} alerts: {error}".format(
+                    n=len(alerts), error=e))
+
+class Session(object):
+
+    """A reddit session shared by every part of the bot. The bot logs in
+    the first time the session is needed and only logs in again once the
+    session has expired, either because it is older than max_age seconds
+    or because reddit has rejected it.
+    """
+
+    def __init__(self, max_age=86400, factory=None, clock=time.time):
+        self.max_age = max_age
+        self.factory = factory or (lambda: praw.Reddit(USER_AGENT))
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.reddit = None
+        self.logged_in = None
+
+    def get(self):
+        """Return the logged in session, logging in if needed."""
+        with self.lock:
+            if (self.reddit is None or
+                self.clock() - self.logged_in >= self.max_age):
+                r = self.factory()
+                throttle('reddit_write')
+                r.login(R_USERNAME, R_PASSWORD)
+                self.reddit, self.logged_in = r, self.clock()
+            return self.reddit
+
+    def expire(self):
+        """Discard the session so that the next use logs in again."""
+        with self.lock:
+            self.reddit = None
+
+class TokenBucket(object):
+
+    """Allows calls at an average of rate calls per second, with bursts of
+    up to burst calls. Callers that exceed the rate reserve a token ahead
+    of time and wait until it becomes available, so waiting callers are
+    served in the order they arrived.
+    """
+
+    def __init__(self, rate, burst=1, clock=time.time):
+        self.rate = float(rate)
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token and return the number of seconds to wait before
+        using it.
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+class RateLimiter(object):
+
+    """Paces outbound calls to reddit and ideone so that the bot stays
+    under their rate limits instead of hitting them. Each class of
+    endpoint has its own token bucket. Counts of the calls made, the
+    calls that were throttled and the total time spent waiting are kept
+    for each class.
+    """
+
+    def __init__(self, limits, clock=time.time, sleep=time.sleep):
+        self.buckets = {endpoint: TokenBucket(limit['rate'],
+                                              limit.get('burst', 1), clock)
+                        for endpoint, limit in limits.items()}
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def wait(self, endpoint):
+        """Wait until a call to a class of endpoint may be made."""
+        bucket = self.buckets.get(endpoint)
+        delay = bucket.reserve() if bucket else 0
+        with self.lock:
+            counters = self.counters.setdefault(
+                endpoint, {'calls': 0, 'throttled': 0, 'waited': 0.0})
+            counters['calls'] += 1
+            if delay:
+                counters['throttled'] += 1
+                counters['waited'] += delay
+        if delay:
+            METRICS.count('rate_limit_waits_total', endpoint=endpoint)
+            METRICS.count('rate_limit_wait_seconds_total', delay,
+                          endpoint=endpoint)
+            self.sleep(delay)
+
+    def stats(self):
+        """Return a copy of the counters for each class of endpoint."""
+        with self.lock:
+            return {endpoint: dict(counters)
+                    for endpoint, counters in self.counters.items()}
+
+def throttle(endpoint):
+    """Wait until a call to a class of endpoint may be made. The classes
+    are reddit_read, reddit_write, ideone_submit and ideone_poll.
+    """
+    RATE_LIMITER.wait(endpoint)
+
+class Metrics(object):
+
+    """Counters and timing spans for the work the bot does, so that slow
+    replies can be traced to ideone, reddit or the bot itself. Counters
+    are named like Prometheus metrics and may have labels. Each span
+    records how many times it ran, the total time spent in it and the
+    longest it took. Peaks record the largest value seen. Labels given
+    to the constructor are added to every series in the Prometheus
+    output, so that the files written by several processes can be told
+    apart.
+    """
+
+    def __init__(self, clock=time.time, labels=None):
+        self.clock = clock
+        self.labels = labels or {}
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.spans = {}
+        self.peaks = {}
+
+    def count(self, name, value=1, **labels):
+        """Add value to a counter."""
+        if labels:
+            name += '{{{}}}'.format(','.join(
+                '{}="{}"'.format(k, v) for k, v in sorted(labels.items())))
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def peak(self, name, value):
+        """Raise a peak to value if it's the largest seen so far."""
+        with self.lock:
+            self.peaks[name] = max(self.peaks.get(name, value), value)
+
+    def observe(self, name, seconds):
+        """Record one run of a span that took the given time."""
+        with self.lock:
+            span = self.spans.setdefault(
+                name, {'count': 0, 'sum': 0.0, 'max': 0.0})
+            span['count'] += 1
+            span['sum'] += seconds
+            span['max'] = max(span['max'], seconds)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """Time the body of a with block."""
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.observe(name, self.clock() - start)
+
+    def snapshot(self):
+        """Return a copy of every counter, span and peak."""
+        with self.lock:
+            return {'time': self.clock(), 'counters': dict(self.counters),
+                    'spans': {name: dict(span)
+                              for name, span in self.spans.items()},
+                    'peaks': dict(self.peaks)}
+
+    def prometheus(self):
+        """Return the metrics in the Prometheus text format."""
+        snapshot = self.snapshot()
+        extra = ','.join('{}="{}"'.format(k, v)
+                         for k, v in sorted(self.labels.items()))
+
+        def series(name):
+            if not extra:
+                return name
+            if name.endswith('}'):
+                return '{},{}}}'.format(name[:-1], extra)
+            return '{}{{{}}}'.format(name, extra)
+
+        lines = []
+        for name, value in sorted(list(snapshot['counters'].items()) +
+                                  list(snapshot['peaks'].items())):
+            lines.append("compilebot_{} {}".format(series(name), value))
+        for name, span in sorted(snapshot['spans'].items()):
+            for stat in ('count', 'sum', 'max'):
+                lines.append('compilebot_{} {}'.format(
+                    series('span_seconds_{}{{span="{}"}}'.format(stat, name)),
+                    span[stat]))
+        return '\n'.join(lines) + '\n'
+
+class SendQueue(object):
+
+    """Replies, edits and messages that reddit has rate limited. Each one
+    is parked until the rate limit window has passed, and flush() sends
+    the ones that are due. Parked items are stored in a sqlite database
+    so that they survive restarts. An item that fails to send for any
+    other reason is retried after ERROR_DELAY seconds without holding up
+    the rest. An item that has been rate limited or has failed
+    max_attempts times is dropped. Replies and edits of the bot's
+    replies are recorded in the reply index once they have been sent.
+    """
+
+    # Seconds before an item that failed for a reason other than the rate
+    # limit is tried again.
+    ERROR_DELAY = 60
+
+    def __init__(self, path=':memory:', max_attempts=5, clock=time.time):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.clock = clock
+        self.lock = threading.Lock()
+        # The rate limit applies to the whole account, so nothing is
+        # sent before this time.
+        self.not_before = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS outbox ("
+                            "id INTEGER PRIMARY KEY, kind TEXT, "
+                            "target TEXT, subject TEXT, text TEXT, "
+                            "not_before REAL, attempts INTEGER, "
+                            "parent TEXT, digest TEXT)")
+            # Outboxes created before replies were indexed lack the
+            # columns for it.
+            columns = [row[1] for row in
+                       self.db.execute("PRAGMA table_info(outbox)")]
+            for column in ('parent', 'digest'):
+                if column not in columns:
+                    self.db.execute("ALTER TABLE outbox ADD COLUMN {} TEXT"
+                                    "".format(column))
+            row = self.db.execute("SELECT MAX(not_before) FROM outbox"
+                                  ).fetchone()
+            self.not_before = row[0] or 0
+
+    def reopen(self):
+        """Open a new connection to the database. Connections must not be
+        shared with a forked process.
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+
+    def limited(self):
+        """Return true if sending now would exceed the rate limit."""
+        return self.clock() < self.not_before
+
+    def park(self, kind, target, text, subject='', delay=0, parent=None,
+             digest=None):
+        """Park an item until delay seconds from now, or until the current
+        rate limit window has passed. The kind is 'reply' or 'edit' with
+        the fullname of a comment as the target, or 'message' with the
+        name of a user. For replies and edits, parent is the id of the
+        comment the bot is answering and digest is the reply's digest,
+        which are recorded in the reply index once the item is sent.
+        """
+        METRICS.count('deferred_total', kind=kind)
+        with self.lock, self.db:
+            self.not_before = max(self.not_before, self.clock() + delay)
+            self.db.execute("INSERT INTO outbox (kind, target, subject, "
+                            "text, not_before, attempts, parent, digest) "
+                            "VALUES (?, ?, ?, ?, ?, 1, ?, ?)",
+                            (kind, target, subject, text, self.not_before,
+                             parent, digest))
+        log("Rate limit exceeded. Deferred {kind} to {target} for {time} "
+            "seconds".format(kind=kind, target=target, time=delay))
+
+    def __len__(self):
+        with self.lock:
+            row = self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()
+        return row[0]
+
+    def flush(self, r):
+        """Send every parked item that is due, oldest first."""
+        with self.lock:
+            rows = self.db.execute("SELECT id, kind, target, subject, text, "
+                                   "attempts, parent, digest FROM outbox "
+                                   "WHERE not_before <= ? ORDER BY id",
+                                   (self.clock(),)).fetchall()
+        for (row_id, kind, target, subject, text, attempts, parent,
+             digest) in rows:
+            try:
+                if kind == 'message':
+                    throttle('reddit_write')
+                    r.send_message(target, subject, text)
+                else:
+                    throttle('reddit_read')
+                    thing = r.get_info(thing_id=target)
+                    if thing is None:
+                        log("Deferred {kind} target {target} no longer "
+                            "exists".format(kind=kind, target=target))
+                    elif kind == 'reply':
+                        throttle('reddit_write')
+                        sent = thing.reply(text)
+                        if sent is not None and parent:
+                            REPLIES.put(parent, sent.id, digest)
+                    else:
+                        throttle('reddit_write')
+                        thing.edit(text)
+                        if parent:
+                            REPLIES.put(parent, thing.id, digest)
+                log("Sent deferred {kind} to {target}".format(
+                    kind=kind, target=target))
+            except praw.errors.RateLimitExceeded as e:
+                self._retry(row_id, kind, target, attempts, e.sleep_time)
+                # The remaining items would be rate limited as well.
+                return
+            except praw.errors.APIException as e:
+                log("Exception sending deferred {kind} to {target}, "
+                    "{error}".format(kind=kind, target=target, error=e))
+            except Exception as e:
+                # Errors such as HTTP errors from a subreddit the bot has
+                # been banned from only affect this item, and mustn't stop
+                # the inbox from being checked.
+                log("Error sending deferred {kind} to {target}, {error}"
+                    "".format(kind=kind, target=target, error=e))
+                self._retry(row_id, kind, target, attempts,
+                            self.ERROR_DELAY, limited=False)
+                continue
+            with self.lock, self.db:
+                self.db.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+
+    def _retry(self, row_id, kind, target, attempts, delay, limited=True):
+        """Count a failed attempt to send an item and park it again, or
+        drop it after max_attempts. Only a rate limit holds up every
+        other item as well.
+        """
+        attempts += 1
+        with self.lock, self.db:
+            if attempts >= self.max_attempts:
+                self.db.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+            else:
+                not_before = self.clock() + delay
+                if limited:
+                    self.not_before = max(self.not_before, not_before)
+                    not_before = self.not_before
+                self.db.execute("UPDATE outbox SET not_before = ?, "
+                                "attempts = ? WHERE id = ?",
+                                (not_before, attempts, row_id))
+        if attempts >= self.max_attempts:
+            log("Dropped deferred {kind} to {target} after {n} attempts"
+                "".format(kind=kind, target=target, n=attempts), alert=True)
+
+class WorkJournal(object):
+
+    """Records how far each inbox item has got through processing so
+    that a crash neither drops nor double answers a mention. An item is
+    fetched, then submitted to ideone, then replied to and finally marked
+    as read. Items are left unread in the inbox until they reach the
+    last state, so after a restart they are fetched again and resume
+    from where they left off. Items that were parked on their last
+    attempt are flagged, so that fetching them again isn't mistaken for
+    new activity. The journal is stored in a sqlite database.
+    """
+
+    FETCHED = 'fetched'
+    SUBMITTED = 'submitted'
+    REPLIED = 'replied'
+    READ = 'read'
+
+    def __init__(self, path=':memory:', max_attempts=3, retention=604800,
+                 clock=time.time):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS items ("
+                            "id TEXT PRIMARY KEY, state TEXT, link TEXT, "
+                            "attempts INTEGER, updated REAL, owner INTEGER, "
+                            "parked INTEGER)")
+            # Journals created before items were parked lack the column
+            # for it.
+            columns = [row[1] for row in
+                       self.db.execute("PRAGMA table_info(items)")]
+            if 'parked' not in columns:
+                self.db.execute("ALTER TABLE items ADD COLUMN parked INTEGER")
+
+    def reopen(self):
+        """Open a new connection to the database. Connections must not be
+        shared with a forked process.
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+
+    def get(self, item_id):
+        """Return the state, ideone link and number of attempts of an
+        item, or None if it has never been fetched.
+        """
+        with self.lock:
+            return self.db.execute("SELECT state, link, attempts FROM items "
+                                   "WHERE id = ?", (item_id,)).fetchone()
+
+    def state(self, item_id):
+        row = self.get(item_id)
+        return row[0] if row else None
+
+    def link(self, item_id):
+        """Return the link of an item's ideone submission if the item is
+        still waiting on it.
+        """
+        row = self.get(item_id)
+        return row[1] if row and row[0] == self.SUBMITTED else None
+
+    def fetched(self, item_id):
+        """Record the start of an attempt to process an item."""
+        with self.lock, self.db:
+            self.db.execute("INSERT OR IGNORE INTO items (id, state, "
+                            "attempts) VALUES (?, ?, 0)",
+                            (item_id, self.FETCHED))
+            self.db.execute("UPDATE items SET attempts = attempts + 1, "
+                            "parked = 0, updated = ? WHERE id = ?",
+                            (self.clock(), item_id))
+
+    def submitted(self, item_id, link):
+        """Record the ideone link of an item that is being processed.
+        Items in any other state, such as comments that are recompiled
+        after they were answered, are left alone.
+        """
+        with self.lock, self.db:
+            self.db.execute("UPDATE items SET state = ?, link = ?, "
+                            "updated = ? WHERE id = ? AND state = ?",
+                            (self.SUBMITTED, link, self.clock(), item_id,
+                             self.FETCHED))
+
+    def unsubmit(self, item_id):
+        """Forget the ideone link of an item that is waiting on it, so that
+        its source is submitted again.
+        """
+        with self.lock, self.db:
+            self.db.execute("UPDATE items SET state = ?, link = NULL, "
+                            "updated = ? WHERE id = ? AND state = ?",
+                            (self.FETCHED, self.clock(), item_id,
+                             self.SUBMITTED))
+
+    def parked(self, item_id):
+        """Record that an item was left unread without being processed,
+        so that the attempt isn't counted towards max_attempts.
+        """
+        with self.lock, self.db:
+            self.db.execute("UPDATE items SET attempts = MAX(attempts - 1, "
+                            "0), parked = 1, updated = ? WHERE id = ?",
+                            (self.clock(), item_id))
+
+    def was_parked(self, item_id):
+        """Return true if an item was parked on its last attempt."""
+        with self.lock:
+            row = self.db.execute("SELECT parked FROM items WHERE id = ?",
+                                  (item_id,)).fetchone()
+        return bool(row and row[0])
+
+    def record(self, item_id, state):
+        """Move an item to a new state."""
+        with self.lock, self.db:
+            self.db.execute("INSERT OR IGNORE INTO items (id, attempts) "
+                            "VALUES (?, 0)", (item_id,))
+            self.db.execute("UPDATE items SET state = ?, updated = ? "
+                            "WHERE id = ?", (state, self.clock(), item_id))
+
+    def answered(self, item_id):
+        """Return true if an item has already been replied to."""
+        return self.state(item_id) in (self.REPLIED, self.READ)
+
+    def retry(self, item_id):
+        """Return true if an item that failed should be left unread so
+        that it is processed again. Items that have been replied to, or
+        that have failed max_attempts times, are not retried.
+        """
+        row = self.get(item_id)
+        return bool(row and row[0] not in (self.REPLIED, self.READ) and
+                    row[2] < self.max_attempts)
+
+    def claim(self, item_id, owner):
+        """Claim an item for a worker. Returns false if the item is
+        already claimed by a worker or has been marked as read, so that
+        an item fetched again while it's being processed is skipped.
+        """
+        with self.lock, self.db:
+            self.db.execute("INSERT OR IGNORE INTO items (id, state, "
+                            "attempts) VALUES (?, ?, 0)",
+                            (item_id, self.FETCHED))
+            cursor = self.db.execute("UPDATE items SET owner = ? WHERE "
+                                     "id = ? AND owner IS NULL AND "
+                                     "state != ?",
+                                     (owner, item_id, self.READ))
+            return cursor.rowcount == 1
+
+    def unclaim(self, item_id):
+        """Release the claim on an item once a worker is done with it."""
+        with self.lock, self.db:
+            self.db.execute("UPDATE items SET owner = NULL WHERE id = ?",
+                            (item_id,))
+
+    def release(self, owner=None):
+        """Release every claim held by a worker, or by any worker if none
+        is given.
+        """
+        with self.lock, self.db:
+            if owner is None:
+                self.db.execute("UPDATE items SET owner = NULL")
+            else:
+                self.db.execute("UPDATE items SET owner = NULL WHERE "
+                                "owner = ?", (owner,))
+
+    def prune(self):
+        """Forget items that were marked as read before the retention
+        period.
+        """
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM items WHERE state = ? AND "
+                            "updated < ?",
+                            (self.READ, self.clock() - self.retention))
+
 def log(message, alert=False):
     """Log messages along with a timestamp in a log file. If the alert
     option is set to true, send a message to the admin's reddit inbox.
@@ -115,43 +843,1141 @@ def log(message, alert=False):
     t = time.strftime('%y-%m-%d %H:%M:%S', time.localtime())
     message = "{}: {}\n".format(t, message)
     if LOG_FILE:
-        with open(LOG_FILE, 'a') as f:
-            f.write(message)
+        log_file().write(message)
     else:
-        print(message, end='')
+        with LOG_LOCK:
+            print(message, end='')
     if alert and ADMIN:
-        r = praw.Reddit(USER_AGENT)
-        r.login(R_USERNAME, R_PASSWORD)
-        admin_alert = message
-        subject = "CompileBot Alert"
-        r.send_message(ADMIN, subject, admin_alert)
+        ALERTS.alert(message)
+
+def log_file():
+    """Return the open log file, opening it if the log file setting has
+    changed.
+    """
+    global LOG
+    with LOG_LOCK:
+        if LOG is None or LOG.path != LOG_FILE:
+            if LOG is not None:
+                LOG.flush()
+            LOG = LogFile(LOG_FILE, max_bytes=LOG_MAX_BYTES,
+                          backups=LOG_BACKUPS,
+                          flush_interval=LOG_FLUSH_INTERVAL)
+        return LOG
+
+def flush_logs():
+    """Write any buffered log messages and send any queued alerts."""
+    if LOG is not None:
+        LOG.flush()
+    ALERTS.flush()
+
+def write_metrics():
+    """Write the metrics to the JSON snapshot and Prometheus text files
+    named in the settings.
+    """
+    for path, text in ((METRICS_FILE, lambda: json.dumps(METRICS.snapshot())),
+                       (PROMETHEUS_FILE, METRICS.prometheus)):
+        if path:
+            with open(path + '.tmp', 'w') as f:
+                f.write(text())
+            os.rename(path + '.tmp', path)
+
+class ClientPool(object):
+
+    """A bounded pool of long lived ideone clients. Creating a client sets
+    up a new SOAP client and connection, so clients are reused between
+    requests instead. A client that raises a transport error, or that has
+    been idle long enough for its connection to have gone stale, is
+    discarded and a new one is built the next time a client is needed.
+    """
+
+    def __init__(self, size, factory=None, max_idle=None, clock=time.time):
+        self.factory = factory or (lambda: ideone.Ideone(I_USERNAME,
+                                                         I_PASSWORD))
+        self.max_idle = max_idle if max_idle is not None else CLIENT_MAX_IDLE
+        self.clock = clock
+        # Idle clients are stored as (client, last_used) tuples. The most
+        # recently used client is handed out first since its connection
+        # is the most likely to still be open.
+        self.idle = Queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(max(size, 1))
+
+    @contextlib.contextmanager
+    def client(self, link=None):
+        """Check out a client for the duration of a with block. Every
+        client in a pool uses the same account, so the link of the
+        submission the client is checked out for doesn't matter.
+        """
+        with METRICS.span('client_wait'):
+            self.slots.acquire()
+        try:
+            client = self._checkout()
+            try:
+                yield client
+            except ideone.LanguageNotFoundError:
+                # Errors returned by the API itself don't indicate that
+                # anything is wrong with the client.
+                self._checkin(client)
+                raise
+            except:
+                log("Discarding ideone client after error")
+                raise
+            else:
+                self._checkin(client)
+        finally:
+            self.slots.release()
+
+    def _checkout(self):
+        while True:
+            try:
+                client, last_used = self.idle.get_nowait()
+            except Queue.Empty:
+                return self.factory()
+            if self.clock() - last_used <= self.max_idle:
+                return client
+
+    def _checkin(self, client):
+        self.idle.put((client, self.clock()))
+
+class AccountHealth(object):
+
+    """The recent performance of an ideone account. Latency and error
+    rate are exponentially weighted moving averages over its requests.
+    """
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.in_flight = 0
+        self.latency = 0.0
+        self.error_rate = 0.0
+        # Consecutive failures, and the number of times in a row the
+        # account has been ejected.
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = None
+        self.probing = False
+
+    def score(self):
+        """Return the expected wait for a successful request, which is
+        lowest for the account that should be used next.
+        """
+        return ((self.in_flight + 1) * max(self.latency, 0.01) /
+                max(1 - self.error_rate, 0.05))
+
+class AccountRouter(object):
+
+    """Spreads ideone requests across several accounts, each with its own
+    pool of clients. A new submission goes to the account with the lowest
+    score, based on its requests in flight, recent latency and recent
+    error rate. A submission is polled through the account that made it.
+    Transport errors, API errors and internal errors (result 20) count as
+    failures. An account that fails eject_after times in a row, or whose
+    error rate reaches max_error_rate, is ejected for eject_time seconds,
+    doubled every time it's ejected again up to max_eject_time. After
+    that a single probe request is sent through it, and the account is
+    only used again if the probe succeeds. A probe that fails before it
+    makes a request, for example because a client can't be created,
+    counts as a failed probe, and one that ends without making a request
+    lets the next request probe instead. If every account has been
+    ejected, the one that is due back first is used rather than failing
+    outright.
+    """
+
+    # The weight given to the latest request in the moving averages.
+    DECAY = 0.2
+
+    def __init__(self, pools, eject_after=3, max_error_rate=0.5,
+                 eject_time=60, max_eject_time=900, clock=time.time):
+        self.accounts = [AccountHealth(name, pool) for name, pool in pools]
+        self.eject_after = eject_after
+        self.max_error_rate = max_error_rate
+        self.eject_time = eject_time
+        self.max_eject_time = max_eject_time
+        self.clock = clock
+        self.lock = threading.Lock()
+        # The account that made each submission that is still running.
+        self.links = {}
+        self.turn = 0
+
+    @contextlib.contextmanager
+    def client(self, link=None):
+        """Check out a client of the best account for the duration of a
+        with block, or a client of the account that made a submission if
+        its link is given.
+        """
+        account, probe = self._choose(link)
+        failed = False
+        try:
+            with account.pool.client() as client:
+                yield RoutedClient(self, account, client)
+        except:
+            failed = True
+            raise
+        finally:
+            with self.lock:
+                account.in_flight -= 1
+                # A probe that made a request has already been recorded.
+                if probe and account.probing:
+                    account.probing = False
+                    if failed:
+                        self._eject(account)
+
+    def _choose(self, link):
+        now = self.clock()
+        with self.lock:
+            account, probe = self.links.get(link), False
+            if account is None or account.ejected_until is not None:
+                account, probe = self._best(now)
+            account.in_flight += 1
+            return account, probe
+
+    def _best(self, now):
+        """Return the account to use next, and whether the request is a
+        probe.
+        """
+        for account in self.accounts:
+            if (account.ejected_until is not None and
+                account.ejected_until <= now and not account.probing):
+                log("Probing ideone account {}".format(account.name))
+                account.probing = True
+                return account, True
+        healthy = [a for a in self.accounts if a.ejected_until is None]
+        if healthy:
+            # Accounts are taken in turn when their scores are tied.
+            self.turn = (self.turn + 1) % len(healthy)
+            return min(healthy[self.turn:] + healthy[:self.turn],
+                       key=AccountHealth.score), False
+        return min(self.accounts, key=lambda a: a.ejected_until), False
+
+    def record(self, account, seconds, ok):
+        """Record the latency and outcome of a request made through an
+        account.
+        """
+        with self.lock:
+            account.latency += self.DECAY * (seconds - account.latency)
+            account.error_rate += self.DECAY * ((not ok) -
+                                                account.error_rate)
+            if ok:
+                account.failures = 0
+                if account.probing:
+                    account.ejected_until = None
+                    account.ejections = 0
+                    account.error_rate = 0.0
+                    log("Ideone account {} is back".format(account.name))
+                account.probing = False
+                return
+            account.failures += 1
+            if account.probing or (
+                    account.ejected_until is None and
+                    (account.failures >= self.eject_after or
+                     account.error_rate >= self.max_error_rate)):
+                account.probing = False
+                self._eject(account)
+
+    def _eject(self, account):
+        account.ejections += 1
+        duration = min(self.eject_time * 2 ** (account.ejections - 1),
+                       self.max_eject_time)
+        account.ejected_until = self.clock() + duration
+        METRICS.count('account_ejections_total', account=account.name)
+        log("Ejected ideone account {name} for {time} seconds"
+            "".format(name=account.name, time=duration), alert=True)
+
+    def stats(self):
+        """Return the health of each account."""
+        with self.lock:
+            return {a.name: {'in_flight': a.in_flight,
+                             'latency': a.latency,
+                             'error_rate': a.error_rate,
+                             'ejected': a.ejected_until is not None}
+                    for a in self.accounts}
+
+class RoutedClient(object):
+
+    """Wraps an ideone client to report the outcome of each request to
+    the account router.
+    """
+
+    def __init__(self, router, account, client):
+        self.router = router
+        self.account = account
+        self.client = client
+
+    def _call(self, method, *args, **kwargs):
+        start = self.router.clock()
+        try:
+            result = method(*args, **kwargs)
+        except ideone.LanguageNotFoundError:
+            # The request was fine, the language wasn't.
+            self.router.record(self.account, self.router.clock() - start,
+                               True)
+            raise
+        except:
+            self.router.record(self.account, self.router.clock() - start,
+                               False)
+            raise
+        return result, self.router.clock() - start
+
+    def create_submission(self, *args, **kwargs):
+        sub, seconds = self._call(self.client.create_submission,
+                                  *args, **kwargs)
+        self.router.record(self.account, seconds, True)
+        with self.router.lock:
+            self.router.links[sub['link']] = self.account
+        return sub
+
+    def submission_details(self, link):
+        details, seconds = self._call(self.client.submission_details, link)
+        self.router.record(self.account, seconds, details['status'] != 0 or
+                           details['result'] != 20)
+        if details['status'] == 0:
+            with self.router.lock:
+                self.router.links.pop(link, None)
+        return details
+
+    def languages(self):
+        languages, seconds = self._call(self.client.languages)
+        self.router.record(self.account, seconds, True)
+        return languages
+
+class CircuitBreaker(object):
+
+    """Stops submissions to ideone while it's failing. Transport errors,
+    internal errors (result 20), submissions that miss the polling
+    deadline and requests that take longer than slow_call seconds all
+    count as failures, and a finished submission counts as a success.
+    After threshold failures in a row the breaker opens, and no new
+    submissions are made for reset_timeout seconds. After that a single
+    probe is let through: the breaker closes if it succeeds and opens
+    again if it fails. A probe that never reports back is replaced by
+    another one after reset_timeout seconds.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold=5, reset_timeout=60, slow_call=30,
+                 clock=time.time):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.slow_call = slow_call
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        # When the breaker opened, or when the current probe was let
+        # through while it's half open.
+        self.since = None
+
+    def allow(self):
+        """Return true if a submission can be made. Once the breaker has
+        been open for reset_timeout seconds this returns true once, for
+        the probe.
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            now = self.clock()
+            if now - self.since < self.reset_timeout:
+                return False
+            if self.state == self.OPEN:
+                log("Probing ideone")
+            self.state = self.HALF_OPEN
+            self.since = now
+            return True
+
+    def opened(self):
+        """Return true if requests for submissions that were already made
+        should stop as well.
+        """
+        with self.lock:
+            return self.state == self.OPEN
+
+    def success(self):
+        with self.lock:
+            if self.state == self.OPEN:
+                # Only the probe can close an open breaker.
+                return
+            if self.state == self.HALF_OPEN:
+                log("Ideone is back, closing the circuit breaker")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (
+                    self.state == self.CLOSED and
+                    self.failures >= self.threshold):
+                self.state = self.OPEN
+                self.since = self.clock()
+                METRICS.count('circuit_opened_total')
+                log("Ideone is failing, opening the circuit breaker for "
+                    "{} seconds".format(self.reset_timeout), alert=True)
+
+    def record(self, details):
+        """Record the outcome of a finished submission."""
+        if details['result'] == 20:
+            self.failure()
+        else:
+            self.success()
+
+    @contextlib.contextmanager
+    def guard(self):
+        """Count a request made in a with block as a failure if it raises
+        an error or takes longer than slow_call seconds.
+        """
+        start = self.clock()
+        try:
+            yield
+        except ideone.LanguageNotFoundError:
+            raise
+        except:
+            self.failure()
+            raise
+        if self.clock() - start > self.slow_call:
+            self.failure()
+
+class ReplyIndex(object):
+
+    """Maps each comment the bot has replied to onto the id of the bot's
+    reply and the digest of the reply's output, so that a recompile
+    request can edit the reply without searching the comment's thread
+    for it. The index is stored in a sqlite database.
+    """
+
+    def __init__(self, path=':memory:', clock=time.time):
+        self.path = path
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS replies ("
+                            "comment_id TEXT PRIMARY KEY, reply_id TEXT, "
+                            "digest TEXT, updated REAL)")
+
+    def reopen(self):
+        """Open a new connection to the database. Connections must not be
+        shared with a forked process.
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+
+    def get(self, comment_id):
+        """Return a (reply_id, digest) tuple for a comment, or None if the
+        bot's reply to it isn't known.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT reply_id, digest FROM replies "
+                                  "WHERE comment_id = ?",
+                                  (comment_id,)).fetchone()
+        return tuple(row) if row else None
+
+    def put(self, comment_id, reply_id, digest):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO replies (comment_id, "
+                            "reply_id, digest, updated) VALUES "
+                            "(?, ?, ?, ?)",
+                            (comment_id, reply_id, digest, self.clock()))
+
+class PollSchedule(object):
+
+    """Decides when to check on the status of a submission. The first
+    check is made after about as long as programs in the same language
+    usually take to run, and later checks back off exponentially with
+    some random jitter so that concurrent submissions don't poll in
+    lockstep. Once the deadline has passed a SubmissionTimeout is raised.
+    """
+
+    def __init__(self, lang, start):
+        self.lang = lang
+        self.deadline = start + POLL_DEADLINE
+        with RUNTIME_LOCK:
+            estimate = RUNTIME_ESTIMATES.get(lang, 0)
+        self.delay = min(max(POLL_INITIAL, estimate), POLL_MAX)
+        self.due = start + self.delay
+        self.polls = 0
+
+    def advance(self, now):
+        """Schedule the next status check after a check has found that
+        the submission is still running.
+        """
+        self.polls += 1
+        if now >= self.deadline:
+            raise SubmissionTimeout("Submission not finished after "
+                                    "{} checks".format(self.polls))
+        self.delay = min(self.delay * POLL_FACTOR, POLL_MAX)
+        jitter = random.uniform(-POLL_JITTER, POLL_JITTER) * self.delay
+        self.due = min(now + self.delay + jitter, self.deadline)
+
+def record_runtime(lang, details):
+    """Update the estimated execution time for a language with the time
+    taken by a finished submission.
+    """
+    try:
+        runtime = float(details['time'])
+    except (KeyError, TypeError, ValueError):
+        return
+    with RUNTIME_LOCK:
+        estimate = RUNTIME_ESTIMATES.get(lang)
+        if estimate is None:
+            RUNTIME_ESTIMATES[lang] = runtime
+        else:
+            # Exponentially weighted moving average of recent runtimes.
+            RUNTIME_ESTIMATES[lang] = 0.8 * estimate + 0.2 * runtime
+
+def text_digest(text, chunk_size=65536):
+    """Return the sha256 digest of a text, encoding it a chunk at a time
+    so that no full size copy of it is made.
+    """
+    digest = hashlib.sha256()
+    for start in range(0, len(text), chunk_size):
+        digest.update(text[start:start + chunk_size].encode('utf-8'))
+    return digest.hexdigest()
+
+def cap_details(details):
+    """Cap the output fields of a finished submission's details at
+    OUTPUT_CAP characters so that programs that flood stdout don't hold
+    on to memory while their reply is built. The full length, number of
+    line breaks and digest of each field are kept in the details as
+    <field>_length, <field>_lines and <field>_digest. Returns the number
+    of characters of output the submission held before it was capped,
+    which is also recorded in the output_held_chars metrics.
+    """
+    held = 0
+    for field in ('output', 'stderr', 'cmpinfo'):
+        text = details.get(field) or ''
+        held += len(text)
+        details[field + '_length'] = len(text)
+        details[field + '_lines'] = text.count('\n')
+        details[field + '_digest'] = text_digest(text)
+        details[field] = text[:OUTPUT_CAP]
+    METRICS.count('output_held_chars_total', held)
+    METRICS.peak('output_held_chars_max', held)
+    if held > OUTPUT_CAP:
+        log("Capped output of ideone submission {link} from {held} "
+            "characters".format(link=details.get('link'), held=held))
+    return held
+
+def field_length(details, field):
+    """Return the full length of an output field of a submission's
+    details, which may have been capped.
+    """
+    return details.get(field + '_length', len(details[field]))
+
+def field_lines(details, field):
+    """Return the number of line breaks in the whole of an output field
+    of a submission's details, which may have been capped.
+    """
+    lines = details.get(field + '_lines')
+    return lines if lines is not None else details[field].count('\n')
+
+class ResultCache(object):
+
+    """A content addressed cache of finished submission details stored in
+    a sqlite database. Entries expire after ttl seconds and the least
+    recently used entries are evicted once there are more than
+    max_entries of them.
+    """
+
+    def __init__(self, path, ttl, max_entries, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS results ("
+                            "key TEXT PRIMARY KEY, details TEXT, "
+                            "created REAL, used REAL)")
+
+    def reopen(self):
+        """Open a new connection to the database. Connections must not be
+        shared with a forked process.
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+
+    @staticmethod
+    def key(lang, source, stdin):
+        """Return the cache key of a program in a language with an input."""
+        request = json.dumps([resolve_language(lang).lower(), source, stdin])
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Return the cached details for a key, or None if there are none."""
+        now = self.clock()
+        with self.lock, self.db:
+            row = self.db.execute("SELECT details FROM results WHERE key = ? "
+                                  "AND created > ?",
+                                  (key, now - self.ttl)).fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE results SET used = ? WHERE key = ?",
+                            (now, key))
+        return json.loads(row[0])
+
+    def put(self, key, details):
+        """Store the details of a finished submission."""
+        now = self.clock()
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO results VALUES "
+                            "(?, ?, ?, ?)",
+                            (key, json.dumps(details, default=str), now, now))
+            self.db.execute("DELETE FROM results WHERE created <= ?",
+                            (now - self.ttl,))
+            self.db.execute("DELETE FROM results WHERE key NOT IN (SELECT "
+                            "key FROM results ORDER BY used DESC LIMIT ?)",
+                            (self.max_entries,))
+
+def cached_details(key):
+    """Return the cached details of an identical earlier submission, or
+    None if there are none.
+    """
+    if not RESULT_CACHE:
+        return None
+    details = RESULT_CACHE.get(key)
+    if details is not None:
+        METRICS.count('cache_hits_total')
+        log("Cache hit for ideone submission {}".format(details['link']))
+    else:
+        METRICS.count('cache_misses_total')
+    return details
+
+def cache_details(key, details):
+    """Store the details of a finished submission in the result cache.
+    Internal errors are not cached since they should be retried.
+    """
+    if RESULT_CACHE and details['result'] != 20:
+        RESULT_CACHE.put(key, details)
+
+def resolve_language(lang):
+    """Return the ideone name of a language, expanding any shortcuts."""
+    return LANG_SHORTCUTS.get(lang.lower(), lang)
+
+class LanguageIndex(object):
+
+    """The languages supported by ideone, indexed by name so that the
+    language of a request can be resolved to its ideone id without a
+    round trip. Languages are matched by their full ideone name, such as
+    "Python 3 (python-3.4)", or by the name without the version, such as
+    "Python 3", after any shortcuts are expanded. The list is fetched
+    from ideone every refresh_interval seconds and saved to a snapshot
+    file so that it survives restarts.
+    """
+
+    def __init__(self, path='', refresh_interval=86400, clock=time.time):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.clock = clock
+        self.languages = {}
+        # The time of the last fetch, or None if there hasn't been one.
+        self.fetched = None
+        self.load()
+
+    def load(self):
+        """Read the language list from the snapshot file, if there is one."""
+        if not self.path:
+            return
+        try:
+            with open(self.path) as f:
+                snapshot = json.load(f)
+            languages = {int(k): v for k, v in snapshot['languages'].items()}
+            fetched = snapshot['fetched']
+        except (IOError, ValueError, KeyError):
+            return
+        self._build(languages)
+        self.fetched = fetched
+
+    def _build(self, languages):
+        # Full names are indexed first so that they take precedence over
+        # a name without its version that happens to be the same.
+        index = {}
+        names = {}
+        for lang_id, name in sorted(languages.items()):
+            index.setdefault(name.lower(), lang_id)
+            names.setdefault(name.lower(), name)
+        for lang_id, name in sorted(languages.items()):
+            simple = name.split('(')[0].strip()
+            index.setdefault(simple.lower(), lang_id)
+            names.setdefault(simple.lower(), simple)
+        # Replace the lookup tables all at once since worker threads may
+        # be reading them.
+        self.languages, self.index, self.names = languages, index, names
+
+    def stale(self):
+        return (self.fetched is None or
+                self.clock() - self.fetched >= self.refresh_interval)
+
+    def update(self, client):
+        """Fetch the language list from ideone if it's out of date."""
+        if not self.stale():
+            return
+        throttle('ideone_poll')
+        languages = client.languages()
+        self._build(languages)
+        self.fetched = self.clock()
+        log("Fetched {} ideone languages".format(len(languages)))
+        self.save()
+
+    def save(self):
+        """Write the language list to the snapshot file."""
+        if not self.path:
+            return
+        snapshot = {'languages': self.languages, 'fetched': self.fetched}
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(snapshot, f)
+        os.rename(self.path + '.tmp', self.path)
+
+    def lookup(self, lang):
+        """Return the ideone id of a language, or None if it isn't known."""
+        if not self.languages:
+            return None
+        for name in (resolve_language(lang), lang):
+            lang_id = self.index.get(name.lower())
+            if lang_id is not None:
+                return lang_id
+        return None
+
+    def similar(self, lang, n=3):
+        """Return the names of up to n languages similar to lang."""
+        matches = difflib.get_close_matches(lang.lower(), self.names, n=n,
+                                            cutoff=0.3)
+        return [self.names[name] for name in matches]
+
+    def resolve(self, lang):
+        """Return the ideone id of a language, or None if the language
+        list hasn't been fetched yet, in which case ideone resolves the
+        name itself. Raises a LanguageNotFoundError with suggestions if
+        the language isn't supported.
+        """
+        lang_id = self.lookup(lang)
+        if lang_id is None and self.languages:
+            raise ideone.LanguageNotFoundError(
+                "Couldn't match '{}' to an ideone language".format(lang),
+                self.similar(lang))
+        return lang_id
+
+def refresh_languages():
+    """Bring the language index up to date. A failed fetch is retried
+    the next time the inbox is checked, and until then the old list is
+    kept.
+    """
+    if not LANGUAGES.stale():
+        return
+    try:
+        with CLIENTS.client() as client:
+            LANGUAGES.update(client)
+    except Exception:
+        log("Could not fetch ideone languages\n" + traceback.format_exc())
+
+def submit(source, lang, stdin='', client=None):
+    """Create an ideone submission and return its link without waiting
+    for the submission to finish executing. Raises a
+    LanguageNotFoundError before anything is sent to ideone if the
+    language index doesn't know the language. If no client is given,
+    the outcome is reported to the circuit breaker, otherwise that's up
+    to the caller, who also has to check the client out.
+    """
+    lang_id = LANGUAGES.resolve(lang)
+    if client is None:
+        # Errors creating a client count as failures too.
+        with BREAKER.guard(), CLIENTS.client() as client:
+            return submit(source, lang, stdin, client=client)
+    with METRICS.span('submit'):
+        throttle('ideone_submit')
+        if lang_id is not None:
+            sub = client.create_submission(source, language_id=lang_id,
+                                           std_input=stdin)
+        else:
+            sub = client.create_submission(
+                source, language_name=resolve_language(lang),
+                std_input=stdin)
+    return sub['link']
+
+def record_result(details, item_id=None):
+    """Report a finished ideone submission to the circuit breaker. If it
+    ended in an internal error that opened the breaker, the submission
+    is forgotten and a BackendUnavailable is raised, so that the source
+    is submitted again once ideone has recovered rather than answered
+    with an internal error.
+    """
+    BREAKER.record(details)
+    if details['result'] == 20 and BREAKER.opened():
+        if item_id:
+            JOURNAL.unsubmit(item_id)
+        raise BackendUnavailable()
+
+class IdeoneBackend(object):
+
+    """Executes source code on ideone. A submission is made and then
+    polled until it has finished executing.
+    """
+
+    def supports(self, lang):
+        # Until the language list has been fetched ideone is left to
+        # resolve the name itself.
+        return not LANGUAGES.languages or LANGUAGES.lookup(lang) is not None
+
+    def execute(self, source, lang, stdin='', item_id=None):
+        """Return the details of a finished ideone submission. Raises a
+        SubmissionTimeout if the submission doesn't finish before the
+        polling deadline, and a BackendUnavailable if the circuit breaker
+        is open.
+        """
+        if not BREAKER.allow():
+            raise BackendUnavailable()
+        sub_link = JOURNAL.link(item_id) if item_id else None
+        if sub_link:
+            log("Resuming ideone submission {link} for {id}".format(
+                link=sub_link, id=item_id))
+        else:
+            sub_link = submit(source, lang, stdin)
+            if item_id:
+                JOURNAL.submitted(item_id, sub_link)
+        schedule = PollSchedule(resolve_language(lang), time.time())
+        # The status of the submission indicates whether or not the source
+        # has finished executing. A status of 0 indicates the submission
+        # is finished.
+        while True:
+            time.sleep(max(schedule.due - time.time(), 0))
+            if BREAKER.opened():
+                # The submission is picked up again by its link once
+                # ideone has recovered.
+                raise BackendUnavailable()
+            with BREAKER.guard(), CLIENTS.client(sub_link) as i, \
+                 METRICS.span('poll'):
+                throttle('ideone_poll')
+                details = i.submission_details(sub_link)
+            if details['status'] == 0:
+                break
+            try:
+                schedule.advance(time.time())
+            except SubmissionTimeout:
+                BREAKER.failure()
+                raise
+        record_result(details, item_id)
+        record_runtime(schedule.lang, details)
+        details['link'] = sub_link
+        return details
+
+class LocalRunner(object):
+
+    """Executes source code in a subprocess on this machine instead of on
+    ideone, for the languages it's configured with. Each language names
+    the file the source is written to, an optional command that compiles
+    it and the command that runs it, for example:
+
+        "C": {"source": "prog.c",
+              "compile": ["gcc", "-O2", "-o", "prog", "prog.c", "-lm"],
+              "run": ["./prog"]}
+
+    Each program runs in a new temporary directory with resource limits
+    on its CPU time, memory, the size of the files it writes (including
+    its output) and optionally the number of processes, and is killed if
+    it's still running after wall_limit seconds. Only the first
+    output_limit bytes of its output are kept, and a program that runs
+    into file_limit is treated as if it had finished, since that can
+    only be reached by writing far more output than is kept. The details
+    returned have the same fields and result codes as ideone's, except
+    that there is no ideone link.
+
+    The limits don't stop a program from reading files or from using
+    the network, so programs must not run as the bot's own user, which
+    can read the settings file. Every command is run as another user,
+    which requires the bot to run as root, or through a jail, which is a
+    command such as bwrap or nsjail that the command is appended to, or
+    both. A ValueError is raised if neither is given. Programs only get
+    a minimal environment, never the bot's own.
+
+    A program can escape its process group and keep running after it
+    exits. When programs run as other users, user is a list of names or
+    uids that are used for nothing else, each program gets one of them
+    to itself, and every process of that user is killed once the
+    program is done. Each user is locked with a file as well, so that
+    several bot processes can share them. Programs run one at a time per
+    user. A jail without a user must give each program its own PID
+    namespace, for example with bwrap's --unshare-pid and
+    --die-with-parent, so that nothing outlives it.
+    """
 
-def compile(source, lang, stdin=''):
-    """Compile and evaluate source sode using the ideone API and return
-    a dict containing the output details.
+    # The whole environment of every command, apart from HOME, which is
+    # set to the program's directory.
+    ENV = {'PATH': '/usr/local/bin:/usr/bin:/bin', 'LANG': 'C.UTF-8'}
+
+    # Error output that shows a program ran out of memory, since running
+    # into the address space limit makes allocations fail rather than
+    # killing the program.
+    MEMORY_ERRORS = ('MemoryError', 'std::bad_alloc', 'OutOfMemoryError',
+                     'Cannot allocate memory', 'out of memory')
+
+    def __init__(self, languages, time_limit=5, wall_limit=None,
+                 compile_time_limit=10, memory_limit=256 * 1024 * 1024,
+                 compile_memory_limit=1024 * 1024 * 1024,
+                 output_limit=65536, file_limit=64 * 1024 * 1024,
+                 max_processes=16, user=None, jail=None):
+        if not user and not jail:
+            raise ValueError("The local runner needs a user or a jail to "
+                             "run programs in")
+        self.languages = {name.lower(): dict(config, name=name)
+                          for name, config in languages.items()}
+        self.time_limit = time_limit
+        self.wall_limit = wall_limit or time_limit * 3
+        self.compile_time_limit = compile_time_limit
+        self.memory_limit = memory_limit
+        self.compile_memory_limit = compile_memory_limit
+        self.output_limit = output_limit
+        self.file_limit = max(file_limit, output_limit)
+        self.max_processes = max_processes
+        # The (uid, gid) of each user that isn't running a program.
+        self.users = None
+        if user:
+            self.users = Queue.Queue()
+            for name in [user] if isinstance(user, basestring) else user:
+                if isinstance(name, int):
+                    account = (name, name)
+                else:
+                    entry = pwd.getpwnam(name)
+                    account = (entry.pw_uid, entry.pw_gid)
+                # Every process of the user is killed after each run.
+                if account[0] in (0, os.getuid()):
+                    raise ValueError("Programs can't run as root or as "
+                                     "the bot's own user")
+                self.users.put(account)
+        self.jail = list(jail or [])
+
+    @contextlib.contextmanager
+    def user(self):
+        """Check out a user to run a program as for the duration of a
+        with block, or None if programs run as the bot's user.
+        """
+        if self.users is None:
+            yield None
+            return
+        account = self.users.get()
+        try:
+            path = os.path.join(tempfile.gettempdir(),
+                                'compilebot-runner-{}.lock'.format(account[0]))
+            with open(path, 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    yield account
+                finally:
+                    self._kill_all(account[0])
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        finally:
+            self.users.put(account)
+
+    def _kill_all(self, uid):
+        """Kill every process of a user, from a child process that has
+        become the user, since only that kills processes that have left
+        the program's process group.
+        """
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.setuid(uid)
+                # Processes can fork while they're being killed, so this
+                # is repeated until there are none left.
+                for _ in range(100):
+                    os.kill(-1, signal.SIGKILL)
+            except BaseException:
+                pass
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+    def language(self, lang):
+        """Return the configuration of a language, or None if the runner
+        isn't configured to run it.
+        """
+        for name in (resolve_language(lang), lang):
+            config = self.languages.get(name.lower())
+            if config is not None:
+                return config
+        return None
+
+    def supports(self, lang):
+        return self.language(lang) is not None
+
+    def execute(self, source, lang, stdin='', item_id=None):
+        """Compile and run source code and return its details."""
+        config = self.language(lang)
+        details = {
+            'cmpinfo': '', 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'error': 'OK', 'input': stdin, 'langId': None,
+            'langName': config['name'], 'langVersion': '', 'link': '',
+            'memory': 0, 'output': '', 'public': False, 'result': 15,
+            'signal': 0, 'source': source, 'status': 0, 'stderr': '',
+            'time': 0,
+        }
+        with self.user() as account:
+            directory = tempfile.mkdtemp(prefix='compilebot-')
+            try:
+                path = os.path.join(directory, config['source'])
+                with io.open(path, 'w', encoding='utf-8') as f:
+                    f.write(source)
+                if account is not None:
+                    # The directory is only accessible to the bot, so it's
+                    # handed to the user the program runs as.
+                    os.chown(directory, *account)
+                    os.chown(path, *account)
+                if config.get('compile'):
+                    status, usage, timed_out, output, errors = self._run(
+                        config['compile'], directory, '',
+                        self.compile_time_limit, self.compile_time_limit * 3,
+                        self.compile_memory_limit, account=account)
+                    if timed_out or status != 0:
+                        details['cmpinfo'] = (output +
+                                              errors)[:self.output_limit]
+                        details['result'] = 13 if timed_out else 11
+                        return details
+                status, usage, timed_out, output, errors = self._run(
+                    config['run'], directory, stdin, self.time_limit,
+                    self.wall_limit, config.get('memory_limit',
+                                                self.memory_limit),
+                    self.file_limit, self.max_processes, account=account)
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+        details['output'] = output
+        details['stderr'] = errors
+        details['time'] = round(usage.ru_utime + usage.ru_stime, 2)
+        # ru_maxrss is in kilobytes on Linux, which is what ideone reports.
+        details['memory'] = usage.ru_maxrss
+        if os.WIFSIGNALED(status):
+            details['signal'] = os.WTERMSIG(status)
+        details['result'] = self._result(status, timed_out, errors)
+        return details
+
+    def _result(self, status, timed_out, errors):
+        """Return the ideone result code of a program that has exited."""
+        signaled = os.WIFSIGNALED(status)
+        if timed_out or (signaled and os.WTERMSIG(status) in
+                         (signal.SIGXCPU, signal.SIGKILL)):
+            return 13
+        if signaled and os.WTERMSIG(status) == signal.SIGXFSZ:
+            return 15
+        if signaled or os.WEXITSTATUS(status) != 0:
+            if any(error in errors for error in self.MEMORY_ERRORS):
+                return 17
+            return 12
+        return 15
+
+    def _run(self, command, directory, stdin, time_limit, wall_limit,
+             memory_limit, file_limit=0, max_processes=0, account=None):
+        """Run a command with resource limits and return its exit status,
+        resource usage, whether it ran out of wall clock time, and its
+        output and error output.
+        """
+        def limit():
+            # Start a new process group so that any processes the program
+            # starts are killed along with it.
+            os.setsid()
+            # Python ignores these signals, and ignored signals stay
+            # ignored in the program.
+            signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+            signal.signal(signal.SIGXFSZ, signal.SIG_DFL)
+            if account is not None:
+                os.setgroups([])
+                os.setgid(account[1])
+                os.setuid(account[0])
+            resource.setrlimit(resource.RLIMIT_CPU,
+                               (time_limit, time_limit + 1))
+            resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+            if file_limit:
+                resource.setrlimit(resource.RLIMIT_FSIZE,
+                                   (file_limit, file_limit))
+            if max_processes:
+                resource.setrlimit(resource.RLIMIT_NPROC,
+                                   (max_processes, max_processes))
+            # The bot itself may already use more address space than the
+            # program is allowed, so this limit comes last, once nothing
+            # else needs to be allocated before the exec.
+            resource.setrlimit(resource.RLIMIT_AS,
+                               (memory_limit, memory_limit))
+
+        # The program's input and output are kept in anonymous files
+        # rather than pipes, so that nothing has to be read until it
+        # exits, and so that the program can't swap them for other files.
+        with tempfile.TemporaryFile() as stdin_file, \
+             tempfile.TemporaryFile() as stdout_file, \
+             tempfile.TemporaryFile() as stderr_file:
+            stdin_file.write(stdin.encode('utf-8'))
+            stdin_file.seek(0)
+            process = subprocess.Popen(self.jail + list(command),
+                                       cwd=directory,
+                                       env=dict(self.ENV, HOME=directory),
+                                       stdin=stdin_file, stdout=stdout_file,
+                                       stderr=stderr_file, preexec_fn=limit,
+                                       close_fds=True)
+            timed_out = []
+            def kill():
+                timed_out.append(True)
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            timer = threading.Timer(wall_limit, kill)
+            timer.start()
+            try:
+                _, status, usage = os.wait4(process.pid, 0)
+            finally:
+                timer.cancel()
+            # Kill anything the program left running in the background.
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            output = []
+            for f in (stdout_file, stderr_file):
+                f.seek(0)
+                output.append(f.read(self.output_limit).decode('utf-8',
+                                                               'replace'))
+        return (status, usage, bool(timed_out)) + tuple(output)
+
+def backend_for(lang):
+    """Return the first execution backend that supports a language.
+    Raises a LanguageNotFoundError, with suggestions from ideone's
+    languages, if none of them do.
+    """
+    for backend in BACKENDS:
+        if backend.supports(lang):
+            return backend
+    LANGUAGES.resolve(lang)
+    raise ideone.LanguageNotFoundError(
+        "Couldn't match '{}' to a language".format(lang), [])
+
+def compile(source, lang, stdin='', fresh=False, item_id=None):
+    """Compile and evaluate source sode using the execution backend for
+    the language, usually the ideone API, and return a dict containing
+    the output details. Raises a SubmissionTimeout if an ideone
+    submission doesn't finish before the polling deadline, and a
+    BackendUnavailable while ideone's circuit breaker is open.
 
     Keyword arguments:
     source -- a string containing source code to be compiled and evaluated
     lang -- the programming language pertaining to the source code
     stdin -- optional "standard input" for the program
+    fresh -- execute the source even if an identical submission is cached
+    item_id -- the inbox item the source came from, used to resume its
+               submission if it was made before a restart
 
     >>> d = compile('print("Hello World")', 'python')
     >>> d['output']
     Hello World
 
     """
-    lang = LANG_SHORTCUTS.get(lang.lower(), lang)
-    # Login to ideone and create a submission
-    i = ideone.Ideone(I_USERNAME, I_PASSWORD)
-    sub = i.create_submission(source, language_name=lang, std_input=stdin)
-    sub_link = sub['link']
-    details = i.submission_details(sub_link)
-    # The status of the submission indicates whether or not the source has
-    # finished executing. A status of 0 indicates the submission is finished.
-    while details['status'] != 0:
-        details = i.submission_details(sub_link)
-        time.sleep(3)
-    details['link'] = sub_link
+    cache_key = ResultCache.key(lang, source, stdin)
+    if not fresh:
+        details = cached_details(cache_key)
+        if details is not None:
+            return details
+    details = backend_for(lang).execute(source, lang, stdin, item_id=item_id)
+    METRICS.count('results_total', code=details['result'])
+    cap_details(details)
+    cache_details(cache_key, details)
     return details
 
 def code_block(text):
@@ -160,73 +1986,262 @@ def code_block(text):
 
 def get_banned(reddit):
     """Retrive list of banned users list from the moderator subreddit"""
+    throttle('reddit_read')
     banned = {user.name.lower() for user in
                 reddit.get_subreddit(SUBREDDIT).get_banned()}
     return banned
 
-def send_modmail(subject, body, reddit):
+class BanList(object):
+
+    """The users banned from the moderator subreddit. The full ban list
+    is only fetched every refresh_interval seconds. In between, bans and
+    unbans are applied from the subreddit's moderation log. The list is
+    saved to a snapshot file so that the bot doesn't have to wait on a
+    full fetch after it restarts.
+    """
+
+    # Moderation log entries are applied again if they are this many
+    # seconds older than the last one seen, in case of clock skew.
+    # Applying a suffix of the log again in order leaves the list as is.
+    OVERLAP = 60
+
+    def __init__(self, path='', refresh_interval=86400, mod_log_limit=100,
+                 clock=time.time):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.mod_log_limit = mod_log_limit
+        self.clock = clock
+        self.users = set()
+        # The time of the last full fetch, or None if there hasn't been one.
+        self.fetched = None
+        self.last_action = 0
+        if path:
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+                self.users = set(snapshot['users'])
+                self.fetched = snapshot['fetched']
+                self.last_action = snapshot['last_action']
+            except (IOError, ValueError, KeyError):
+                pass
+
+    def update(self, reddit):
+        """Bring the ban list up to date and return the set of banned
+        usernames in lower case.
+        """
+        now = self.clock()
+        if (self.fetched is None or
+            now - self.fetched >= self.refresh_interval or
+            not self._apply_mod_log(reddit)):
+            self.users = get_banned(reddit)
+            self.fetched = self.last_action = now
+            log("Fetched {} banned users".format(len(self.users)))
+        self.save()
+        return self.users
+
+    def _apply_mod_log(self, reddit):
+        """Apply recent bans and unbans from the moderation log. Returns
+        false if the log doesn't reach back far enough to be sure that no
+        actions were missed.
+        """
+        since = self.last_action - self.OVERLAP
+        throttle('reddit_read')
+        actions = list(reddit.get_subreddit(SUBREDDIT).get_mod_log(
+            limit=self.mod_log_limit))
+        if (len(actions) >= self.mod_log_limit and
+            min(a.created_utc for a in actions) > since):
+            return False
+        actions = [a for a in actions if a.created_utc >= since and
+                   a.action in ('banuser', 'unbanuser')]
+        for action in sorted(actions, key=lambda a: a.created_utc):
+            if action.action == 'banuser':
+                self.users.add(action.target_author.lower())
+            else:
+                self.users.discard(action.target_author.lower())
+            self.last_action = max(self.last_action, action.created_utc)
+        return True
+
+    def save(self):
+        """Write the ban list to the snapshot file."""
+        if not self.path:
+            return
+        snapshot = {'users': sorted(self.users), 'fetched': self.fetched,
+                    'last_action': self.last_action}
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(snapshot, f)
+        os.rename(self.path + '.tmp', self.path)
+
+def send_modmail(subject, body, reddit=None):
     """Send a message to the bot moderators"""
     if SUBREDDIT:
+        reddit = reddit or SESSION.get()
         sub = reddit.get_subreddit(SUBREDDIT)
+        throttle('reddit_write')
         reddit.send_message(sub, subject, body)
     else:
         log("Mod message not sent. No subreddit found in settings.")
 
-def format_reply(details, opts):
+def _output_window(details, limit):
+    """Return up to limit characters of a program's output followed by
+    its runtime error output, and whether any of it was left out. Only
+    the characters that are returned are copied.
+    """
+    window = details['output'][:limit]
+    if len(window) < limit:
+        window += details['stderr'][:limit - len(window)]
+    length = field_length(details, 'output') + field_length(details, 'stderr')
+    return window, length > limit
+
+def _fit(parts, budget):
+    """Join the parts of a reply section, shortening it to fit within
+    budget characters.
+    """
+    section = ''.join(parts)
+    if len(section) > budget:
+        marker = '\n...\n'
+        section = section[:budget - len(marker)] + marker
+        if len(section) > budget:
+            section = ''
+    return section
+
+def format_reply(details, opts, footer=''):
     """Returns a reply that contains the output from a ideone submission's
-    details along with optional additional information.
+    details along with optional additional information, followed by the
+    footer. Only as much of the output as can appear in the reply is
+    read, however long it is.
     """
-    head, body, extra, = '', '', ''
-    # Combine information that will go before the output.
-    if '--source' in opts:
-        head += 'Source:\n{}\n\n'.format(code_block(details['source']))
-    if '--input' in opts:
-    # Combine program output and runtime error output.
-        head += 'Input:\n{}\n\n'.format(code_block(details['input']))
-    output = details['output'] + details['stderr']
-    # Truncate the output if it contains an excessive
-    # amount of line breaks or if it is too long.
-    if output.count('\n') > LINE_LIMIT:
-        lines = output.split('\n')
+    # Combine program output and runtime error output, truncated if it
+    # is too long or if it contains an excessive amount of line breaks.
+    # Line breaks are counted over the whole output, not just the part
+    # of it that fits in the reply.
+    output, cut = _output_window(details, OUTPUT_LIMIT)
+    if (field_lines(details, 'output') + field_lines(details, 'stderr') >
+            LINE_LIMIT):
+        lines = output.split('\n', LINE_LIMIT + 1)
         # If message contains an excessive amount of duplicate lines,
         # truncate to a small amount of lines to discourage spamming
-        if len(set(lines)) < 5:
+        if len(set(lines[:-1])) < 5:
             lines_allowed = 2
         else:
             lines_allowed = 51
-        output = '\n'.join(lines[:lines_allowed])
-        output += "\n..."
-    # Truncate the output if it is too long.
-    if len(output) > 8000:
-        output = output[:8000] + '\n    ...\n'
-    body += 'Output:\n{}\n\n'.format(code_block(output))
+        output = '\n'.join(lines[:lines_allowed]) + "\n..."
+    elif cut:
+        output += '\n    ...\n'
+    body = ['Output:\n{}\n\n'.format(code_block(output))]
     if details['cmpinfo']:
-        body += 'Compiler Info:\n{}\n\n'.format(code_block(details['cmpinfo']))
+        body.append('Compiler Info:\n{}\n\n'.format(
+            code_block(details['cmpinfo'][:REPLY_LIMIT])))
+    # Combine information that will go before the output.
+    head = []
+    if '--source' in opts:
+        head.append('Source:\n{}\n\n'.format(
+            code_block(details['source'][:REPLY_LIMIT])))
+    if '--input' in opts:
+        head.append('Input:\n{}\n\n'.format(
+            code_block(details['input'][:REPLY_LIMIT])))
     # Combine extra runtime information.
+    extra = []
     if '--date' in opts:
-        extra += "Date: {}\n\n".format(details['date'])
+        extra.append("Date: {}\n\n".format(details['date']))
     if '--memory' in opts:
-        extra += "Memory Usage: {} bytes\n\n".format(details['memory'])
+        extra.append("Memory Usage: {} bytes\n\n".format(details['memory']))
     if '--time' in opts:
-        extra += "Execution Time: {} seconds\n\n".format(details['time'])
+        extra.append("Execution Time: {} seconds\n\n".format(details['time']))
     if '--version' in opts:
-        extra += "Version: {}\n\n".format(details['langVersion'])
-    # To ensure the reply is less than 10000 characters long, shorten
-    # sections of the reply until they are of adequate length. Certain
-    # sections with less priority will be shortened before others.
-    total_len = 0
-    for section in (FOOTER, body, head, extra):
-        if len(section) + total_len > 9800:
-            section = section[:9800 - total_len] + '\n...\n'
-            total_len += len(section)
-    reply_text = head + body + extra
-    return reply_text
+        extra.append("Version: {}\n\n".format(details['langVersion']))
+    # To ensure the reply isn't too long for reddit, shorten sections of
+    # the reply until they are of adequate length. Sections with less
+    # priority are shortened before others and the footer is kept whole.
+    budget = REPLY_LIMIT - len(footer)
+    body = _fit(body, budget)
+    budget -= len(body)
+    head = _fit(head, budget)
+    budget -= len(head)
+    extra = _fit(extra, budget)
+    return head + body + extra + footer
+
+def _code_start(body, start, end):
+    """Return the position of the first character of a code block whose
+    indentation lies within the whitespace between start and end, or -1
+    if there is no such position. Lines of a code block are indented by
+    four spaces or a tab. If several blank lines could begin the block,
+    the last one is used.
+    """
+    found = -1
+    line = start if start > 0 and body[start - 1] == '\n' else -1
+    while True:
+        if line != -1:
+            if body.startswith('    ', line) and line + 4 <= end:
+                found = line + 4
+            elif body.startswith('\t', line) and line + 1 <= end:
+                found = line + 1
+        newline = body.find('\n', max(line, start), end)
+        if newline == -1:
+            return found
+        line = newline + 1
+
+def _code_end(body, start, include_newline=False):
+    """Return the end of a code block that begins at start. The block
+    continues over indented and empty lines and ends after its last
+    indented line. The line break after the last line is only included
+    if requested and the block spans more than one line.
+    """
+    end = body.find('\n', start)
+    if end == -1:
+        return len(body)
+    block_end = end
+    while end != -1:
+        line = end + 1
+        next_end = body.find('\n', line)
+        line_end = len(body) if next_end == -1 else next_end
+        if body.startswith('    ', line) or body.startswith('\t', line):
+            block_end = line_end
+            if include_newline and next_end != -1:
+                block_end += 1
+        elif line_end != line:
+            break
+        end = next_end
+    return block_end
+
+def _skip_whitespace(body, start):
+    """Return the position of the first non whitespace character at or
+    after start.
+    """
+    m = NON_WHITESPACE.search(body, start)
+    return m.start() if m else len(body)
+
+def _parse_block(body, args_end):
+    """Parse the code block and optional input that follow the line
+    ending at args_end. Returns (src, stdin), or None if there is no
+    code block.
+    """
+    run_start = args_end + 1
+    src_start = _code_start(body, run_start,
+                            _skip_whitespace(body, run_start))
+    if src_start == -1:
+        return None
+    src_end = _code_end(body, src_start)
+    src, stdin = body[src_start:src_end], ''
+    # Search for an "Input:" or "Stdin:" label followed by another block.
+    label = _skip_whitespace(body, src_end)
+    if (src_end < len(body) and
+        body[label:label + 5].lower() in ('input', 'stdin')):
+        run_start = label + 5
+        if body.startswith(':', run_start):
+            run_start += 1
+        run_end = _skip_whitespace(body, run_start)
+        in_start = _code_start(body, run_start, run_end)
+        if in_start != -1:
+            in_end = _code_end(body, in_start, include_newline=True)
+            stdin = body[in_start:in_end]
+    return src, stdin
 
 def parse_comment(body):
     """Parse a string that contains a username mention and code block
-    and return the supplied arguments, source code and input.
+    and return the supplied arguments, source code and input. Raises an
+    AttributeError if no code block follows a mention.
 
-    c_pattern is a regular expression that searches for the following:
+    The comment is scanned for the following:
         1. "+/u/" + the reddit username that is using the program
             (case insensitive).
         2. A string representing the programming language and arguments
@@ -236,36 +2251,45 @@ def parse_comment(body):
         4. (Optional) "Input:" OR "Stdin:" + "\n".
         5. (Optional) A markdown code block that represents the
             program's input.
+
+    The scan makes a single pass over the lines following each mention,
+    so its running time is linear in the length of the comment.
     """
-    c_pattern = (
-        r'\+/u/(?i)%s\s*(?P<args>.*)\n\s*'
-        r'((?<=\n( {4}))|(?<=\n\t))'
-        r'(?P<src>.*(\n((( {4}|\t).*\n)|\n)*(( {4}|\t).*))?)'
-        r'(\n\s*((?i)Input|Stdin):?\s*\n\s*'
-        r'((?<=\n( {4}))|(?<=\n\t))'
-        r'(?P<in>.*(\n((( {4}|\t).*\n)|\n)*(( {4}|\t).*\n?))?))?'
-    ) % R_USERNAME
-    m = re.search(c_pattern, body)
-    args, src, stdin = m.group('args'), m.group('src'), m.group('in') or ''
+    for mention in MENTION_PATTERN.finditer(body):
+        block = None
+        args_start = _skip_whitespace(body, mention.end())
+        args_end = body.find('\n', args_start)
+        if args_end != -1:
+            block = _parse_block(body, args_end)
+            if block:
+                args = body[args_start:args_end]
+                break
+        # The arguments may be left blank, in which case the blank lines
+        # following the mention are tried, starting from the last one.
+        newline = body.rfind('\n', mention.end(), args_start)
+        while newline != -1:
+            block = _parse_block(body, newline)
+            if block:
+                args = ''
+                break
+            newline = body.rfind('\n', mention.end(), newline)
+        if block:
+            break
+    else:
+        raise AttributeError("No code block found in comment")
+    src, stdin = block
     # Remove the leading four spaces from every line.
     src = src.replace('\n    ', '\n')
     stdin = stdin.replace('\n    ', '\n')
     return args, src, stdin
 
-def create_reply(comment):
-    """Search comments for username mentions followed by code blocks
-    and return a formatted reply containing the output of the executed
-    block or a message with additional information.
+def parse_request(comment):
+    """Parse a comment that mentions the bot and return the requested
+    language, a list of options, the source code and the input. Raises an
+    AttributeError if the comment is not formatted correctly.
     """
-    try:
+    with METRICS.span('parse_comment'):
         args, src, stdin = parse_comment(comment.body)
-    except AttributeError:
-        preamble = ERROR_PREAMBLE.format(link=comment.permalink)
-        postamble = ERROR_POSTAMBLE.format(link=comment.permalink)
-        error_text = preamble + FORMAT_ERROR_TEXT + postamble
-        log("Formatting error on comment {c.permalink}:\n\n{c.body}".format(
-            c=comment))
-        return MessageReply(error_text)
     # Seperate the language name from the rest of the supplied options.
     try:
         lang, opts = args.split(' -', 1)
@@ -274,19 +2298,44 @@ def create_reply(comment):
         # No additional opts found
         lang, opts = args, []
     lang = lang.strip()
-    try:
-        details = compile(src, lang, stdin=stdin)
-        log("Compiled ideone submission {link} for comment {id}".format(
-            link=details['link'], id=comment.id))
-    except ideone.LanguageNotFoundError as e:
-        preamble = ERROR_PREAMBLE.format(link=comment.permalink)
-        postamble = ERROR_POSTAMBLE.format(link=comment.permalink)
-        choices = ', '.join(e.similar_languages)
-        error_text = LANG_ERROR_TEXT.format(lang=lang, choices=choices)
-        error_text = preamble + error_text + postamble
-        # TODO Add link to accepted languages to msg
-        log("Language error on comment {id}".format(id=comment.id))
-        return MessageReply(error_text)
+    return lang, opts, src, stdin
+
+def format_error_reply(comment):
+    """Return a message reply for a comment that could not be parsed."""
+    preamble = ERROR_PREAMBLE.format(link=comment.permalink)
+    postamble = ERROR_POSTAMBLE.format(link=comment.permalink)
+    error_text = preamble + FORMAT_ERROR_TEXT + postamble
+    log("Formatting error on comment {c.permalink}:\n\n{c.body}".format(
+        c=comment))
+    return MessageReply(error_text)
+
+def language_error_reply(comment, lang, error):
+    """Return a message reply for a comment that requested a language
+    ideone could not find.
+    """
+    preamble = ERROR_PREAMBLE.format(link=comment.permalink)
+    postamble = ERROR_POSTAMBLE.format(link=comment.permalink)
+    choices = ', '.join(error.similar_languages)
+    error_text = LANG_ERROR_TEXT.format(lang=lang, choices=choices)
+    error_text = preamble + error_text + postamble
+    # TODO Add link to accepted languages to msg
+    log("Language error on comment {id}".format(id=comment.id))
+    return MessageReply(error_text)
+
+def deadline_error_reply(comment):
+    """Return a message reply for a comment whose submission didn't
+    finish before the polling deadline.
+    """
+    preamble = ERROR_PREAMBLE.format(link=comment.permalink)
+    postamble = ERROR_POSTAMBLE.format(link=comment.permalink)
+    error_text = preamble + DEADLINE_ERROR_TEXT + postamble
+    log("Submission deadline exceeded on comment {id}".format(id=comment.id))
+    return MessageReply(error_text)
+
+def result_reply(comment, details, opts):
+    """Return a reply containing the output of a finished ideone
+    submission, or a message reply if the submission resulted in an error.
+    """
     # The ideone submission result value indicaties the final state of
     # the program. If the program compiled and ran successfully the
     # result is 15. Other codes indicate various errors.
@@ -294,10 +2343,18 @@ def create_reply(comment):
     # The user is alerted of any errors via message reply unless they
     # include an option to include errors in the reply.
     if result_code == 15 or '--include-errors' in opts:
-        text = format_reply(details, opts)
         ideone_link = "http://ideone.com/{}".format(details['link'])
+        if not details['link']:
+            # Source that was run locally has no ideone page, but the
+            # comment itself holds the source.
+            ideone_link = comment.permalink
         url_pl = urllib.quote(comment.permalink)
-        text += FOOTER.format(ide_link=ideone_link, perm_link=url_pl)
+        footer = FOOTER.format(ide_link=ideone_link, perm_link=url_pl)
+        with METRICS.span('format_reply'):
+            text = format_reply(details, opts, footer=footer)
+        # The footer links to the submission, which changes every time
+        # the same output is produced again.
+        digest = text_digest(text[:len(text) - len(footer)])
     else:
         log("Result error {code} detected in comment {id}".format(
             code=result_code, id=comment.id))
@@ -323,7 +2380,135 @@ def create_reply(comment):
                                 code_block(details['stderr']))
         error_text = preamble + error_text + postamble
         return MessageReply(error_text)
-    return CompiledReply(text, details)
+    return CompiledReply(text, details, digest=digest)
+
+def create_reply(comment):
+    """Search comments for username mentions followed by code blocks
+    and return a formatted reply containing the output of the executed
+    block or a message with additional information.
+    """
+    try:
+        lang, opts, src, stdin = parse_request(comment)
+    except AttributeError:
+        return format_error_reply(comment)
+    try:
+        # Unknown languages are rejected before anything is submitted.
+        backend_for(lang)
+        details = compile(src, lang, stdin=stdin, fresh='--fresh' in opts,
+                          item_id=comment.id)
+        log("Compiled ideone submission {link} for comment {id}".format(
+            link=details['link'], id=comment.id))
+    except ideone.LanguageNotFoundError as e:
+        return language_error_reply(comment, lang, e)
+    except SubmissionTimeout:
+        return deadline_error_reply(comment)
+    return result_reply(comment, details, opts)
+
+class SpamDetector(object):
+
+    """Scans the details of a submission for spam. The spam phrases and
+    the regular expression rules are combined into a single compiled
+    alternation, so the source and output are each scanned once however
+    many phrases there are. Every rule has a weight and scanning stops as
+    soon as the weights of the rules that fired reach the threshold.
+
+    Rules are given as dicts with a name, a pattern and optionally a
+    weight, which defaults to 1.
+    """
+
+    def __init__(self, phrases, rules=(), phrase_weight=1, threshold=1):
+        self.phrases = tuple(phrases)
+        self.threshold = threshold
+        self.names = {'phrase': "Spam phrase detected"}
+        self.weights = {'phrase': phrase_weight}
+        alternatives = []
+        if self.phrases:
+            # Longer phrases are tried first so that a phrase containing
+            # another one is reported whole.
+            phrases = sorted(set(self.phrases), key=len, reverse=True)
+            alternatives.append('(?P<phrase>{})'.format(
+                '|'.join(re.escape(p) for p in phrases)))
+        for i, rule in enumerate(rules):
+            group = 'rule{}'.format(i)
+            alternatives.append('(?P<{}>{})'.format(group, rule['pattern']))
+            self.names[group] = rule['name']
+            self.weights[group] = rule.get('weight', 1)
+        self.pattern = None
+        if alternatives:
+            self.pattern = re.compile('|'.join(alternatives),
+                                      re.IGNORECASE | re.UNICODE)
+
+    def scan(self, details):
+        """Return a list of (rule, field, offset) tuples for the rules
+        that fired on a submission, in the order they fired, or an empty
+        list if their weights don't reach the threshold. The field is the
+        part of the details the rule fired on and the offset is the
+        position in that field, or None for rules about the field as a
+        whole. Each rule is reported once.
+        """
+        fired = []
+        score = [0]
+
+        def fire(rule, weight, field, offset):
+            fired.append((rule, field, offset))
+            score[0] += weight
+            return score[0] >= self.threshold
+
+        # Cheap checks of the output as a whole come first. The output
+        # may have been capped, in which case its full length and number
+        # of line breaks were recorded.
+        output = details['output']
+        lines = details.get('output_lines')
+        if lines is None:
+            lines = output.count('\n')
+        if (field_length(details, 'output') > CHAR_LIMIT and
+            fire("Excessive character count", 1, 'output', CHAR_LIMIT)):
+            return fired
+        if (lines > LINE_LIMIT and
+            fire("Excessive line breaks", 1, 'output', None)):
+            return fired
+        if ("Permission denied" in details['stderr'] and
+            fire("Illegal system call detected", 1, 'stderr', None)):
+            return fired
+        if self.pattern is None:
+            return []
+        seen = set()
+        for field in ('source', 'output'):
+            for match in self.pattern.finditer(details[field]):
+                group = match.lastgroup
+                if group in seen:
+                    continue
+                seen.add(group)
+                if fire(self.names[group], self.weights[group], field,
+                        match.start()):
+                    return fired
+        return []
+
+def spam_detector():
+    """Return the spam detector, rebuilding it if the spam phrases have
+    changed.
+    """
+    global SPAM_DETECTOR
+    if SPAM_DETECTOR is None or SPAM_DETECTOR.phrases != tuple(SPAM_PHRASES):
+        SPAM_DETECTOR = SpamDetector(SPAM_PHRASES, SPAM_RULES,
+                                     phrase_weight=SPAM_PHRASE_WEIGHT,
+                                     threshold=SPAM_THRESHOLD)
+    return SPAM_DETECTOR
+
+def report_spam(reply, r):
+    """Notify the moderators if a compiled reply looks like spam."""
+    spam = reply.spam_matches()
+    if spam:
+        text = ("Potential spam detected on comment {c.permalink} "
+                "by {c.author}: ".format(c=reply.parent_comment))
+        text += ', '.join(
+            "{rule} in {field}".format(rule=rule, field=field)
+            if offset is None else
+            "{rule} in {field} at offset {offset}".format(
+                rule=rule, field=field, offset=offset)
+            for rule, field, offset in spam)
+        send_modmail("Potential spam detected", text, r)
+        log(text)
 
 def process_unread(new, r):
     """Parse a new comment or message for various options and ignore reply
@@ -334,16 +2519,16 @@ def process_unread(new, r):
     log("New {type} {id} from {sender}".format(
         type="mention" if new.was_comment else "message",
         id=new.id, sender=sender))
-    if sender.name.lower() in BANNED_USERS:
+    if sender and sender.lower() in BANNED_USERS:
         log("Ignoring banned user {user}".format(user=sender))
         return
     # Search for a user mention preceded by a '+' which is the signal
     # for CompileBot to create a reply for that comment.
-    if (new.was_comment and
-        re.search(r'(?i)\+/u/{}'.format(R_USERNAME), new.body)):
+    if new.was_comment and MENTION_PATTERN.search(new.body):
         reply = create_reply(new)
         if reply:
             reply.send(new)
+            JOURNAL.record(new.id, WorkJournal.REPLIED)
     elif ((not new.was_comment) and
           re.match(r'(i?)\s*--help', new.body)):
         # Message a user the help text if comment is a message
@@ -371,73 +2556,428 @@ def process_unread(new, r):
         try:
             id = m.group('id')
         except AttributeError:
-            new.reply(RECOMPILE_ERROR_TEXT)
+            throttle('reddit_write')
+            new.thing.reply(RECOMPILE_ERROR_TEXT)
+            return
+        # Fetch only the comment that will be recompiled, not its thread.
+        throttle('reddit_read')
+        original = r.get_info(thing_id='t1_' + id.rsplit('/', 1)[-1])
+        if original is None:
+            throttle('reddit_write')
+            new.thing.reply(RECOMPILE_ERROR_TEXT)
             return
-        # Fetch the comment that will be recompiled.
-        sub = r.get_submission(submission_id=id, comment_sort='best')
-        original = sub.comments[0]
+        original = Job.from_thing(original, was_comment=True)
         log("Processing request to recompile {id} from {user}"
             "".format(id=original.id, user=new.author))
         # Ensure the author of the original comment matches the author
         # requesting the recompile to prevent one user sending a recompile
         # request on the behalf of another.
-        if original.author == new.author:
+        if (original.author is not None and new.author is not None and
+            original.author.lower() == new.author.lower()):
             reply = create_reply(original)
             # Ensure the recompiled reply resulted in a valid comment
             # reply and not an error message reply.
             if isinstance(reply, CompiledReply):
-                # Search for an existing comment reply from the bot.
-                # If one is found, edit the existing comment instead
-                # of creating a new one.
-                #
-                # Note: the .replies property only returns a limited
-                # number of comments. If the reply is buried, it will
-                # not be retrieved and a new one will be created
-                for rp in original.replies:
-                    if rp.author.name.lower() == R_USERNAME.lower():
-                        footnote = ("\n\n**EDIT:** Recompile request "
-                                    "by {}".format(new.author))
-                        reply.text += footnote
-                        reply.make_edit(rp, original)
-                        break
-                else:
+                # If the bot has already replied, edit the existing
+                # comment instead of creating a new one.
+                rp, digest = existing_reply(r, original, id)
+                if rp is None:
                     # Reply to the original comment.
                     reply.send(original)
+                elif digest is not None and digest == reply.digest:
+                    log("Output of {id} is unchanged, not editing "
+                        "{reply}".format(id=original.id, reply=rp.id))
+                    # The output was already checked for spam.
+                    reply = None
+                else:
+                    footnote = ("\n\n**EDIT:** Recompile request "
+                                "by {}".format(new.author))
+                    reply.text += footnote
+                    reply.make_edit(rp, original)
             else:
                 # Send a message reply.
                 reply.send(new)
         else:
-            new.reply(RECOMPILE_AUTHOR_ERROR_TEXT)
+            throttle('reddit_write')
+            new.thing.reply(RECOMPILE_AUTHOR_ERROR_TEXT)
             log("Attempt to reompile on behalf of another author "
                 "detected. Request deined.")
     if reply and isinstance(reply, CompiledReply):
-        spam = reply.detect_spam()
-        if spam:
-            text = ("Potential spam detected on comment {c.permalink} "
-                    "by {c.author}: ".format(c=reply.parent_comment))
-            text += ', '.join(spam)
-            send_modmail("Potential spam detected", text, r)
-            log(text)
+        report_spam(reply, r)
 
-def main():
-    r = praw.Reddit(USER_AGENT)
-    r.login(R_USERNAME, R_PASSWORD)
-    if SUBREDDIT:
-        global BANNED_USERS
-        BANNED_USERS = get_banned(r)
-    # Iterate though each new comment/message in the inbox and
-    # process it appropriately.
-    inbox = r.get_unread()
-    for new in inbox:
-        try:
+def existing_reply(r, original, link):
+    """Return the bot's reply to a comment and the digest of the reply's
+    output, or (None, None) if the bot hasn't replied to it. Replies in
+    the reply index are fetched directly. Otherwise the comment's thread
+    is fetched and its replies are searched, which was the only way to
+    find replies sent before the index existed.
+    """
+    known = REPLIES.get(original.id)
+    if known:
+        reply_id, digest = known
+        throttle('reddit_read')
+        rp = r.get_info(thing_id='t1_' + reply_id)
+        # The reply may have been deleted since.
+        return (rp, digest) if rp is not None else (None, None)
+    # Note: the .replies property only returns a limited number of
+    # comments. If the reply is buried, it will not be retrieved and a
+    # new one will be created.
+    throttle('reddit_read')
+    sub = r.get_submission(submission_id=link, comment_sort='best')
+    for rp in sub.comments[0].replies:
+        if rp.author and rp.author.name.lower() == R_USERNAME.lower():
+            return rp, None
+    return None, None
+
+def finish(new, failed=False):
+    """Mark an inbox item as read once processing has finished. An item
+    that failed before it was replied to is left unread so that it is
+    retried on a later check of the inbox, up to the journal's limit.
+    """
+    if failed and JOURNAL.retry(new.id):
+        log("Leaving {id} unread to retry it".format(id=new.id))
+        return
+    throttle('reddit_write')
+    new.thing.mark_as_read()
+    JOURNAL.record(new.id, WorkJournal.READ)
+
+def park(new):
+    """Leave an inbox item unread while ideone is unavailable. The unread
+    items in the inbox act as the retry queue: parked items are fetched
+    again on every check of the inbox, and processed once the circuit
+    breaker lets submissions through again. They don't count as activity
+    when the daemon decides how soon to check the inbox again.
+    """
+    JOURNAL.parked(new.id)
+    METRICS.count('parked_total')
+    log("Parking {id} until ideone recovers".format(id=new.id))
+
+def handle_unread(new, r):
+    """Process the job of a single inbox item. Any errors are logged and
+    reported to the admin so that they don't interrupt the processing of
+    other items. Items that were already replied to before a restart are
+    only marked as read, and items that need ideone while it's
+    unavailable are parked.
+    """
+    failed = parked = False
+    try:
+        if JOURNAL.answered(new.id):
+            log("Already replied to {id}".format(id=new.id))
+        else:
+            JOURNAL.fetched(new.id)
             process_unread(new, r)
+            JOURNAL.record(new.id, WorkJournal.REPLIED)
+    except BackendUnavailable:
+        parked = True
+        park(new)
+    except:
+        failed = True
+        tb = traceback.format_exc()
+        # Notify admin of any errors
+        log("Error processing comment {c.id}\n"
+            "{traceback}".format(c=new, traceback=tb), alert=True)
+    finally:
+        if not parked:
+            finish(new, failed)
+
+def process_inbox(inbox, r, workers=1):
+    """Process each item of the inbox. If more than one worker is
+    requested, items are handed to a bounded pool of worker threads so
+    that a slow submission doesn't hold up the items queued behind it.
+    Returns once every item has been processed.
+    """
+    jobs = (Job.from_thing(new) for new in inbox)
+    if workers <= 1:
+        for new in jobs:
+            handle_unread(new, r)
+        return
+    # Bound the queue so that items are only fetched from the inbox as
+    # quickly as the workers can process them.
+    queue = Queue.Queue(maxsize=workers * 2)
+
+    def worker():
+        while True:
+            new = queue.get()
+            try:
+                if new is None:
+                    return
+                handle_unread(new, r)
+            except:
+                # Errors raised while marking an item as read must not
+                # kill the worker, otherwise the queue would stall.
+                log("Worker error on {id}\n{traceback}".format(
+                    id=new.id, traceback=traceback.format_exc()), alert=True)
+            finally:
+                queue.task_done()
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        for new in jobs:
+            queue.put(new)
+    finally:
+        # Signal each worker to stop once the queue has been drained.
+        for t in threads:
+            queue.put(None)
+        for t in threads:
+            t.join()
+
+class SubmissionPipeline(object):
+
+    """A two stage pipeline for processing mentions. The first stage
+    submits the source of every mention to ideone up front. The second
+    stage polls all of the outstanding submissions together and replies
+    to each comment as soon as its submission has finished, so that
+    ideone's execution time overlaps across requests.
+    """
+
+    def __init__(self, r, clients=None, sleep=time.sleep, clock=time.time):
+        self.r = r
+        self.clients = clients or CLIENTS
+        self.sleep = sleep
+        self.clock = clock
+        # Submissions that haven't finished executing, stored as
+        # (link, comment, opts, schedule, cache_key) tuples.
+        self.pending = []
+
+    def accepts(self, new):
+        """Return true if an inbox item is a mention that should be
+        processed by the pipeline.
+        """
+        return bool(new.was_comment and MENTION_PATTERN.search(new.body))
+
+    def add(self, new):
+        """Submit the source code of a mention to ideone. Mentions that
+        can be answered without waiting on a submission are replied to
+        and marked as read immediately.
+        """
+        waiting = failed = parked = False
+        try:
+            if JOURNAL.answered(new.id):
+                log("Already replied to {id}".format(id=new.id))
+            else:
+                JOURNAL.fetched(new.id)
+                waiting = self._submit(new)
+        except BackendUnavailable:
+            parked = True
+            park(new)
         except:
+            failed = True
             tb = traceback.format_exc()
-            # Notify admin of any errors
             log("Error processing comment {c.id}\n"
                 "{traceback}".format(c=new, traceback=tb), alert=True)
         finally:
-            new.mark_as_read()
+            if not waiting and not parked:
+                finish(new, failed)
+
+    def _submit(self, new):
+        log("New mention {id} from {sender}".format(id=new.id,
+                                                    sender=new.author))
+        if new.author and new.author.lower() in BANNED_USERS:
+            log("Ignoring banned user {user}".format(user=new.author))
+            return False
+        try:
+            lang, opts, src, stdin = parse_request(new)
+        except AttributeError:
+            format_error_reply(new).send(new)
+            JOURNAL.record(new.id, WorkJournal.REPLIED)
+            return False
+        try:
+            backend = backend_for(lang)
+        except ideone.LanguageNotFoundError as e:
+            language_error_reply(new, lang, e).send(new)
+            JOURNAL.record(new.id, WorkJournal.REPLIED)
+            return False
+        if backend is not IDEONE:
+            # Other backends finish executing the source before they
+            # return, so there's nothing to wait on.
+            details = compile(src, lang, stdin, fresh='--fresh' in opts,
+                              item_id=new.id)
+            self._reply(new, details, opts)
+            return False
+        cache_key = ResultCache.key(lang, src, stdin)
+        if '--fresh' not in opts:
+            details = cached_details(cache_key)
+            if details is not None:
+                self._reply(new, details, opts)
+                return False
+        if not BREAKER.allow():
+            raise BackendUnavailable()
+        link = JOURNAL.link(new.id)
+        if link:
+            log("Resuming ideone submission {link} for {id}".format(
+                link=link, id=new.id))
+        else:
+            try:
+                with BREAKER.guard(), self.clients.client() as client:
+                    link = submit(src, lang, stdin, client=client)
+            except ideone.LanguageNotFoundError as e:
+                language_error_reply(new, lang, e).send(new)
+                JOURNAL.record(new.id, WorkJournal.REPLIED)
+                return False
+            JOURNAL.submitted(new.id, link)
+        schedule = PollSchedule(resolve_language(lang), self.clock())
+        self.pending.append((link, new, opts, schedule, cache_key))
+        return True
+
+    def _reply(self, new, details, opts):
+        reply = result_reply(new, details, opts)
+        reply.send(new)
+        JOURNAL.record(new.id, WorkJournal.REPLIED)
+        if isinstance(reply, CompiledReply):
+            report_spam(reply, self.r)
+
+    def collect(self):
+        """Poll the outstanding submissions until every one of them has
+        finished, sending each reply as soon as its submission is done.
+        """
+        while self.pending:
+            still_pending = []
+            for job in self.pending:
+                link, new, opts, schedule, cache_key = job
+                if schedule.due > self.clock():
+                    still_pending.append(job)
+                    continue
+                done = True
+                failed = False
+                try:
+                    if BREAKER.opened():
+                        raise BackendUnavailable()
+                    with BREAKER.guard(), \
+                         self.clients.client(link) as client, \
+                         METRICS.span('poll'):
+                        throttle('ideone_poll')
+                        details = client.submission_details(link)
+                    if details['status'] != 0:
+                        schedule.advance(self.clock())
+                        done = False
+                        still_pending.append(job)
+                        continue
+                    record_result(details, new.id)
+                    record_runtime(schedule.lang, details)
+                    METRICS.count('results_total', code=details['result'])
+                    details['link'] = link
+                    cap_details(details)
+                    cache_details(cache_key, details)
+                    log("Compiled ideone submission {link} for comment "
+                        "{id}".format(link=link, id=new.id))
+                    self._reply(new, details, opts)
+                except SubmissionTimeout:
+                    BREAKER.failure()
+                    deadline_error_reply(new).send(new)
+                    JOURNAL.record(new.id, WorkJournal.REPLIED)
+                except BackendUnavailable:
+                    done = False
+                    park(new)
+                except:
+                    failed = True
+                    tb = traceback.format_exc()
+                    log("Error processing comment {c.id}\n"
+                        "{traceback}".format(c=new, traceback=tb), alert=True)
+                finally:
+                    if done:
+                        finish(new, failed)
+            self.pending = still_pending
+            if self.pending:
+                # Sleep until the next submission is due to be checked.
+                due = min(job[3].due for job in self.pending)
+                self.sleep(max(due - self.clock(), 0))
+
+def process_pipelined(inbox, r, client=None, sleep=time.sleep,
+                      clock=time.time):
+    """Process the inbox by submitting every mention before waiting on
+    any of them. Other inbox items are processed as they are fetched.
+    """
+    clients = ClientPool(1, factory=lambda: client) if client else None
+    pipeline = SubmissionPipeline(r, clients=clients, sleep=sleep,
+                                  clock=clock)
+    for new in (Job.from_thing(new) for new in inbox):
+        if pipeline.accepts(new):
+            pipeline.add(new)
+        else:
+            handle_unread(new, r)
+    pipeline.collect()
+
+def check_inbox(r, stop=None):
+    """Process every unread comment and message in the inbox and return
+    the number of items processed, not counting items that were parked
+    while ideone is unavailable. If a stop event is given and it is set,
+    no new items are taken from the inbox but the items that are already
+    being processed are finished.
+    """
+    if SUBREDDIT:
+        global BANNED_USERS
+        BANNED_USERS = BAN_LIST.update(r)
+    refresh_languages()
+    taken = []
+
+    def take(inbox):
+        for new in inbox:
+            if stop is not None and stop.is_set():
+                break
+            taken.append(new.id)
+            yield new
+
+    # Send any replies that were held back by the rate limit.
+    SEND_QUEUE.flush(r)
+    JOURNAL.prune()
+    # Iterate though each new comment/message in the inbox and
+    # process it appropriately. Parked items stay unread, so the whole
+    # inbox is fetched rather than a single page, which they could fill.
+    throttle('reddit_read')
+    inbox = take(r.get_unread(limit=None))
+    try:
+        if PIPELINE:
+            process_pipelined(inbox, r)
+        else:
+            process_inbox(inbox, r, workers=WORKERS)
+    finally:
+        flush_logs()
+        write_metrics()
+    return sum(1 for item_id in taken if not JOURNAL.was_parked(item_id))
+
+def share_rate_limits(shares):
+    """Pace outbound calls at an even share of the configured rate limits,
+    for one of several processes that use the same accounts.
+    """
+    global RATE_LIMITER
+    RATE_LIMITER = RateLimiter({
+        endpoint: {'rate': limit['rate'] / float(shares),
+                   'burst': max(limit.get('burst', 1) // shares, 1)}
+        for endpoint, limit in RATE_LIMITS.items()})
+
+def worker_path(path, index):
+    """Return the name of a worker's own copy of a file."""
+    return '{0}-{2}{1}'.format(*(os.path.splitext(path) + (index,)))
+
+def init_worker(workers, index=0):
+    """Prepare the bot to run in one of several forked worker processes.
+    The sqlite stores are reopened and the worker logs in to reddit with
+    its own session, since connections inherited from the parent process
+    must not be used. The rate limits are split evenly between the
+    workers and the supervisor, which also reads the inbox and sends
+    deferred replies. Each worker writes its own log and metrics files,
+    since a log file can only be rotated by the process writing it.
+    Every Prometheus series a worker writes is labelled with its index,
+    as the textfile collector rejects the same series in several files.
+    """
+    global ALERTS, METRICS, METRICS_FILE, PROMETHEUS_FILE, LOG_FILE
+    for store in (SEND_QUEUE, RESULT_CACHE, JOURNAL, REPLIES):
+        if store is not None:
+            store.reopen()
+    SESSION.expire()
+    # The alert thread isn't running in the forked process.
+    ALERTS = AlertSender(ALERTS.recipient, window=ALERTS.window)
+    share_rate_limits(workers + 1)
+    METRICS = Metrics(labels={'worker': index})
+    METRICS_FILE, PROMETHEUS_FILE, LOG_FILE = [
+        worker_path(path, index) if path else path
+        for path in (METRICS_FILE, PROMETHEUS_FILE, LOG_FILE)]
+
+def main():
+    check_inbox(SESSION.get())
 
 # Settings
 SETTINGS_FILE = 'settings.json'
@@ -456,10 +2996,97 @@ R_PASSWORD = SETTINGS['reddit_pass']
 USER_AGENT = SETTINGS['user_agent']
 ADMIN = SETTINGS['admin_user']
 SUBREDDIT = SETTINGS['subreddit']
+# Counters and timings, written to a JSON snapshot and a Prometheus text
+# file after each check of the inbox.
+METRICS = Metrics()
+METRICS_SETTINGS = SETTINGS.get('metrics', {})
+METRICS_FILE = METRICS_SETTINGS.get('file', '')
+PROMETHEUS_FILE = METRICS_SETTINGS.get('prometheus_file', '')
+# Outbound calls are paced by the limits set for each class of endpoint.
+RATE_LIMITS = SETTINGS.get('rate_limits', {})
+RATE_LIMITER = RateLimiter(RATE_LIMITS)
+SESSION = Session(max_age=SETTINGS.get('session_max_age', 86400))
+# Replies held back by reddit's rate limit.
+OUTBOX = SETTINGS.get('send_queue', {})
+SEND_QUEUE = SendQueue(OUTBOX.get('file', ':memory:'),
+                       max_attempts=OUTBOX.get('max_attempts', 5))
+# Progress of each inbox item, kept so that a restart resumes it.
+WORK = SETTINGS.get('journal', {})
+JOURNAL = WorkJournal(WORK.get('file', ':memory:'),
+                      max_attempts=WORK.get('max_attempts', 3),
+                      retention=WORK.get('retention', 604800))
+# The bot's reply to each comment, kept so that recompiles can edit it.
+REPLY_INDEX = SETTINGS.get('reply_index', {})
+REPLIES = ReplyIndex(REPLY_INDEX.get('file', ':memory:'))
+# Log file rotation and buffering, and batching of admin alerts.
+LOGGING = SETTINGS.get('logging', {})
+LOG_MAX_BYTES = LOGGING.get('max_bytes', 0)
+LOG_BACKUPS = LOGGING.get('backups', 3)
+LOG_FLUSH_INTERVAL = LOGGING.get('flush_interval', 1)
+LOG = None
+LOG_LOCK = threading.Lock()
+ALERTS = AlertSender(ADMIN, window=LOGGING.get('alert_window', 5))
+atexit.register(flush_logs)
+# A user mention preceded by a '+' which signals a request to CompileBot.
+MENTION_PATTERN = re.compile(r'\+/u/' + re.escape(R_USERNAME), re.IGNORECASE)
+NON_WHITESPACE = re.compile(r'\S')
 LANG_SHORTCUTS = {k.lower(): v for k, v in SETTINGS['lang_shortcuts'].items()}
+LANGUAGE_INDEX = SETTINGS.get('languages', {})
+LANGUAGES = LanguageIndex(LANGUAGE_INDEX.get('file', ''),
+                          refresh_interval=LANGUAGE_INDEX.get(
+                              'refresh_interval', 86400))
+# The number of inbox items that may be processed concurrently.
+WORKERS = SETTINGS.get('workers', 1)
+# Submit every mention up front and collect the results together.
+PIPELINE = SETTINGS.get('pipeline', False)
+# Long lived ideone clients shared by every worker.
+IDEONE_CLIENTS = SETTINGS.get('ideone_clients', {})
+CLIENT_MAX_IDLE = IDEONE_CLIENTS.get('max_idle', 240)
+# Requests are spread across every ideone account, each with its own
+# pool of clients.
+IDEONE_ACCOUNTS = SETTINGS.get('ideone_accounts') or [
+    {'user': I_USERNAME, 'pass': I_PASSWORD}]
+ROUTING = SETTINGS.get('ideone_routing', {})
+CLIENTS = AccountRouter(
+    [(account['user'], ClientPool(IDEONE_CLIENTS.get('size', WORKERS),
+                                  factory=functools.partial(
+                                      ideone.Ideone, account['user'],
+                                      account['pass'])))
+     for account in IDEONE_ACCOUNTS],
+    eject_after=ROUTING.get('eject_after', 3),
+    max_error_rate=ROUTING.get('max_error_rate', 0.5),
+    eject_time=ROUTING.get('eject_time', 60),
+    max_eject_time=ROUTING.get('max_eject_time', 900))
+# Submissions stop while ideone as a whole is failing. Times are in
+# seconds.
+BREAKER_SETTINGS = SETTINGS.get('circuit_breaker', {})
+BREAKER = CircuitBreaker(
+    threshold=BREAKER_SETTINGS.get('threshold', 5),
+    reset_timeout=BREAKER_SETTINGS.get('reset_timeout', 60),
+    slow_call=BREAKER_SETTINGS.get('slow_call', 30))
+# Submission polling. Delays are in seconds.
+POLLING = SETTINGS.get('polling', {})
+POLL_INITIAL = POLLING.get('initial', 0.5)
+POLL_FACTOR = POLLING.get('factor', 2)
+POLL_MAX = POLLING.get('max', 8)
+POLL_JITTER = POLLING.get('jitter', 0.2)
+POLL_DEADLINE = POLLING.get('deadline', 120)
+# Results of finished submissions keyed by language, source and input.
+CACHE = SETTINGS.get('cache', {})
+RESULT_CACHE = None
+if CACHE.get('file'):
+    RESULT_CACHE = ResultCache(CACHE['file'], CACHE.get('ttl', 86400),
+                               CACHE.get('max_entries', 1000))
+# Estimated execution times of each language learned from past submissions.
+RUNTIME_ESTIMATES = {}
+RUNTIME_LOCK = threading.Lock()
 # A set of users that are banned. The banned users list is retrieved
 # in the main session but not here because it requires a reddit login.
 BANNED_USERS = set()
+BANS = SETTINGS.get('bans', {})
+BAN_LIST = BanList(BANS.get('file', ''),
+                   refresh_interval=BANS.get('refresh_interval', 86400),
+                   mod_log_limit=BANS.get('mod_log_limit', 100))
 # Text
 TEXT = SETTINGS['text']
 FOOTER = TEXT['footer']
@@ -474,12 +3101,44 @@ TIMEOUT_ERROR_TEXT = TEXT['timeout_error_text']
 MEMORY_ERROR_TEXT = TEXT['memory_error_text']
 ILLEGAL_ERROR_TEXT = TEXT['illegal_error_text']
 INTERNAL_ERROR_TEXT =  TEXT['internal_error_text']
+DEADLINE_ERROR_TEXT = TEXT.get('deadline_error_text', TIMEOUT_ERROR_TEXT)
 RECOMPILE_ERROR_TEXT = TEXT['recompile_error_text']
 RECOMPILE_AUTHOR_ERROR_TEXT = TEXT['recompile_author_error_text']
+# The longest reply that is built, leaving room below reddit's limit of
+# 10000 characters for a recompile footnote, and the most program output
+# that is shown in a reply.
+REPLY_LIMIT = 9800
+OUTPUT_LIMIT = 8000
+# The most output of each kind that is kept from a finished submission.
+OUTPUT_CAP = max(SETTINGS.get('output_cap', 65536), OUTPUT_LIMIT)
+# Source code is executed locally for the languages the local runner is
+# configured with, and on ideone otherwise.
+LOCAL = SETTINGS.get('local_runner', {})
+LOCAL_RUNNER = None
+if LOCAL.get('enabled'):
+    LOCAL_RUNNER = LocalRunner(
+        LOCAL.get('languages', {}), time_limit=LOCAL.get('time_limit', 5),
+        wall_limit=LOCAL.get('wall_limit'),
+        compile_time_limit=LOCAL.get('compile_time_limit', 10),
+        memory_limit=LOCAL.get('memory_limit', 256 * 1024 * 1024),
+        compile_memory_limit=LOCAL.get('compile_memory_limit',
+                                       1024 * 1024 * 1024),
+        output_limit=OUTPUT_CAP,
+        file_limit=LOCAL.get('file_limit', 64 * 1024 * 1024),
+        max_processes=LOCAL.get('max_processes', 16),
+        user=LOCAL.get('user'), jail=LOCAL.get('jail'))
+IDEONE = IdeoneBackend()
+BACKENDS = [backend for backend in (LOCAL_RUNNER, IDEONE) if backend]
 # Spam Settings
 LINE_LIMIT = SETTINGS["spam"]["line_limit"]
 CHAR_LIMIT = SETTINGS["spam"]["char_limit"]
 SPAM_PHRASES = SETTINGS["spam"]["spam_phrases"]
+# Regular expression rules, and the weights that decide when enough
+# rules have fired for a reply to be reported.
+SPAM_RULES = SETTINGS["spam"].get("rules", [])
+SPAM_PHRASE_WEIGHT = SETTINGS["spam"].get("phrase_weight", 1)
+SPAM_THRESHOLD = SETTINGS["spam"].get("threshold", 1)
+SPAM_DETECTOR = None
 
 if __name__ == "__main__":
     main()
@@ -1,31 +1,231 @@
-import time
+import signal
+import threading
 import traceback
-from requests import HTTPError
+import multiprocessing
+from requests import HTTPError, ConnectionError, Timeout
 import compilebot as bot
 
-SLEEP_TIME = 60
+DAEMON = bot.SETTINGS.get('daemon', {})
+# Seconds to wait between inbox checks while there is traffic, and the
+# longest wait once the inbox has been idle for a while.
+MIN_SLEEP_TIME = DAEMON.get('min_sleep', 5)
+SLEEP_TIME = DAEMON.get('max_sleep', 60)
+# The longest wait after repeated errors.
+MAX_BACKOFF = DAEMON.get('max_backoff', 900)
+# The number of worker processes. A single process handles everything
+# itself.
+PROCESSES = DAEMON.get('processes', 1)
+
+def idle_sleep_time(sleep_time, processed):
+    """Return the time to wait before the next inbox check. Checks are
+    frequent while mentions are arriving and slow down while the inbox
+    is idle.
+    """
+    if processed:
+        return MIN_SLEEP_TIME
+    return min(sleep_time * 2, SLEEP_TIME)
+
+def error_sleep_time(error, errors):
+    """Return the time to wait after the given number of consecutive
+    errors, the latest of which was error.
+    """
+    if isinstance(error, HTTPError):
+        # HTTP Errors may indicate reddit is overloaded.
+        base = SLEEP_TIME * 2
+    elif isinstance(error, (ConnectionError, Timeout)):
+        # Network problems are often short lived.
+        base = MIN_SLEEP_TIME
+    else:
+        base = SLEEP_TIME
+    return min(base * 2 ** (errors - 1), MAX_BACKOFF)
+
+def shard(item_id, shards):
+    """Return the shard of an inbox item, based on its base 36 id."""
+    return int(item_id, 36) % shards
+
+def get_item(r, fullname, was_comment):
+    """Fetch an inbox item by its fullname."""
+    kind, item_id = fullname.split('_', 1)
+    bot.throttle('reddit_read')
+    if kind == 't4':
+        new = r.get_message(item_id)
+    else:
+        new = r.get_info(thing_id=fullname)
+    new.was_comment = was_comment
+    return new
+
+def run_worker(index, workers, queue):
+    """Process the inbox items handed to a worker until it's told to stop.
+    Items are sent as (fullname, was_comment) tuples and None signals the
+    end of the queue.
+    """
+    # The supervisor decides when to stop, and the worker finishes the
+    # items that have already been handed to it first.
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    bot.init_worker(workers, index)
+    try:
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            fullname, was_comment = item
+            # The supervisor fetches the language list, and the worker
+            # picks it up from the snapshot file.
+            if bot.LANGUAGES.stale():
+                bot.LANGUAGES.load()
+            try:
+                r = bot.SESSION.get()
+                new = bot.Job.from_thing(get_item(r, fullname, was_comment))
+                bot.handle_unread(new, r)
+            except Exception as e:
+                bot.log("Worker {index} error on {item}: {error}".format(
+                        index=index, item=fullname, error=e), alert=True)
+            finally:
+                bot.JOURNAL.unclaim(fullname.split('_', 1)[1])
+                bot.flush_logs()
+                bot.write_metrics()
+    finally:
+        bot.flush_logs()
+
+class Supervisor(object):
+
+    """Runs the bot across several worker processes. The supervisor
+    fetches the inbox and hands each item to the worker for its shard.
+    Items are claimed in the shared work journal before they are handed
+    out, so an item that is fetched again while it's still being
+    processed isn't processed twice. Workers that exit are restarted.
+    """
+
+    def __init__(self, workers):
+        self.queues = [multiprocessing.Queue() for _ in range(workers)]
+        self.processes = [None] * workers
+
+    def start(self):
+        # Claims left by a previous run are no longer held by anyone.
+        bot.JOURNAL.release()
+        # The supervisor's own calls to reddit count against the same
+        # limits as the workers'.
+        bot.share_rate_limits(len(self.processes) + 1)
+        for index in range(len(self.processes)):
+            self._start(index)
+
+    def _start(self, index):
+        # Buffered log messages would otherwise be written by both
+        # processes.
+        bot.flush_logs()
+        process = multiprocessing.Process(
+            target=run_worker,
+            args=(index, len(self.processes), self.queues[index]))
+        process.daemon = True
+        process.start()
+        self.processes[index] = process
+
+    def restart_exited(self):
+        """Restart any worker that has exited."""
+        for index, process in enumerate(self.processes):
+            if not process.is_alive():
+                bot.log("Worker {index} exited with code {code}, "
+                        "restarting".format(index=index,
+                                            code=process.exitcode),
+                        alert=True)
+                # The items the worker held will be fetched again.
+                bot.JOURNAL.release(index)
+                self._start(index)
+
+    def check_inbox(self, r, stop=None):
+        """Hand every unread item in the inbox to a worker and return the
+        number of items handed out, not counting items that are waiting
+        for ideone to recover.
+        """
+        self.restart_exited()
+        if bot.SUBREDDIT:
+            bot.BANNED_USERS = bot.BAN_LIST.update(r)
+        bot.refresh_languages()
+        bot.SEND_QUEUE.flush(r)
+        bot.JOURNAL.prune()
+        dispatched = 0
+        bot.throttle('reddit_read')
+        # Parked items stay unread, so the whole inbox is fetched rather
+        # than a single page, which they could fill.
+        for new in r.get_unread(limit=None):
+            if stop is not None and stop.is_set():
+                break
+            index = shard(new.id, len(self.processes))
+            if not bot.JOURNAL.claim(new.id, index):
+                continue
+            if new.author and new.author.name.lower() in bot.BANNED_USERS:
+                bot.log("Ignoring banned user {user}".format(user=new.author))
+                bot.finish(bot.Job.from_thing(new))
+                bot.JOURNAL.unclaim(new.id)
+                continue
+            self.queues[index].put((new.fullname, new.was_comment))
+            if not bot.JOURNAL.was_parked(new.id):
+                dispatched += 1
+        bot.flush_logs()
+        bot.write_metrics()
+        return dispatched
+
+    def stop(self):
+        """Wait for the workers to finish the items they were handed."""
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join()
 
 def main():
+    # Stop taking new items from the inbox on SIGTERM. Items that are
+    # already being processed are finished before shutting down.
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    supervisor = None
+    check_inbox = bot.check_inbox
     try:
         bot.log("Initializing bot")
-        while True:
+        if PROCESSES > 1:
+            if bot.JOURNAL.path == ':memory:':
+                bot.log("Worker processes need a journal file to share, "
+                        "running in a single process")
+            else:
+                supervisor = Supervisor(PROCESSES)
+                supervisor.start()
+                check_inbox = supervisor.check_inbox
+        sleep_time = MIN_SLEEP_TIME
+        errors = 0
+        while not stop.is_set():
             try:
-                bot.main()
-            except HTTPError as e:
-                # HTTP Errors may indicate reddit is overloaded.
-                # Sleep for some extra time. 
-                bot.log(str(e) + " ")
-                time.sleep(SLEEP_TIME*2)
+                # The session is only logged in again once it expires.
+                processed = check_inbox(bot.SESSION.get(), stop=stop)
+                errors = 0
+                sleep_time = idle_sleep_time(sleep_time, processed)
             except Exception as e:
-                bot.log("Error running bot.main: {error}".format(
-                        error=e), alert=True)
-            time.sleep(SLEEP_TIME)
+                errors += 1
+                sleep_time = error_sleep_time(e, errors)
+                response = getattr(e, 'response', None)
+                if isinstance(e, HTTPError):
+                    bot.log(str(e) + " ")
+                    if response is not None and response.status_code in (
+                            401, 403):
+                        # The session has been rejected, log in again.
+                        bot.SESSION.expire()
+                elif isinstance(e, (ConnectionError, Timeout)):
+                    bot.log("Connection error: {error}".format(error=e))
+                else:
+                    bot.log("Error checking inbox: {error}".format(
+                            error=e), alert=True)
+            # Wake up early if the bot is asked to shut down.
+            stop.wait(sleep_time)
+        bot.log("Bot shutting down")
     except KeyboardInterrupt:
         exit_msg = ''
     except Exception as e:
         tb = traceback.format_exc()
         exit_msg = "Depoyment error: {traceback}\n".format(traceback=tb)
         bot.log("{msg}Bot shutting down".format(msg=exit_msg), alert=True)
-        
+    finally:
+        if supervisor is not None:
+            supervisor.stop()
+        bot.flush_logs()
+
 if __name__ == "__main__":
     main()
@@ -1 +1,2 @@
-__all__ = ['test_reply', 'test_compiler']
+__all__ = ['test_reply', 'test_compiler', 'test_submission',
+           'test_log']
@@ -0,0 +1,75 @@
+from __future__ import unicode_literals, print_function
+import timeit
+import compilebot as cb
+
+"""
+Benchmarks for compilebot functions that sit on the hot path of every
+request. None of the benchmarks make requests to reddit or ideone.
+
+Run the following command from the parent directory in order to run all
+of the benchmarks: python -m tests.benchmark
+"""
+
+def report(name, size, seconds):
+    print("{:<28}{:>12}{:>14.6f}s".format(name, size, seconds))
+
+def synthetic_comment(lines):
+    """Create a comment with a code block of the given number of lines,
+    mixing indented and blank lines, followed by an input block.
+    """
+    code = ''.join("    print({})\n\n".format(i) for i in range(lines))
+    return ("Some text before the mention +/u/{user} python --time\n\n"
+            "{code}Input:\n\n    1\n    2\n\nText after the code block."
+            "".format(user=cb.R_USERNAME, code=code))
+
+def bench_parse_comment(repeat=5):
+    for lines in (10, 100, 1000, 10000, 100000):
+        body = synthetic_comment(lines)
+        seconds = min(timeit.repeat(lambda: cb.parse_comment(body),
+                                    number=1, repeat=repeat))
+        report("parse_comment", len(body), seconds)
+    # A mention followed by a long run of whitespace.
+    for lines in (1000, 10000, 100000):
+        body = "+/u/{}\n".format(cb.R_USERNAME) + "    \n \n\t\n" * lines
+        def parse():
+            try:
+                cb.parse_comment(body)
+            except AttributeError:
+                pass
+        seconds = min(timeit.repeat(parse, number=1, repeat=repeat))
+        report("parse_comment (blank)", len(body), seconds)
+
+def bench_detect_spam(repeat=5):
+    # Many phrases and an output just under the character limit, none of
+    # which is spam so that every rule has to be checked.
+    phrases = ["phrase {}".format(i) for i in range(1000)]
+    detector = cb.SpamDetector(phrases)
+    for size in (100, 1000, cb.CHAR_LIMIT - 1):
+        details = {'source': "print('x' * {})".format(size),
+                   'output': 'x' * size, 'stderr': ''}
+        seconds = min(timeit.repeat(lambda: detector.scan(details),
+                                    number=1, repeat=repeat))
+        report("detect_spam", size, seconds)
+
+def bench_format_reply(repeat=5):
+    # Programs that flood stdout, with and without line breaks.
+    opts = ['--source', '--input', '--time']
+    for megabytes in (1, 4, 16):
+        size = megabytes * 1024 * 1024
+        for name, output in (("format_reply", 'x' * size),
+                             ("format_reply (lines)", "line\n" * (size // 5))):
+            details = {'output': output, 'stderr': '', 'cmpinfo': '',
+                       'source': "print('x')", 'input': '', 'time': 0.1}
+            seconds = min(timeit.repeat(
+                lambda: cb.format_reply(details, opts, footer=cb.FOOTER),
+                number=1, repeat=repeat))
+            report(name, size, seconds)
+
+def main():
+    print("{:<28}{:>12}{:>15}".format("benchmark", "size", "time"))
+    bench_parse_comment()
+    bench_detect_spam()
+    bench_format_reply()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+from __future__ import unicode_literals, print_function
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+import compilebot as cb
+
+"""
+Replays a corpus of inbox items through compilebot end to end and reports
+throughput, latency and peak memory. Reddit and ideone are replaced with
+fakes, so the replay runs completely offline. The fake ideone finishes
+each submission after a configurable latency.
+
+A corpus is a JSON list of items, each with a type of "mention",
+"recompile", "help" or "report", and optionally the language and source
+code of a mention. Without a corpus, a synthetic one is generated.
+
+Run the following command from the parent directory in order to replay
+a synthetic corpus: python -m tests.replay --help
+"""
+
+SOURCES = [
+    ('python', 'print("Hello World")'),
+    ('python 3 --time', 'for i in range(10):\n    print(i)'),
+    ('c', '#include <stdio.h>\nint main() {\n    puts("Hi");\n}'),
+    ('java', 'class Main {\n    public static void main(String[] a) {'
+             '\n        System.out.println(1);\n    }\n}'),
+    ('ruby --source', 'puts [1, 2, 3].map { |x| x * 2 }'),
+]
+
+def synthetic_corpus(size, seed=0):
+    """Create a corpus that is mostly mentions, with some recompile
+    requests, help requests and reports mixed in.
+    """
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(size):
+        roll = rng.random()
+        if roll < 0.8:
+            lang, source = rng.choice(SOURCES)
+            # Make half of the mentions unique so that not every one of
+            # them can be answered from the result cache.
+            if rng.random() < 0.5:
+                source += '\n' * (i % 7) + ' ' * i
+            corpus.append({'type': 'mention', 'lang': lang,
+                           'source': source})
+        elif roll < 0.9:
+            corpus.append({'type': 'recompile'})
+        elif roll < 0.95:
+            corpus.append({'type': 'help'})
+        else:
+            corpus.append({'type': 'report'})
+    return corpus
+
+def percentile(values, p):
+    """Return the nearest rank percentile of a sorted list."""
+    if not values:
+        return 0
+    rank = int(round(p / 100.0 * len(values) + 0.5)) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+class FakeIdeone(object):
+
+    """Emulates the ideone API client. Each submission finishes after the
+    given latency, varied by up to half of it either way, and its output
+    is the source code repeated to output_size characters.
+    """
+
+    def __init__(self, latency=0.2, output_size=0, seed=0):
+        self.latency = latency
+        self.output_size = output_size
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.submissions = {}
+
+    LANGUAGES = {
+        4: "Python (python 2.7.3)",
+        116: "Python 3 (python-3.4)",
+        11: "C (gcc-4.8.1)",
+        10: "Java (sun-jdk-1.7.0_10)",
+        17: "Ruby (ruby-1.9.3)",
+    }
+
+    def languages(self):
+        return dict(self.LANGUAGES)
+
+    def create_submission(self, source, language_name=None, language_id=None,
+                          std_input=''):
+        lang = self.LANGUAGES.get(language_id, language_name)
+        with self.lock:
+            link = '{:06x}'.format(len(self.submissions))
+            delay = self.latency * self.rng.uniform(0.5, 1.5)
+            self.submissions[link] = (source, lang, time.time() + delay)
+        return {'error': 'OK', 'link': link}
+
+    def submission_details(self, link):
+        with self.lock:
+            source, lang, finishes = self.submissions[link]
+        finished = time.time() >= finishes
+        output = source
+        if self.output_size:
+            output = (source * (self.output_size // max(len(source), 1) + 1)
+                      )[:self.output_size]
+        return {
+            'cmpinfo': '', 'error': 'OK', 'input': '', 'langId': 116,
+            'langName': lang, 'output': output if finished else '',
+            'public': True, 'result': 15 if finished else 0, 'signal': 0,
+            'source': source, 'status': 0 if finished else 1, 'stderr': '',
+            'time': 0.1, 'memory': 1024, 'date': '', 'langVersion': '',
+        }
+
+
+class Author(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __eq__(self, other):
+        return self.name == getattr(other, 'name', None)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        return self.name
+
+
+class Item(object):
+
+    """Simplified version of a PRAW comment or message that records when
+    it was fetched and when it was marked as read.
+    """
+
+    count = 0
+
+    def __init__(self, body, reddit, was_comment=True, author='User'):
+        Item.count += 1
+        self.id = '{:06x}'.format(Item.count)
+        self.fullname = ('t1_' if was_comment else 't4_') + self.id
+        self.body = body
+        self.author = Author(author)
+        self.was_comment = was_comment
+        self.permalink = 'comments/replay/_/' + self.id
+        self.reddit_session = reddit
+        self.replies = []
+        self.fetched = None
+        self.read = None
+
+    def reply(self, text):
+        reply = Item(text, self.reddit_session, author=cb.R_USERNAME)
+        self.reddit_session.things[reply.fullname] = reply
+        return reply
+
+    def edit(self, text):
+        pass
+
+    def mark_as_read(self):
+        self.read = time.time()
+
+
+class Subreddit(object):
+    def get_banned(self):
+        return []
+
+    def get_mod_log(self, limit=None):
+        return []
+
+
+class Reddit(object):
+
+    """A fake reddit session whose inbox holds the items of a corpus."""
+
+    def __init__(self, corpus):
+        self.messages = 0
+        self.originals = {}
+        self.things = {}
+        self.inbox = [self.item(entry) for entry in corpus]
+
+    def mention(self, lang, source):
+        code = ''.join('    ' + line + '\n' for line in source.split('\n'))
+        return "+/u/{user} {lang}\n\n{code}\n".format(
+            user=cb.R_USERNAME, lang=lang, code=code)
+
+    def item(self, entry):
+        kind = entry['type']
+        if kind == 'mention':
+            lang, source = entry.get('lang'), entry.get('source')
+            if not source:
+                lang, source = SOURCES[0]
+            return Item(self.mention(lang, source), self)
+        elif kind == 'recompile':
+            lang, source = SOURCES[1]
+            original = Item(self.mention(lang, source), self)
+            reply = Item('', self, author=cb.R_USERNAME)
+            original.replies.append(reply)
+            self.originals[original.id] = original
+            self.things[original.fullname] = original
+            self.things[reply.fullname] = reply
+            return Item("--recompile replay/_/{}".format(original.id), self,
+                        was_comment=False)
+        elif kind == 'help':
+            return Item("--help", self, was_comment=False)
+        return Item("--report spam", self, was_comment=False)
+
+    def login(self, username, password):
+        pass
+
+    def get_unread(self, limit=None):
+        for new in self.inbox:
+            new.fetched = time.time()
+            yield new
+
+    def get_submission(self, submission_id=None, comment_sort=None):
+        class Submission(object):
+            pass
+        submission = Submission()
+        comment_id = submission_id.rsplit('/', 1)[-1]
+        submission.comments = [self.originals[comment_id]]
+        return submission
+
+    def get_subreddit(self, name):
+        return Subreddit()
+
+    def get_info(self, thing_id=None):
+        return self.things.get(thing_id)
+
+    def send_message(self, recipient, subject, text, **kwargs):
+        self.messages += 1
+
+
+def offline(r, ideone, workers, pipeline, cache, directory):
+    """Point every outside dependency of the bot at the fakes."""
+    cb.LOG_FILE = os.path.join(directory, 'replay.log')
+    cb.SESSION = cb.Session(factory=lambda: r)
+    cb.RATE_LIMITER = cb.RateLimiter({})
+    cb.SEND_QUEUE = cb.SendQueue()
+    cb.JOURNAL = cb.WorkJournal()
+    cb.REPLIES = cb.ReplyIndex()
+    cb.BAN_LIST = cb.BanList()
+    cb.LANGUAGES = cb.LanguageIndex()
+    cb.CLIENTS = cb.ClientPool(workers, factory=lambda: ideone)
+    cb.BREAKER = cb.CircuitBreaker()
+    cb.RESULT_CACHE = None
+    if cache:
+        cb.RESULT_CACHE = cb.ResultCache(':memory:', ttl=3600,
+                                         max_entries=10000)
+    cb.WORKERS = workers
+    cb.PIPELINE = pipeline
+    cb.METRICS = cb.Metrics()
+    cb.METRICS_FILE = cb.PROMETHEUS_FILE = ''
+
+def replay(corpus, latency=0.2, output_size=0, workers=4, pipeline=False,
+           cache=True):
+    """Replay a corpus through the bot's main function and return the
+    results as a dict.
+    """
+    r = Reddit(corpus)
+    ideone = FakeIdeone(latency, output_size)
+    directory = tempfile.mkdtemp()
+    try:
+        offline(r, ideone, workers, pipeline, cache, directory)
+        start = time.time()
+        cb.main()
+        seconds = time.time() - start
+    finally:
+        shutil.rmtree(directory)
+    latencies = sorted(new.read - new.fetched for new in r.inbox
+                       if new.read is not None)
+    return {
+        'items': len(r.inbox),
+        'processed': len(latencies),
+        'seconds': seconds,
+        'items_per_second': len(latencies) / seconds if seconds else 0,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        # ru_maxrss is in kilobytes on Linux.
+        'peak_rss_mb': resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        'metrics': cb.METRICS.snapshot(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay inbox items through compilebot offline.")
+    parser.add_argument('--corpus', help="JSON file of items to replay")
+    parser.add_argument('--save', help="write the corpus to a JSON file")
+    parser.add_argument('--size', type=int, default=200,
+                        help="number of items in a synthetic corpus")
+    parser.add_argument('--latency', type=float, default=0.2,
+                        help="seconds each submission takes to finish")
+    parser.add_argument('--output-size', type=int, default=0,
+                        help="characters of output for each submission")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--pipeline', action='store_true')
+    parser.add_argument('--no-cache', action='store_true')
+    parser.add_argument('--poll-initial', type=float,
+                        help="seconds before a submission is first checked")
+    parser.add_argument('--json', action='store_true',
+                        help="print the results as JSON")
+    args = parser.parse_args()
+    if args.corpus:
+        with open(args.corpus) as f:
+            corpus = json.load(f)
+    else:
+        corpus = synthetic_corpus(args.size)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(corpus, f, indent=2)
+    if args.poll_initial is not None:
+        cb.POLL_INITIAL = args.poll_initial
+    results = replay(corpus, latency=args.latency,
+                     output_size=args.output_size, workers=args.workers,
+                     pipeline=args.pipeline, cache=not args.no_cache)
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    print("Items:          {processed}/{items}".format(**results))
+    print("Time:           {seconds:.3f}s".format(**results))
+    print("Throughput:     {items_per_second:.1f} items/s".format(**results))
+    print("Latency:        p50 {:.3f}s  p95 {:.3f}s  p99 {:.3f}s".format(
+        results['p50'], results['p95'], results['p99']))
+    print("Peak memory:    {peak_rss_mb:.1f} MB".format(**results))
+    for name, span in sorted(results['metrics']['spans'].items()):
+        print("{:<16}{:>6} x {:.6f}s avg, {:.6f}s max".format(
+            name, span['count'], span['sum'] / span['count'], span['max']))
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,9 @@ import unittest
 def main():
     test_suites = [
         test_reply.test_suite(),
-        test_compiler.test_suite()
+        test_compiler.test_suite(),
+        test_submission.test_suite(),
+        test_log.test_suite()
     ]
     all_tests = unittest.TestSuite(test_suites)
     unittest.TextTestRunner().run(all_tests)
@@ -0,0 +1,196 @@
+from __future__ import unicode_literals, print_function
+import unittest
+import os
+import json
+import shutil
+import tempfile
+from imp import reload
+import compilebot as cb
+
+"""
+Unit test cases for logging, admin alerts and metrics. No requests are
+made to reddit, alerts are sent with a fake reddit session.
+
+Run the following command from the parent directory in order to run only
+this test module: python -m unittest tests.test_log
+"""
+
+LOG_FILE = "tests.log"
+cb.LOG_FILE = LOG_FILE
+# Outbound calls are not paced in tests.
+cb.RATE_LIMITER = cb.RateLimiter({})
+
+def test_suite():
+    cases = [
+        TestLogFile, TestAlertSender, TestMetrics
+    ]
+    alltests = [
+        unittest.TestLoader().loadTestsFromTestCase(case) for case in cases
+    ]
+    return unittest.TestSuite(alltests)
+
+
+class TestLogFile(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'compilebot.log')
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_buffered_writes(self):
+        log = cb.LogFile(self.path, flush_interval=60)
+        log.write("First line\n")
+        log.write("Second line\n")
+        log.flush()
+        self.assertEqual(self.read(self.path), "First line\nSecond line\n")
+
+    def test_rotation(self):
+        log = cb.LogFile(self.path, max_bytes=100, backups=2)
+        for i in range(25):
+            log.write("Line {:02d}{}\n".format(i, ' ' * 40))
+        log.flush()
+        self.assertTrue(os.path.exists(self.path + '.1'))
+        self.assertTrue(os.path.exists(self.path + '.2'))
+        self.assertFalse(os.path.exists(self.path + '.3'))
+        self.assertIn("Line 24", self.read(self.path))
+        self.assertTrue(os.path.getsize(self.path) < 100)
+
+    def test_log_setting_change(self):
+        cb.LOG_FILE = self.path
+        cb.log("Logged message")
+        cb.flush_logs()
+        self.assertIn("Logged message", self.read(self.path))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        reload(cb)
+        cb.LOG_FILE = LOG_FILE
+        cb.RATE_LIMITER = cb.RateLimiter({})
+
+
+class TestAlertSender(unittest.TestCase):
+
+    class Reddit(object):
+        def __init__(self):
+            self.messages = []
+
+        def send_message(self, recipient, subject, text, **kwargs):
+            self.messages.append((recipient, subject, text))
+
+    def test_batching(self):
+        r = self.Reddit()
+        alerts = cb.AlertSender("admin", window=60, session=r)
+        for i in range(3):
+            alerts.alert("Error {}".format(i))
+        # Alerts wait in the background until the window closes, or until
+        # they're flushed.
+        self.assertEqual(r.messages, [])
+        alerts.flush()
+        self.assertEqual(len(r.messages), 1)
+        recipient, subject, text = r.messages[0]
+        self.assertEqual(recipient, "admin")
+        self.assertTrue(all("Error {}".format(i) in text for i in range(3)))
+        alerts.flush()
+        self.assertEqual(len(r.messages), 1)
+
+    def test_log_alert(self):
+        r = self.Reddit()
+        cb.ADMIN = "admin"
+        cb.ALERTS = cb.AlertSender("admin", window=0, session=r)
+        cb.log("Something went wrong", alert=True)
+        cb.flush_logs()
+        self.assertIn("Something went wrong", r.messages[0][2])
+
+    def tearDown(self):
+        reload(cb)
+        cb.LOG_FILE = LOG_FILE
+        cb.RATE_LIMITER = cb.RateLimiter({})
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.metrics = cb.Metrics(clock=lambda: self.now)
+
+    def test_counters(self):
+        self.metrics.count('cache_hits_total')
+        self.metrics.count('results_total', code=15)
+        self.metrics.count('results_total', code=15)
+        self.metrics.count('results_total', code=13)
+        counters = self.metrics.snapshot()['counters']
+        self.assertEqual(counters['cache_hits_total'], 1)
+        self.assertEqual(counters['results_total{code="15"}'], 2)
+        self.assertEqual(counters['results_total{code="13"}'], 1)
+
+    def test_spans(self):
+        for seconds in (1, 3):
+            with self.metrics.span('poll'):
+                self.now += seconds
+        span = self.metrics.snapshot()['spans']['poll']
+        self.assertEqual(span, {'count': 2, 'sum': 4, 'max': 3})
+
+    def test_peaks(self):
+        cb.METRICS = self.metrics
+        for size in (10, 1000, 100):
+            cb.cap_details({'output': 'x' * size, 'stderr': '',
+                            'cmpinfo': ''})
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot['peaks']['output_held_chars_max'], 1000)
+        self.assertEqual(snapshot['counters']['output_held_chars_total'],
+                         1110)
+        self.assertIn('compilebot_output_held_chars_max 1000',
+                      self.metrics.prometheus().splitlines())
+
+    def test_prometheus(self):
+        self.metrics.count('results_total', code=15)
+        self.metrics.observe('send', 0.5)
+        lines = self.metrics.prometheus().splitlines()
+        self.assertIn('compilebot_results_total{code="15"} 1', lines)
+        self.assertIn('compilebot_span_seconds_sum{span="send"} 0.5', lines)
+
+    def test_worker_labels(self):
+        # Every series a worker writes carries its index, so the files of
+        # several workers don't repeat the same series.
+        cb.PROMETHEUS_FILE = 'metrics.prom'
+        cb.init_worker(2, 1)
+        cb.METRICS.count('cache_hits_total')
+        cb.METRICS.count('results_total', code=15)
+        cb.METRICS.peak('output_held_chars_max', 10)
+        cb.METRICS.observe('send', 0.5)
+        lines = cb.METRICS.prometheus().splitlines()
+        self.assertEqual(cb.PROMETHEUS_FILE, 'metrics-1.prom')
+        self.assertIn('compilebot_cache_hits_total{worker="1"} 1', lines)
+        self.assertIn('compilebot_results_total{code="15",worker="1"} 1',
+                      lines)
+        self.assertIn('compilebot_output_held_chars_max{worker="1"} 10',
+                      lines)
+        self.assertIn('compilebot_span_seconds_sum{span="send",worker="1"} '
+                      '0.5', lines)
+        self.assertTrue(all('worker="1"' in line for line in lines))
+
+    def test_write(self):
+        directory = tempfile.mkdtemp()
+        cb.METRICS = self.metrics
+        cb.METRICS_FILE = os.path.join(directory, 'metrics.json')
+        cb.PROMETHEUS_FILE = os.path.join(directory, 'metrics.prom')
+        self.metrics.count('cache_misses_total')
+        cb.write_metrics()
+        with open(cb.METRICS_FILE) as f:
+            snapshot = json.load(f)
+        self.assertEqual(snapshot['counters']['cache_misses_total'], 1)
+        with open(cb.PROMETHEUS_FILE) as f:
+            self.assertIn('compilebot_cache_misses_total 1', f.read())
+        shutil.rmtree(directory)
+
+    def tearDown(self):
+        reload(cb)
+        cb.LOG_FILE = LOG_FILE
+        cb.RATE_LIMITER = cb.RateLimiter({})
+
+
+if __name__ == "__main__":
+    unittest.main(exit=False)
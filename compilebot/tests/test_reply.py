@@ -2,6 +2,10 @@ from __future__ import unicode_literals, print_function
 import unittest
 import random
 import string 
+import os
+import tempfile
+import sqlite3
+import threading
 from imp import reload
 import compilebot as cb
 
@@ -16,15 +20,25 @@ this test module: python -m unittest tests.test_reply
 
 LOG_FILE = "tests.log" 
 cb.LOG_FILE = LOG_FILE
+# Outbound calls are not paced in tests.
+cb.RATE_LIMITER = cb.RateLimiter({})
 
 def reddit_id(length=6):
     """Emulate a reddit id with a random string of letters and digits"""
     return ''.join(random.choice(string.ascii_lowercase + 
                    string.digits) for x in range(length))
     
+def rate_limit(sleep_time):
+    """Create a rate limit exception without a reddit response."""
+    e = cb.praw.errors.RateLimitExceeded.__new__(
+        cb.praw.errors.RateLimitExceeded)
+    e.sleep_time = sleep_time
+    return e
+
 def test_suite():
     cases = [
-        TestParseComment, TestCreateReply, TestProcessUnread, TestDetectSpam
+        TestParseComment, TestCreateReply, TestProcessUnread, TestDetectSpam,
+        TestProcessInbox, TestJob, TestBanList, TestSession, TestSendQueue
     ]
     alltests = [
         unittest.TestLoader().loadTestsFromTestCase(case) for case in cases
@@ -62,6 +76,27 @@ class TestParseComment(unittest.TestCase):
                 "\n\n".format(user=self.user))
         self.assertRaises(AttributeError, cb.parse_comment, (body))
 
+    def test_tab_indentation(self):
+        body = ("+/u/{user} C\n\n\tint main() {{\n\t}}\n\n"
+                "stdin:\n\n\t1\n").format(user=self.user)
+        args, source, stdin = cb.parse_comment(body)
+        self.assertEqual(args, 'C')
+        self.assertEqual(source, 'int main() {\n\t}')
+        self.assertEqual(stdin, '1')
+
+    def test_large_comment(self):
+        # Long comments made of many indented and blank lines should be
+        # parsed in a single pass.
+        lines = ["    print({})\n\n".format(i) for i in range(20000)]
+        body = ("+/u/{user} python\n\n{code}Input:\n\n    1\n    2\n"
+                "Trailing text".format(user=self.user, code=''.join(lines)))
+        args, source, stdin = cb.parse_comment(body)
+        self.assertEqual(source.count('\n'), 2 * 20000 - 2)
+        self.assertTrue(source.endswith('print(19999)'))
+        self.assertEqual(stdin, '1\n2\n')
+        body = "+/u/{user} python\n".format(user=self.user) + " \n" * 50000
+        self.assertRaises(AttributeError, cb.parse_comment, (body))
+
 class TestCreateReply(unittest.TestCase):
     
     # Simplified version of a PRAW comment for testing purposes.
@@ -69,7 +104,11 @@ class TestCreateReply(unittest.TestCase):
         def __init__(self, body):
             self.body = body
             self.id = reddit_id()
+            self.fullname = 't1_' + self.id
             self.permalink = ''
+            self.author = None
+            self.was_comment = True
+            self.reddit_session = None
     
     def setUp(self):
         self.user = cb.R_USERNAME
@@ -89,13 +128,13 @@ class TestCreateReply(unittest.TestCase):
         body = ("+/u/{user} python\n\n"
                 "    print(\"Test\")\n\n".format(user=self.user))
         comment = self.Comment(body)
-        reply = cb.create_reply(comment)
+        reply = cb.create_reply(cb.Job.from_thing(comment))
         self.assertIn("Output:\n\n    Test\n", reply.text)
         
     def test_bad_format(self):
         body = "+/u/{user} Formatted incorrectly".format(user=self.user)
         comment = self.Comment(body)
-        reply = cb.create_reply(comment)
+        reply = cb.create_reply(cb.Job.from_thing(comment))
         self.assertIsInstance(reply, cb.MessageReply)
         self.assertIn(cb.FORMAT_ERROR_TEXT, reply.text)
         
@@ -110,10 +149,24 @@ class TestCreateReply(unittest.TestCase):
         # were looking for via message reply.
         body = "+/u/{user} Foo\n\n    print(\"Test\")\n\n".format(user=self.user)
         comment = self.Comment(body)
-        reply = cb.create_reply(comment)
+        reply = cb.create_reply(cb.Job.from_thing(comment))
         self.assertIsInstance(reply, cb.MessageReply)
         self.assertTrue(all(lang in reply.text for lang in similar_langs))
         
+    def test_unknown_language(self):
+        # Languages missing from the language index are rejected without
+        # submitting anything.
+        def compile(*args, **kwargs):
+            self.fail("Unknown language submitted")
+        cb.compile = compile
+        cb.LANGUAGES._build({4: "Python (python 2.7.3)",
+                             116: "Python 3 (python-3.4)"})
+        body = "+/u/{user} Pyton\n\n    print(\"Test\")\n\n".format(
+            user=self.user)
+        reply = cb.create_reply(cb.Job.from_thing(self.Comment(body)))
+        self.assertIsInstance(reply, cb.MessageReply)
+        self.assertIn("Python", reply.text)
+
     def test_result_errors(self):
         # Test each error code and ensure the user will be alerted of
         # errors via private message instead of in compiled replies.
@@ -132,17 +185,45 @@ class TestCreateReply(unittest.TestCase):
             body = ("+/u/{user} python\n\n"
                     "    error\n\n".format(user=self.user))
             comment = self.Comment(body)
-            reply = cb.create_reply(comment)
+            reply = cb.create_reply(cb.Job.from_thing(comment))
             self.assertIsInstance(reply, cb.MessageReply)
         body = ("+/u/{user} python --include-errors\n\n"
                 "    error\n\n".format(user=self.user))
         comment = self.Comment(body)
-        reply = cb.create_reply(comment)
+        reply = cb.create_reply(cb.Job.from_thing(comment))
         self.assertIsInstance(reply, cb.CompiledReply)
         
+    def test_long_output(self):
+        details = {'output': 'x' * 10 ** 6, 'stderr': '', 'cmpinfo': '',
+                   'source': 'y' * 20000, 'input': '', 'time': 0.1}
+        text = cb.format_reply(details, ['--source', '--time'], footer='end')
+        self.assertTrue(len(text) <= cb.REPLY_LIMIT)
+        # The output is kept ahead of the source and the footer is whole.
+        self.assertIn('x' * cb.OUTPUT_LIMIT + '\n        ...', text)
+        self.assertTrue(text.endswith('end'))
+
+    def test_excessive_lines(self):
+        details = {'output': "spam\n" * 10 ** 5, 'stderr': '', 'cmpinfo': ''}
+        text = cb.format_reply(details, [])
+        self.assertEqual(text, "Output:\n\n    spam\n    spam\n    ...\n\n")
+        # Lines long enough that only some of them fit in the reply.
+        line = 'x' * 49 + '\n'
+        details = {'output': line * 1000, 'stderr': '', 'cmpinfo': ''}
+        cb.cap_details(details)
+        text = cb.format_reply(details, [])
+        self.assertEqual(text, "Output:\n\n    {0}\n    {0}\n    ...\n\n"
+                               "".format('x' * 49))
+        details = {'output': ''.join('{:<49}\n'.format(i)
+                                     for i in range(1000)),
+                   'stderr': '', 'cmpinfo': ''}
+        text = cb.format_reply(details, [])
+        self.assertIn("\n    50 ", text)
+        self.assertNotIn("\n    51 ", text)
+
     def tearDown(self):
         reload(cb)
         cb.LOG_FILE = LOG_FILE
+        cb.RATE_LIMITER = cb.RateLimiter({})
 
 class TestProcessUnread(unittest.TestCase):
     
@@ -160,6 +241,7 @@ class TestProcessUnread(unittest.TestCase):
             # Allows a custom comment to be assigned that is used to
             # verify if get_submission is working correctly.
             self._get_sub_comment = None
+            self._get_submission_calls = 0
             
         def get_subreddit(*args, **kwargs):
             pass
@@ -171,10 +253,17 @@ class TestProcessUnread(unittest.TestCase):
             self._message_text = text
             
         def get_submission(self, *args, **kwargs):
+            self._get_submission_calls += 1
             s = TestProcessUnread.Submission()
             if kwargs.get('submission_id') == self._get_sub_comment.permalink:
                 s.comments.append(self._get_sub_comment)
             return s
+
+        def get_info(self, thing_id=None):
+            original = self._get_sub_comment
+            for thing in [original] + list(original.replies):
+                if 't1_' + thing.id == thing_id:
+                    return thing
     
     class Submission(object):
         def __init__(self):
@@ -186,6 +275,7 @@ class TestProcessUnread(unittest.TestCase):
             self.body = body
             self.replies = replies
             self.id = reddit_id()
+            self.fullname = 't1_' + self.id
             self.reddit_session = reddit_session
             self._replied_to = False
             self._reply_text = ''    
@@ -243,20 +333,20 @@ class TestProcessUnread(unittest.TestCase):
         body = ("+/u/{user} python 3\n\n    x = input()\n    print(x)"
                 "\n\n".format(user=self.user))
         new = self.Comment(body=body, reddit_session=self.r)
-        cb.process_unread(new, self.r)
+        cb.process_unread(cb.Job.from_thing(new), self.r)
         self.assertTrue(new._replied_to)
         self.assertIn("Output:\n\n    Hello World", new._reply_text)
         
     def test_help_request(self):
         new = self.Message(body="--help", reddit_session=self.r)
-        cb.process_unread(new, self.r)
+        cb.process_unread(cb.Job.from_thing(new), self.r)
         self.assertTrue(self.r._sent_message)
         self.assertIn(cb.HELP_TEXT, self.r._message_text)
         
     def test_banned_filter(self):
         cb.BANNED_USERS.add("Banned-User-01")
         new = self.Comment(author=self.Author(name="Banned-User-01"))
-        cb.process_unread(new, self.r)
+        cb.process_unread(cb.Job.from_thing(new), self.r)
         self.assertFalse(new._replied_to)
         
     def test_recompile_request(self):
@@ -279,9 +369,33 @@ class TestProcessUnread(unittest.TestCase):
         # Message that makes the recompile request.
         body = "--recompile {link}".format(link=original.permalink)
         new = self.Message(body=body, reddit_session=self.r)
-        cb.process_unread(new, self.r)
+        cb.process_unread(cb.Job.from_thing(new), self.r)
         self.assertTrue(original._replied_to)
-        
+
+    def test_recompile_fetched_comment(self):
+        # Comments fetched with get_info, unlike those in the inbox, have
+        # no was_comment attribute.
+        def compile(*args, **kwargs):
+            return {
+                'cmpinfo': '', 'error': 'OK', 'input': "",
+                'langId': 116, 'link': '', 'langName': "Python 3",
+                'output': "Test\n", 'public': True, 'result': 15,
+                'signal': 0, 'source': "print(\"Test\")", 'status': 0,
+                'stderr': "",
+            }
+
+        cb.compile = compile
+        cb.ADMIN = ''
+        body = ("+/u/{user} python 3\n\n    print(\"Test\")\n\n"
+                "".format(user=self.user))
+        original = self.Comment(body=body, reddit_session=self.r)
+        del original.was_comment
+        self.r._get_sub_comment = original
+        body = "--recompile {link}".format(link=original.permalink)
+        new = self.Message(body=body, reddit_session=self.r)
+        cb.process_unread(cb.Job.from_thing(new), self.r)
+        self.assertIn("Output:\n\n    Test", original._reply_text)
+
     def test_recompile_edit(self):
         # Ensure that if there is an existing reply from a bot on a 
         # comment that is being recompiled, the existing reply is 
@@ -307,11 +421,43 @@ class TestProcessUnread(unittest.TestCase):
         
         body = "--recompile {link}".format(link=original.permalink)
         new = self.Message(body=body, reddit_session=self.r)
-        cb.process_unread(new, self.r)
+        cb.process_unread(cb.Job.from_thing(new), self.r)
         self.assertTrue(existing_reply._edited)
         self.assertIn("Output:\n\n    Test", existing_reply._edit_text)
         self.assertFalse(original._replied_to)
     
+    def test_recompile_indexed_reply(self):
+        # A reply in the reply index is edited without fetching the
+        # comment's thread, and only if the output has changed.
+        output = ["Test\n"]
+        def compile(*args, **kwargs):
+            return {
+                'cmpinfo': '', 'error': 'OK', 'input': "", 'langId': 116,
+                'link': '', 'langName': "Python 3", 'output': output[0],
+                'public': True, 'result': 15, 'signal': 0,
+                'source': "print(\"Test\")", 'status': 0, 'stderr': "",
+            }
+
+        cb.compile = compile
+        existing_reply = self.Comment(author=self.Author(self.user))
+        body = ("+/u/{user} python 3\n\n    print(\"test\")\n\n"
+                "".format(user=self.user))
+        original = self.Comment(body=body, reddit_session=self.r,
+                                replies=[existing_reply])
+        self.r._get_sub_comment = original
+        digest = cb.create_reply(cb.Job.from_thing(original)).digest
+        cb.REPLIES.put(original.id, existing_reply.id, digest)
+        body = "--recompile {link}".format(link=original.permalink)
+        cb.process_unread(cb.Job.from_thing(self.Message(body=body)),
+                           self.r)
+        self.assertFalse(existing_reply._edited)
+        output[0] = "Changed\n"
+        cb.process_unread(cb.Job.from_thing(self.Message(body=body)),
+                           self.r)
+        self.assertIn("Output:\n\n    Changed", existing_reply._edit_text)
+        self.assertEqual(self.r._get_submission_calls, 0)
+        self.assertNotEqual(cb.REPLIES.get(original.id)[1], digest)
+
     def test_recompile_user_permissions(self):
         # Ensure users aren't allowed to make recompile requests of behalf
         # of other users.
@@ -321,13 +467,14 @@ class TestProcessUnread(unittest.TestCase):
         body = "--recompile {link}".format(link=original.permalink)
         new = self.Message(body=body, reddit_session=self.r, 
                            author=self.Author("Author-2"))
-        cb.process_unread(new, self.r)
+        cb.process_unread(cb.Job.from_thing(new), self.r)
         self.assertFalse(original._replied_to)
         self.assertTrue(new._replied_to)
         
     def tearDown(self):
         reload(cb)
         cb.LOG_FILE = LOG_FILE
+        cb.RATE_LIMITER = cb.RateLimiter({})
         
 class TestDetectSpam(unittest.TestCase):
     
@@ -369,6 +516,514 @@ class TestDetectSpam(unittest.TestCase):
         reply.compile_details['stderr'] = "'rm -rf /*': Permission denied"
         self.assertIn("Illegal system call detected", reply.detect_spam())
 
+    def test_offset(self):
+        reply = self.create_reply("Hello\nrm -rf /")
+        reply.compile_details['source'] = "print('Hello')"
+        self.assertEqual(reply.spam_matches(),
+                         [("Spam phrase detected", 'output', 6)])
+
+    def test_weighted_rules(self):
+        # A rule that isn't enough to report a reply on its own is
+        # reported along with the rule that reaches the threshold.
+        detector = cb.SpamDetector(
+            ["spam"], [{'name': "Fork bomb", 'pattern': r':\(\)\s*\{',
+                        'weight': 0.5}],
+            phrase_weight=0.5, threshold=1)
+        details = {'source': ":() { :|:& };:", 'output': "SPAM",
+                   'stderr': ''}
+        self.assertEqual(detector.scan(details),
+                         [("Fork bomb", 'source', 0),
+                          ("Spam phrase detected", 'output', 0)])
+        details['output'] = ''
+        self.assertEqual(detector.scan(details), [])
+
+    def test_capped_output(self):
+        # Limits are checked against the full output of a submission even
+        # after it has been capped.
+        output = "line\n" * 10 ** 5
+        details = {'output': output, 'stderr': '', 'cmpinfo': '',
+                   'source': '', 'link': 'abc'}
+        self.assertEqual(cb.cap_details(details), len(output))
+        self.assertEqual(len(details['output']), cb.OUTPUT_CAP)
+        self.assertEqual(details['output_length'], len(output))
+        self.assertEqual(details['output_digest'], cb.text_digest(output))
+        reply = cb.CompiledReply('', details)
+        self.assertEqual(reply.detect_spam(), ["Excessive character count"])
+        cb.CHAR_LIMIT = len(output)
+        self.assertEqual(reply.detect_spam(), ["Excessive line breaks"])
+
+    def tearDown(self):
+        reload(cb)
+        cb.LOG_FILE = LOG_FILE
+        cb.RATE_LIMITER = cb.RateLimiter({})
+
+class TestProcessInbox(unittest.TestCase):
+
+    class Item(object):
+        def __init__(self, fail=False):
+            self.id = reddit_id()
+            self.fullname = 't4_' + self.id
+            self.was_comment = False
+            self.body = ''
+            self.author = None
+            self.reddit_session = None
+            self.fail = fail
+            self._marked_read = 0
+
+        def mark_as_read(self):
+            self._marked_read += 1
+
+    def setUp(self):
+        self.processed = []
+        def process_unread(new, r):
+            if new.thing.fail:
+                raise ValueError("Processing failed")
+            self.processed.append(new.id)
+        cb.process_unread = process_unread
+        cb.ADMIN = ''
+        cb.JOURNAL = cb.WorkJournal()
+
+    def test_sequential(self):
+        inbox = [self.Item(), self.Item(fail=True), self.Item()]
+        cb.process_inbox(inbox, None, workers=1)
+        self.assertEqual(len(self.processed), 2)
+        # The failed item is left unread so that it is retried.
+        self.assertEqual([new._marked_read for new in inbox], [1, 0, 1])
+
+    def test_retry_limit(self):
+        new = self.Item(fail=True)
+        for _ in range(cb.JOURNAL.max_attempts):
+            self.assertEqual(new._marked_read, 0)
+            cb.process_inbox([new], None)
+        self.assertEqual(new._marked_read, 1)
+        self.assertEqual(cb.JOURNAL.state(new.id), cb.WorkJournal.READ)
+
+    def test_already_replied(self):
+        # An item that was replied to before a crash is only marked as
+        # read when it is fetched again.
+        new = self.Item()
+        cb.JOURNAL.record(new.id, cb.WorkJournal.REPLIED)
+        cb.process_inbox([new], None)
+        self.assertEqual(self.processed, [])
+        self.assertEqual(new._marked_read, 1)
+
+    def test_resume_submission(self):
+        submitted = []
+        def submit(source, lang, stdin='', client=None):
+            submitted.append(source)
+            return 'new'
+        class Client(object):
+            def submission_details(self, link):
+                return {'status': 0, 'result': 15, 'time': 0.1,
+                        'output': link}
+        cb.submit = submit
+        cb.CLIENTS = cb.ClientPool(1, factory=Client)
+        cb.RESULT_CACHE = None
+        cb.JOURNAL.fetched('abc')
+        cb.JOURNAL.submitted('abc', 'old')
+        details = cb.compile('print(1)', 'python', item_id='abc')
+        self.assertEqual(details['link'], 'old')
+        self.assertEqual(submitted, [])
+        details = cb.compile('print(1)', 'python', item_id='def')
+        self.assertEqual(submitted, ['print(1)'])
+
+    def test_claims(self):
+        # An item that is fetched again while a worker holds it is
+        # skipped, as is one that has been marked as read.
+        self.assertTrue(cb.JOURNAL.claim('abc', 0))
+        self.assertFalse(cb.JOURNAL.claim('abc', 1))
+        cb.JOURNAL.unclaim('abc')
+        self.assertTrue(cb.JOURNAL.claim('abc', 1))
+        cb.JOURNAL.release(1)
+        cb.JOURNAL.record('abc', cb.WorkJournal.READ)
+        self.assertFalse(cb.JOURNAL.claim('abc', 0))
+
+    def test_worker_pool(self):
+        # Every item should be marked as read exactly once, even if
+        # processing fails for some of them.
+        cb.JOURNAL = cb.WorkJournal(max_attempts=1)
+        inbox = [self.Item(fail=(i % 5 == 0)) for i in range(50)]
+        cb.process_inbox(iter(inbox), None, workers=4)
+        self.assertEqual(len(self.processed), 40)
+        self.assertTrue(all(new._marked_read == 1 for new in inbox))
+
+    def test_check_inbox_stop(self):
+        # Once the stop event is set no new items are taken from the inbox.
+        class Reddit(object):
+            def get_unread(self, limit=None):
+                return iter(inbox)
+        stop = threading.Event()
+        def process_unread(new, r):
+            self.processed.append(new.id)
+            if len(self.processed) == 3:
+                stop.set()
+        cb.process_unread = process_unread
+        cb.SUBREDDIT = ''
+        cb.WORKERS = 1
+        inbox = [self.Item() for i in range(10)]
+        self.assertEqual(cb.check_inbox(Reddit(), stop=stop), 3)
+        self.assertEqual([new._marked_read for new in inbox],
+                         [1, 1, 1] + [0] * 7)
+
+    def tearDown(self):
+        reload(cb)
+        cb.LOG_FILE = LOG_FILE
+        cb.RATE_LIMITER = cb.RateLimiter({})
+
+class TestJob(unittest.TestCase):
+
+    class Thing(object):
+
+        """Emulates the lazy loading of PRAW objects. Reading the
+        permalink of a comment fetches its submission, and reading an
+        attribute that didn't come with the inbox listing fetches the
+        object itself. Every fetch is counted.
+        """
+
+        def __init__(self, body, r, was_comment=True):
+            self.reddit_session = r
+            self.id = reddit_id()
+            self.fullname = ('t1_' if was_comment else 't4_') + self.id
+            self.body = body
+            self.was_comment = was_comment
+            self.author = TestProcessUnread.Author("User")
+            if was_comment:
+                self.context = "/r/test/comments/abc/_/{}/?context=3".format(
+                    self.id)
+
+        @property
+        def permalink(self):
+            self.reddit_session.fetches += 1
+            return "http://www.reddit.com/r/test/comments/abc/_/" + self.id
+
+        def __getattr__(self, name):
+            if name.startswith('__'):
+                raise AttributeError(name)
+            self.reddit_session.fetches += 1
+            raise AttributeError(name)
+
+        def reply(self, text):
+            pass
+
+        def mark_as_read(self):
+            pass
+
+    class Reddit(TestProcessUnread.Reddit):
+        def __init__(self):
+            TestProcessUnread.Reddit.__init__(self)
+            self.fetches = 0
+
+    def test_no_lazy_loads(self):
+        def compile(*args, **kwargs):
+            return {
+                'cmpinfo': '', 'input': '', 'langName': "Python",
+                'output': "Test", 'result': 15, 'stderr': '', 'link': '',
+            }
+        cb.compile = compile
+        cb.JOURNAL = cb.WorkJournal()
+        r = self.Reddit()
+        mention = "+/u/{user} python\n\n    print(\"Test\")\n\n".format(
+            user=cb.R_USERNAME)
+        inbox = [
+            self.Thing(mention, r),
+            self.Thing("+/u/{user} Formatted incorrectly".format(
+                user=cb.R_USERNAME), r),
+            self.Thing("--help", r, was_comment=False),
+        ]
+        cb.process_inbox(inbox, r)
+        self.assertTrue(r._sent_message)
+        self.assertTrue(all(cb.JOURNAL.state(new.id) == cb.WorkJournal.READ
+                            for new in inbox))
+        self.assertEqual(r.fetches, 0)
+
+    def test_immutable(self):
+        r = self.Reddit()
+        job = cb.Job.from_thing(self.Thing("--help", r, was_comment=False))
+        self.assertRaises(AttributeError, setattr, job, 'body', '')
+        # There is no instance dictionary to hold any other attributes.
+        self.assertRaises(AttributeError, setattr, job, 'subject', '')
+
+    def tearDown(self):
+        reload(cb)
+        cb.LOG_FILE = LOG_FILE
+        cb.RATE_LIMITER = cb.RateLimiter({})
+
+
+class TestBanList(unittest.TestCase):
+
+    class Reddit(object):
+        def __init__(self, banned, mod_log):
+            self.banned = banned
+            self.mod_log = mod_log
+            self.ban_fetches = 0
+
+        def get_subreddit(self, name):
+            return self
+
+        def get_banned(self):
+            self.ban_fetches += 1
+            return [TestProcessUnread.Author(name) for name in self.banned]
+
+        def get_mod_log(self, limit=None):
+            # The moderation log is returned newest first.
+            return sorted(self.mod_log, key=lambda a: -a.created_utc)[:limit]
+
+    class ModAction(object):
+        def __init__(self, action, target_author, created_utc):
+            self.action = action
+            self.target_author = target_author
+            self.created_utc = created_utc
+
+    def setUp(self):
+        self.now = 1000
+        self.path = os.path.join(tempfile.mkdtemp(), 'banned.json')
+        cb.SUBREDDIT = 'CompileBot'
+
+    def ban_list(self, limit=100):
+        return cb.BanList(self.path, refresh_interval=3600,
+                          mod_log_limit=limit, clock=lambda: self.now)
+
+    def test_incremental_update(self):
+        r = self.Reddit(['User-1', 'User-2'], [])
+        bans = self.ban_list()
+        self.assertEqual(bans.update(r), {'user-1', 'user-2'})
+        self.now += 600
+        r.mod_log = [self.ModAction('banuser', 'User-3', 1100),
+                     self.ModAction('unbanuser', 'User-1', 1200),
+                     self.ModAction('approvelink', 'User-4', 1300)]
+        self.assertEqual(bans.update(r), {'user-2', 'user-3'})
+        self.assertEqual(r.ban_fetches, 1)
+        # The full list is fetched again once the refresh interval passes.
+        self.now += 3600
+        bans.update(r)
+        self.assertEqual(r.ban_fetches, 2)
+
+    def test_snapshot(self):
+        r = self.Reddit(['User-1'], [])
+        self.ban_list().update(r)
+        # A new ban list loads the snapshot instead of fetching the list.
+        self.now += 60
+        bans = self.ban_list()
+        self.assertEqual(bans.update(r), {'user-1'})
+        self.assertEqual(r.ban_fetches, 1)
+
+    def test_mod_log_gap(self):
+        r = self.Reddit(['User-1'], [])
+        bans = self.ban_list(limit=2)
+        bans.update(r)
+        # If the moderation log doesn't reach back to the last update,
+        # some actions may have been missed.
+        self.now += 600
+        r.mod_log = [self.ModAction('banuser', 'User-2', 1500 + i)
+                     for i in range(3)]
+        bans.update(r)
+        self.assertEqual(r.ban_fetches, 2)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        reload(cb)
+        cb.LOG_FILE = LOG_FILE
+        cb.RATE_LIMITER = cb.RateLimiter({})
+
+class TestSession(unittest.TestCase):
+
+    class Reddit(TestProcessUnread.Reddit):
+        def __init__(self):
+            TestProcessUnread.Reddit.__init__(self)
+            self.logins = 0
+
+        def login(self, username, password):
+            self.logins += 1
+
+    def setUp(self):
+        self.now = 0
+        self.sessions = []
+        def factory():
+            self.sessions.append(self.Reddit())
+            return self.sessions[-1]
+        cb.SESSION = cb.Session(max_age=3600, factory=factory,
+                                clock=lambda: self.now)
+
+    def test_single_login(self):
+        r = cb.SESSION.get()
+        cb.SUBREDDIT = 'CompileBot'
+        cb.send_modmail("Subject", "Body")
+        cb.ALERTS = cb.AlertSender('admin', window=0)
+        cb.ALERTS.alert("Alert")
+        cb.ALERTS.flush()
+        new = TestProcessUnread.Message(body="--help")
+        cb.MessageReply(cb.HELP_TEXT).send(cb.Job.from_thing(new))
+        self.assertEqual(len(self.sessions), 1)
+        self.assertEqual(r.logins, 1)
+        self.assertIn(cb.HELP_TEXT, r._message_text)
+
+    def test_expiry(self):
+        r = cb.SESSION.get()
+        self.now += 3599
+        self.assertIs(cb.SESSION.get(), r)
+        self.now += 1
+        self.assertIsNot(cb.SESSION.get(), r)
+        cb.SESSION.expire()
+        cb.SESSION.get()
+        self.assertEqual(len(self.sessions), 3)
+
+    def tearDown(self):
+        reload(cb)
+        cb.LOG_FILE = LOG_FILE
+        cb.RATE_LIMITER = cb.RateLimiter({})
+
+class TestSendQueue(unittest.TestCase):
+
+    class Comment(TestProcessUnread.Comment):
+        def __init__(self, *args, **kwargs):
+            TestProcessUnread.Comment.__init__(self, *args, **kwargs)
+            self.rate_limited = 0
+
+        def reply(self, text):
+            if self.rate_limited:
+                self.rate_limited -= 1
+                raise rate_limit(60)
+            TestProcessUnread.Comment.reply(self, text)
+            return TestSendQueue.Comment(body=text)
+
+        def edit(self, text):
+            if self.rate_limited:
+                self.rate_limited -= 1
+                raise rate_limit(60)
+            TestProcessUnread.Comment.edit(self, text)
+
+    class Reddit(TestProcessUnread.Reddit):
+        def __init__(self, things):
+            TestProcessUnread.Reddit.__init__(self)
+            self.things = {thing.fullname: thing for thing in things}
+
+        def get_info(self, thing_id=None):
+            return self.things.get(thing_id)
+
+    def setUp(self):
+        self.now = 0
+        self.path = os.path.join(tempfile.mkdtemp(), 'outbox.db')
+        cb.SEND_QUEUE = self.send_queue()
+
+    def send_queue(self, max_attempts=3):
+        return cb.SendQueue(self.path, max_attempts=max_attempts,
+                            clock=lambda: self.now)
+
+    def test_deferred_reply(self):
+        limited = self.Comment(body='limited')
+        limited.rate_limited = 1
+        waiting = self.Comment(body='waiting')
+        cb.CompiledReply("Output", {}).send(cb.Job.from_thing(limited))
+        # Replies sent during the rate limit window are parked without
+        # trying to send them.
+        cb.CompiledReply("Output", {}).send(cb.Job.from_thing(waiting))
+        self.assertEqual(len(cb.SEND_QUEUE), 2)
+        self.assertFalse(limited._replied_to or waiting._replied_to)
+        r = self.Reddit([limited, waiting])
+        cb.SEND_QUEUE.flush(r)
+        self.assertEqual(len(cb.SEND_QUEUE), 2)
+        self.now += 60
+        cb.SEND_QUEUE.flush(r)
+        self.assertEqual(len(cb.SEND_QUEUE), 0)
+        self.assertTrue(limited._replied_to and waiting._replied_to)
+
+    def test_persistence(self):
+        limited = self.Comment(body='limited')
+        limited.rate_limited = 1
+        cb.CompiledReply("Output", {}).send(cb.Job.from_thing(limited))
+        # A new queue picks up the parked items and the rate limit window.
+        cb.SEND_QUEUE = self.send_queue()
+        self.assertTrue(cb.SEND_QUEUE.limited())
+        self.now += 60
+        cb.SEND_QUEUE.flush(self.Reddit([limited]))
+        self.assertTrue(limited._replied_to)
+
+    def test_reply_index(self):
+        # Deferred replies and edits are only indexed once they're sent.
+        cb.ADMIN = ''
+        original = self.Comment(body='original')
+        original.rate_limited = 1
+        cb.CompiledReply("Output", {}, digest='old').send(
+            cb.Job.from_thing(original))
+        self.assertIsNone(cb.REPLIES.get(original.id))
+        r = self.Reddit([original])
+        self.now += 60
+        cb.SEND_QUEUE.flush(r)
+        reply_id = cb.REPLIES.get(original.id)[0]
+        reply = self.Comment(body='Output')
+        reply.id, reply.fullname = reply_id, 't1_' + reply_id
+        reply.rate_limited = 10
+        r.things[reply.fullname] = reply
+        cb.CompiledReply("Changed", {}, digest='new').make_edit(
+            reply, cb.Job.from_thing(original))
+        for i in range(5):
+            self.now += 60
+            cb.SEND_QUEUE.flush(r)
+        # The edit was dropped, so the reply still has the old output.
+        self.assertEqual(cb.REPLIES.get(original.id), (reply_id, 'old'))
+        reply.rate_limited = 1
+        cb.CompiledReply("Changed", {}, digest='new').make_edit(
+            reply, cb.Job.from_thing(original))
+        self.now += 60
+        cb.SEND_QUEUE.flush(r)
+        self.assertEqual(cb.REPLIES.get(original.id), (reply_id, 'new'))
+
+    def test_old_outbox(self):
+        os.remove(self.path)
+        db = sqlite3.connect(self.path)
+        db.execute("CREATE TABLE outbox (id INTEGER PRIMARY KEY, kind TEXT, "
+                   "target TEXT, subject TEXT, text TEXT, not_before REAL, "
+                   "attempts INTEGER)")
+        db.close()
+        cb.SEND_QUEUE = self.send_queue()
+        cb.SEND_QUEUE.park('edit', 't1_abc', "Output", parent='def',
+                           digest='new')
+        self.assertEqual(len(cb.SEND_QUEUE), 1)
+
+    def test_send_errors(self):
+        # An item that can't be sent doesn't stop the others or the
+        # check of the inbox.
+        class Forbidden(TestSendQueue.Comment):
+            def reply(self, text):
+                raise IOError("403 Client Error: Forbidden")
+        cb.ADMIN = ''
+        cb.SUBREDDIT = ''
+        cb.refresh_languages = lambda: None
+        banned = Forbidden(body='banned')
+        waiting = self.Comment(body='waiting')
+        for comment in (banned, waiting):
+            cb.SEND_QUEUE.park('reply', comment.fullname, "Output")
+        r = self.Reddit([banned, waiting])
+        r.get_unread = lambda limit=None: iter([])
+        cb.check_inbox(r)
+        self.assertTrue(waiting._replied_to)
+        self.assertEqual(len(cb.SEND_QUEUE), 1)
+        self.assertFalse(cb.SEND_QUEUE.limited())
+        # The item is dropped after max_attempts.
+        for i in range(3):
+            self.now += cb.SendQueue.ERROR_DELAY
+            cb.SEND_QUEUE.flush(r)
+        self.assertEqual(len(cb.SEND_QUEUE), 0)
+
+    def test_max_attempts(self):
+        cb.ADMIN = ''
+        limited = self.Comment(body='limited')
+        limited.rate_limited = 10
+        cb.CompiledReply("Output", {}).send(cb.Job.from_thing(limited))
+        r = self.Reddit([limited])
+        for i in range(5):
+            self.now += 60
+            cb.SEND_QUEUE.flush(r)
+        self.assertEqual(len(cb.SEND_QUEUE), 0)
+        self.assertEqual(limited.rate_limited, 7)
+
+    def tearDown(self):
+        os.remove(self.path)
+        reload(cb)
+        cb.LOG_FILE = LOG_FILE
+        cb.RATE_LIMITER = cb.RateLimiter({})
+
      
 if __name__ == "__main__":
     unittest.main(exit=False)
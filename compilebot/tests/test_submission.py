@@ -0,0 +1,840 @@
+from __future__ import unicode_literals, print_function
+import unittest
+import os
+import sys
+import shutil
+import time
+import tempfile
+from imp import reload
+import compilebot as cb
+from tests.test_reply import reddit_id
+
+"""
+Unit test cases for the way submissions are sent to and collected from
+ideone. A fake ideone client is used in place of the real one so no
+requests are made to reddit or ideone.
+
+Run the following command from the parent directory in order to run only
+this test module: python -m unittest tests.test_submission
+"""
+
+LOG_FILE = "tests.log"
+cb.LOG_FILE = LOG_FILE
+# Outbound calls are not paced in tests.
+cb.RATE_LIMITER = cb.RateLimiter({})
+
+def test_suite():
+    cases = [
+        TestSubmissionPipeline, TestPollSchedule, TestClientPool,
+        TestResultCache, TestRateLimiter, TestLanguageIndex, TestLocalRunner,
+        TestAccountRouter, TestCircuitBreaker
+    ]
+    alltests = [
+        unittest.TestLoader().loadTestsFromTestCase(case) for case in cases
+    ]
+    return unittest.TestSuite(alltests)
+
+
+class Clock(object):
+
+    """A fake clock that only moves forward when something sleeps."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeIdeone(object):
+
+    """Emulates the ideone API client. Each submission finishes once the
+    number of seconds scripted for its source code has passed.
+    """
+
+    LANGUAGES = {
+        4: "Python (python 2.7.3)",
+        116: "Python 3 (python-3.4)",
+        44: "C++11 (gcc-4.8.1)",
+        1: "C++ 4.3.2 (gcc-4.3.2)",
+    }
+
+    def __init__(self, clock, delays=None):
+        self.clock = clock
+        self.delays = delays or {}
+        self.submissions = {}
+        self.calls = []
+        self.language_ids = []
+
+    def languages(self):
+        self.calls.append('languages')
+        return dict(self.LANGUAGES)
+
+    def create_submission(self, source, language_name=None, language_id=None,
+                          std_input=''):
+        self.calls.append('create_submission')
+        self.language_ids.append(language_id)
+        link = reddit_id()
+        self.submissions[link] = (source, self.clock.time())
+        return {'error': 'OK', 'link': link}
+
+    def submission_details(self, link):
+        self.calls.append('submission_details')
+        source, created = self.submissions[link]
+        finished = self.clock.time() - created >= self.delays.get(source, 0)
+        return {
+            'cmpinfo': '', 'error': 'OK', 'input': '', 'langId': 116,
+            'langName': "Python 3", 'output': source, 'public': True,
+            'result': 15 if finished else 0, 'signal': 0, 'source': source,
+            'status': 0 if finished else 1, 'stderr': '', 'time': 0.1,
+            'memory': 1024, 'date': '', 'langVersion': '',
+        }
+
+
+class Author(object):
+    def __init__(self, name='User'):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class Reddit(object):
+    def __init__(self):
+        self._messages = []
+
+    def send_message(self, recipient, subject, text, **kwargs):
+        self._messages.append((recipient, subject, text))
+
+
+class Comment(object):
+
+    """Simplified version of a PRAW comment that records when it was
+    replied to and marked as read.
+    """
+
+    def __init__(self, source, clock, was_comment=True, args='python 3'):
+        self.body = "+/u/{user} {args}\n\n    {src}\n\n".format(
+            user=cb.R_USERNAME, args=args, src=source)
+        self.id = reddit_id()
+        self.fullname = 't1_' + self.id
+        self.author = Author()
+        self.permalink = reddit_id() + '/test/' + self.id
+        self.was_comment = was_comment
+        self.reddit_session = Reddit()
+        self.clock = clock
+        self._replied_at = None
+        self._reply_text = ''
+        self._marked_read = 0
+
+    def reply(self, text):
+        self._replied_at = self.clock.time()
+        self._reply_text = text
+
+    def mark_as_read(self):
+        self._marked_read += 1
+
+
+class TestSubmissionPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        cb.RESULT_CACHE = None
+
+    def test_overlapping_submissions(self):
+        # Every submission should be created before any of them are
+        # polled so that their execution times overlap.
+        delays = {'slow': 30, 'medium': 10, 'fast': 1}
+        client = FakeIdeone(self.clock, delays)
+        inbox = [Comment(src, self.clock) for src in ('slow', 'medium', 'fast')]
+        cb.process_pipelined(inbox, None, client=client,
+                             sleep=self.clock.sleep, clock=self.clock.time)
+        self.assertEqual(client.calls[:3], ['create_submission'] * 3)
+        for new in inbox:
+            self.assertEqual(new._marked_read, 1)
+            self.assertIn("Output:", new._reply_text)
+        # Replies are sent as each submission finishes, and the whole
+        # batch takes about as long as the slowest submission.
+        slow, medium, fast = inbox
+        self.assertTrue(fast._replied_at < medium._replied_at
+                        < slow._replied_at)
+        self.assertTrue(slow._replied_at < 30 + 2 * cb.POLL_MAX)
+        metrics = cb.METRICS.snapshot()
+        self.assertEqual(metrics['counters']['results_total{code="15"}'], 3)
+        self.assertEqual(metrics['spans']['poll']['count'],
+                         client.calls.count('submission_details'))
+
+    def test_deadline(self):
+        client = FakeIdeone(self.clock, {'forever': cb.POLL_DEADLINE * 2})
+        new = Comment('forever', self.clock)
+        cb.process_pipelined([new], None, client=client,
+                             sleep=self.clock.sleep, clock=self.clock.time)
+        self.assertEqual(new._marked_read, 1)
+        self.assertIsNone(new._replied_at)
+        recipient, subject, text = new.reddit_session._messages[0]
+        self.assertIn(cb.DEADLINE_ERROR_TEXT, text)
+        self.assertTrue(self.clock.time() <= cb.POLL_DEADLINE + cb.POLL_MAX)
+
+    def test_error_isolation(self):
+        client = FakeIdeone(self.clock)
+        def submission_details(link):
+            raise ValueError("Transport error")
+        inbox = [Comment('print(1)', self.clock) for _ in range(3)]
+        client.submission_details = submission_details
+        cb.ADMIN = ''
+        cb.JOURNAL = cb.WorkJournal(max_attempts=1)
+        cb.process_pipelined(inbox, None, client=client,
+                             sleep=self.clock.sleep, clock=self.clock.time)
+        for new in inbox:
+            self.assertEqual(new._marked_read, 1)
+            self.assertIsNone(new._replied_at)
+
+    def test_resume_after_restart(self):
+        # A mention that was submitted before a restart is polled by its
+        # link instead of being submitted again.
+        client = FakeIdeone(self.clock, {'slow': 30})
+        new = Comment('slow', self.clock)
+        pipeline = cb.SubmissionPipeline(
+            None, clients=cb.ClientPool(1, factory=lambda: client),
+            sleep=self.clock.sleep, clock=self.clock.time)
+        pipeline.add(cb.Job.from_thing(new))
+        self.assertEqual(new._marked_read, 0)
+        self.assertEqual(cb.JOURNAL.state(new.id), cb.WorkJournal.SUBMITTED)
+        cb.process_pipelined([new], None, client=client,
+                             sleep=self.clock.sleep, clock=self.clock.time)
+        self.assertEqual(client.calls.count('create_submission'), 1)
+        self.assertIn("Output:", new._reply_text)
+        self.assertEqual(new._marked_read, 1)
+        self.assertEqual(cb.JOURNAL.state(new.id), cb.WorkJournal.READ)
+
+    def tearDown(self):
+        reload(cb)
+        cb.LOG_FILE = LOG_FILE
+        cb.RATE_LIMITER = cb.RateLimiter({})
+
+
+class TestPollSchedule(unittest.TestCase):
+
+    def test_backoff(self):
+        schedule = cb.PollSchedule('Python', 0)
+        self.assertEqual(schedule.due, cb.POLL_INITIAL)
+        delays = []
+        now = schedule.due
+        for _ in range(10):
+            schedule.advance(now)
+            delays.append(schedule.due - now)
+            now = schedule.due
+        # Delays grow quickly at first and never exceed the maximum.
+        self.assertTrue(delays[1] > delays[0])
+        self.assertTrue(all(d <= cb.POLL_MAX * (1 + cb.POLL_JITTER)
+                            for d in delays))
+
+    def test_deadline(self):
+        schedule = cb.PollSchedule('Python', 0)
+        self.assertRaises(cb.SubmissionTimeout, schedule.advance,
+                          cb.POLL_DEADLINE)
+
+    def test_learned_runtime(self):
+        # The first check for a language is delayed until about as long
+        # as its programs usually take to run.
+        for _ in range(5):
+            cb.record_runtime('Java', {'time': 2.5})
+        cb.record_runtime('Java', {'time': None})
+        schedule = cb.PollSchedule('Java', 0)
+        self.assertAlmostEqual(schedule.due, 2.5)
+        self.assertEqual(cb.PollSchedule('C', 0).due, cb.POLL_INITIAL)
+
+    def tearDown(self):
+        reload(cb)
+        cb.LOG_FILE = LOG_FILE
+        cb.RATE_LIMITER = cb.RateLimiter({})
+
+
+class TestClientPool(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.built = []
+        def factory():
+            client = FakeIdeone(self.clock)
+            self.built.append(client)
+            return client
+        self.pool = cb.ClientPool(2, factory=factory, max_idle=60,
+                                  clock=self.clock.time)
+
+    def test_reuse(self):
+        for _ in range(5):
+            with self.pool.client() as client:
+                client.create_submission('print(1)')
+        self.assertEqual(len(self.built), 1)
+
+    def test_rebuild_after_transport_error(self):
+        def use_failing_client():
+            with self.pool.client() as client:
+                raise IOError("Connection reset")
+        self.assertRaises(IOError, use_failing_client)
+        with self.pool.client() as client:
+            pass
+        self.assertEqual(len(self.built), 2)
+
+    def test_api_errors_keep_client(self):
+        def use_client():
+            with self.pool.client() as client:
+                raise cb.ideone.LanguageNotFoundError("Not found", [])
+        self.assertRaises(cb.ideone.LanguageNotFoundError, use_client)
+        with self.pool.client() as client:
+            pass
+        self.assertEqual(len(self.built), 1)
+
+    def test_stale_client(self):
+        with self.pool.client() as client:
+            pass
+        self.clock.sleep(61)
+        with self.pool.client() as client:
+            pass
+        self.assertEqual(len(self.built), 2)
+
+    def tearDown(self):
+        reload(cb)
+        cb.LOG_FILE = LOG_FILE
+        cb.RATE_LIMITER = cb.RateLimiter({})
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = cb.ResultCache(':memory:', ttl=60, max_entries=3,
+                                    clock=self.clock.time)
+        cb.RESULT_CACHE = self.cache
+
+    def test_key(self):
+        # Language shortcuts are expanded before a key is created.
+        key = cb.ResultCache.key('python3', 'print(1)', '')
+        self.assertEqual(key, cb.ResultCache.key('Python 3', 'print(1)', ''))
+        self.assertNotEqual(key, cb.ResultCache.key('python3', 'print(1)',
+                                                    '1'))
+
+    def test_expiry(self):
+        self.cache.put('key', {'link': 'abc', 'result': 15})
+        self.assertEqual(self.cache.get('key')['link'], 'abc')
+        self.clock.sleep(61)
+        self.assertIsNone(self.cache.get('key'))
+
+    def test_eviction(self):
+        for key in ('a', 'b', 'c'):
+            self.cache.put(key, {'link': key, 'result': 15})
+            self.clock.sleep(1)
+        # Using an entry makes it the most recently used one.
+        self.cache.get('a')
+        self.clock.sleep(1)
+        self.cache.put('d', {'link': 'd', 'result': 15})
+        self.assertIsNone(self.cache.get('b'))
+        for key in ('a', 'c', 'd'):
+            self.assertIsNotNone(self.cache.get(key))
+
+    def test_pipeline_cache_hit(self):
+        client = FakeIdeone(self.clock)
+        inbox = [Comment('print(1)', self.clock) for _ in range(3)]
+        cb.process_pipelined(inbox[:1], None, client=client,
+                             sleep=self.clock.sleep, clock=self.clock.time)
+        calls = len(client.calls)
+        cb.process_pipelined(inbox[1:], None, client=client,
+                             sleep=self.clock.sleep, clock=self.clock.time)
+        self.assertEqual(len(client.calls), calls)
+        for new in inbox:
+            self.assertIn("Output:", new._reply_text)
+            self.assertEqual(new._marked_read, 1)
+
+    def test_fresh(self):
+        client = FakeIdeone(self.clock)
+        cb.process_pipelined([Comment('print(1)', self.clock)], None,
+                             client=client, sleep=self.clock.sleep,
+                             clock=self.clock.time)
+        calls = len(client.calls)
+        new = Comment('print(1)', self.clock, args='python 3 --fresh')
+        cb.process_pipelined([new], None, client=client,
+                             sleep=self.clock.sleep, clock=self.clock.time)
+        self.assertTrue(len(client.calls) > calls)
+
+    def test_internal_errors_not_cached(self):
+        cb.cache_details('key', {'link': 'abc', 'result': 20})
+        self.assertIsNone(cb.cached_details('key'))
+
+    def tearDown(self):
+        reload(cb)
+        cb.LOG_FILE = LOG_FILE
+        cb.RATE_LIMITER = cb.RateLimiter({})
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.limiter = cb.RateLimiter(
+            {'ideone_poll': {'rate': 2, 'burst': 3}},
+            clock=self.clock.time, sleep=self.clock.sleep)
+        cb.RESULT_CACHE = None
+
+    def test_worker_shares(self):
+        # Two workers and the supervisor each get a third of the limit,
+        # and each worker writes its own log file.
+        cb.RATE_LIMITS = {'reddit_write': {'rate': 1.5, 'burst': 6}}
+        cb.LOG_FILE = 'compilebot.log'
+        cb.init_worker(2, 1)
+        bucket = cb.RATE_LIMITER.buckets['reddit_write']
+        self.assertEqual((bucket.rate, bucket.burst), (0.5, 2))
+        self.assertEqual(cb.LOG_FILE, 'compilebot-1.log')
+
+    def test_burst(self):
+        for _ in range(3):
+            self.limiter.wait('ideone_poll')
+        self.assertEqual(self.clock.time(), 0)
+        self.limiter.wait('ideone_poll')
+        self.assertAlmostEqual(self.clock.time(), 0.5)
+
+    def test_sustained_rate(self):
+        for _ in range(23):
+            self.limiter.wait('ideone_poll')
+        # After the burst calls are made at the configured rate.
+        self.assertAlmostEqual(self.clock.time(), 10)
+        stats = self.limiter.stats()['ideone_poll']
+        self.assertEqual(stats['calls'], 23)
+        self.assertEqual(stats['throttled'], 20)
+        self.assertAlmostEqual(stats['waited'], 10)
+
+    def test_tokens_refill(self):
+        for _ in range(3):
+            self.limiter.wait('ideone_poll')
+        self.clock.sleep(60)
+        for _ in range(3):
+            self.limiter.wait('ideone_poll')
+        self.assertEqual(self.limiter.stats()['ideone_poll']['throttled'], 0)
+
+    def test_unlimited_endpoint(self):
+        for _ in range(100):
+            self.limiter.wait('reddit_read')
+        self.assertEqual(self.clock.time(), 0)
+        self.assertEqual(self.limiter.stats()['reddit_read']['calls'], 100)
+
+    def test_outbound_calls_throttled(self):
+        cb.RATE_LIMITER = self.limiter
+        client = FakeIdeone(self.clock, {'slow': 30})
+        cb.process_pipelined([Comment('slow', self.clock)], None,
+                             client=client, sleep=self.clock.sleep,
+                             clock=self.clock.time)
+        polls = client.calls.count('submission_details')
+        self.assertEqual(self.limiter.stats()['ideone_poll']['calls'], polls)
+
+    def tearDown(self):
+        reload(cb)
+        cb.LOG_FILE = LOG_FILE
+        cb.RATE_LIMITER = cb.RateLimiter({})
+
+
+class TestLanguageIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'languages.json')
+        self.client = FakeIdeone(self.clock)
+        self.index = cb.LanguageIndex(self.path, refresh_interval=3600,
+                                      clock=self.clock.time)
+        self.index.update(self.client)
+
+    def test_lookup(self):
+        self.assertEqual(self.index.lookup("Python 3 (python-3.4)"), 116)
+        # Names without the version and shortcuts are matched too,
+        # regardless of case.
+        self.assertEqual(self.index.lookup("python 3"), 116)
+        self.assertEqual(self.index.lookup("Python3"), 116)
+        self.assertEqual(self.index.lookup("c++"), 44)
+        self.assertEqual(self.index.lookup("C++ 4.3.2"), 1)
+        self.assertIsNone(self.index.lookup("Foo"))
+
+    def test_unknown_language(self):
+        try:
+            self.index.resolve("Pyhton 3")
+        except cb.ideone.LanguageNotFoundError as e:
+            self.assertEqual(e.similar_languages[0], "Python 3")
+        else:
+            self.fail("LanguageNotFoundError not raised")
+
+    def test_empty_index(self):
+        # Until the list has been fetched names are left to ideone.
+        index = cb.LanguageIndex()
+        self.assertIsNone(index.resolve("Foo"))
+
+    def test_refresh(self):
+        self.index.update(self.client)
+        self.assertEqual(self.client.calls.count('languages'), 1)
+        self.clock.sleep(3600)
+        self.index.update(self.client)
+        self.assertEqual(self.client.calls.count('languages'), 2)
+
+    def test_snapshot(self):
+        index = cb.LanguageIndex(self.path, refresh_interval=3600,
+                                 clock=self.clock.time)
+        self.assertFalse(index.stale())
+        self.assertEqual(index.lookup("python"), 4)
+
+    def test_submit_by_id(self):
+        cb.LANGUAGES = self.index
+        cb.submit('print(1)', 'python 3', client=self.client)
+        self.assertEqual(self.client.language_ids, [116])
+        self.assertRaises(cb.ideone.LanguageNotFoundError, cb.submit,
+                          'print(1)', 'Foo', client=self.client)
+        self.assertEqual(self.client.calls.count('create_submission'), 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        reload(cb)
+        cb.LOG_FILE = LOG_FILE
+        cb.RATE_LIMITER = cb.RateLimiter({})
+
+
+class TestLocalRunner(unittest.TestCase):
+
+    def setUp(self):
+        # The interpreter running the tests stands in for both compiling
+        # and running Python. The test programs are trusted, so env
+        # stands in for a jail.
+        self.runner = cb.LocalRunner({
+            'Python': {'source': 'prog.py',
+                       'run': [sys.executable, 'prog.py']},
+            'Checked': {'source': 'prog.py',
+                        'compile': [sys.executable, '-m', 'py_compile',
+                                    'prog.py'],
+                        'run': [sys.executable, 'prog.py']},
+        }, time_limit=1, wall_limit=2, memory_limit=256 * 1024 * 1024,
+           output_limit=1000, jail=['env'])
+
+    def run_source(self, source, lang='Python', stdin=''):
+        return self.runner.execute(source, lang, stdin)
+
+    def test_output(self):
+        details = self.run_source("import sys\n"
+                                  "sys.stdout.write(sys.stdin.read())\n"
+                                  "sys.stderr.write('err')", stdin="Hello")
+        self.assertEqual(details['result'], 15)
+        self.assertEqual(details['output'], "Hello")
+        self.assertEqual(details['stderr'], "err")
+        self.assertEqual(details['status'], 0)
+        self.assertEqual(details['link'], '')
+
+    def test_result_codes(self):
+        self.assertEqual(self.run_source("while True: pass")['result'], 13)
+        self.assertEqual(self.run_source("import time\ntime.sleep(10)"
+                                         )['result'], 13)
+        self.assertEqual(self.run_source("x = ' ' * 2 ** 30")['result'], 17)
+        self.assertEqual(self.run_source("raise ValueError")['result'], 12)
+        details = self.run_source("print(", lang='Checked')
+        self.assertEqual(details['result'], 11)
+        self.assertIn("SyntaxError", details['cmpinfo'])
+
+    def test_output_limit(self):
+        # Output past the limit is cut off, like ideone does.
+        details = self.run_source("print('x' * 100000)")
+        self.assertEqual(details['result'], 15)
+        self.assertEqual(len(details['output']), 1000)
+        details = self.run_source("while True: print('x' * 100)")
+        self.assertEqual(len(details['output']), 1000)
+        self.assertNotEqual(details['result'], 15)
+
+    def test_isolation(self):
+        self.assertRaises(ValueError, cb.LocalRunner, {})
+        self.assertRaises(ValueError, cb.LocalRunner, {}, user=[0])
+        os.environ['COMPILEBOT_SECRET'] = 'secret'
+        try:
+            details = self.run_source("import os\n"
+                                      "print(os.environ.get("
+                                      "'COMPILEBOT_SECRET'))")
+        finally:
+            del os.environ['COMPILEBOT_SECRET']
+        self.assertEqual(details['output'], "None\n")
+
+    @unittest.skipUnless(os.getuid() == 0 and os.path.exists('/bin/sh'),
+                         "switching users requires root")
+    def test_detached_processes(self):
+        # A process that leaves the program's process group is killed
+        # with every other process of the user the program ran as. The
+        # uid isn't used by anything else.
+        directory = tempfile.mkdtemp()
+        os.chmod(directory, 0o777)
+        marker = os.path.join(directory, 'survived')
+        runner = cb.LocalRunner({'Shell': {'source': 'prog.sh',
+                                           'run': ['/bin/sh', 'prog.sh']}},
+                                user=[61234])
+        try:
+            details = runner.execute("setsid sh -c 'sleep 1; touch {}' &\n"
+                                     "echo started".format(marker), 'Shell')
+            self.assertEqual(details['output'], "started\n")
+            time.sleep(2)
+            self.assertFalse(os.path.exists(marker))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_dispatch(self):
+        # Languages the runner is configured with never reach ideone.
+        client = FakeIdeone(Clock())
+        cb.CLIENTS = cb.ClientPool(1, factory=lambda: client)
+        cb.RESULT_CACHE = None
+        cb.BACKENDS = [self.runner, cb.IDEONE]
+        details = cb.compile("print(1)", 'python')
+        self.assertEqual(details['output'], "1\n")
+        self.assertEqual(client.calls, [])
+        self.assertEqual(cb.backend_for('Python 3'), cb.IDEONE)
+
+    def tearDown(self):
+        reload(cb)
+        cb.LOG_FILE = LOG_FILE
+        cb.RATE_LIMITER = cb.RateLimiter({})
+
+
+class TestAccountRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.clients = {}
+        pools = []
+        for name in ('a', 'b'):
+            self.clients[name] = FakeIdeone(self.clock)
+            pools.append((name, cb.ClientPool(
+                2, factory=lambda name=name: self.clients[name])))
+        self.router = cb.AccountRouter(pools, eject_after=2, eject_time=60,
+                                       clock=self.clock.time)
+
+    def submit(self):
+        with self.router.client() as client:
+            return client.account.name, client.create_submission('print(1)')
+
+    def fail(self, name):
+        account = [a for a in self.router.accounts if a.name == name][0]
+        self.router.record(account, 1, False)
+
+    def test_latency(self):
+        # Requests to account a are slower, so b is preferred.
+        def slow_submission(*args, **kwargs):
+            self.clock.sleep(2)
+            return FakeIdeone.create_submission(self.clients['a'], *args,
+                                                **kwargs)
+        self.clients['a'].create_submission = slow_submission
+        accounts = [self.submit()[0] for _ in range(4)]
+        self.assertEqual(accounts.count('a'), 1)
+
+    def test_in_flight(self):
+        with self.router.client() as first:
+            with self.router.client() as second:
+                self.assertNotEqual(first.account, second.account)
+
+    def test_polled_by_owner(self):
+        for _ in range(4):
+            name, sub = self.submit()
+            with self.router.client(sub['link']) as client:
+                self.assertEqual(client.account.name, name)
+                client.submission_details(sub['link'])
+        self.assertEqual(self.router.links, {})
+
+    def test_ejection_and_probe(self):
+        self.fail('a')
+        self.fail('a')
+        self.assertTrue(self.router.stats()['a']['ejected'])
+        self.assertEqual(set(self.submit()[0] for _ in range(5)), {'b'})
+        # Once the ejection is over a single probe is sent to a, and a
+        # failed probe ejects it for twice as long.
+        self.clock.sleep(60)
+        with self.router.client() as probe:
+            self.assertEqual(probe.account.name, 'a')
+            self.assertEqual(self.submit()[0], 'b')
+            self.fail('a')
+        self.clock.sleep(60)
+        self.assertEqual(self.submit()[0], 'b')
+        self.clock.sleep(60)
+        self.assertEqual(self.submit()[0], 'a')
+        self.assertFalse(self.router.stats()['a']['ejected'])
+
+    def test_failed_probe_without_request(self):
+        self.fail('a')
+        self.fail('a')
+        self.clock.sleep(60)
+        # A probe that can't create a client ejects the account again.
+        pool = self.router.accounts[0].pool
+        def factory():
+            raise IOError("Connection refused")
+        pool.factory = factory
+        with self.assertRaises(IOError):
+            with self.router.client() as probe:
+                pass
+        self.assertEqual(self.submit()[0], 'b')
+        # A probe that ends without making a request leaves the next
+        # request to probe.
+        self.clock.sleep(120)
+        pool.factory = lambda: self.clients['a']
+        with self.router.client() as probe:
+            self.assertEqual(probe.account.name, 'a')
+        self.assertTrue(self.router.stats()['a']['ejected'])
+        self.assertEqual(self.submit()[0], 'a')
+        self.assertFalse(self.router.stats()['a']['ejected'])
+
+    def test_internal_errors(self):
+        # Submissions keep being accepted, but every one of them ends in
+        # an internal error.
+        def internal_error(link):
+            details = FakeIdeone.submission_details(self.clients['a'], link)
+            details['result'] = 20
+            return details
+        self.clients['a'].submission_details = internal_error
+        client = cb.RoutedClient(self.router, self.router.accounts[0],
+                                 self.clients['a'])
+        for _ in range(10):
+            link = client.create_submission('print(1)')['link']
+            client.submission_details(link)
+        self.assertTrue(self.router.stats()['a']['ejected'])
+
+    def tearDown(self):
+        reload(cb)
+        cb.LOG_FILE = LOG_FILE
+        cb.RATE_LIMITER = cb.RateLimiter({})
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.breaker = cb.CircuitBreaker(threshold=2, reset_timeout=60,
+                                         slow_call=30, clock=self.clock.time)
+        cb.BREAKER = self.breaker
+        cb.RESULT_CACHE = None
+        cb.ADMIN = ''
+
+    def internal_errors(self, client):
+        def submission_details(link):
+            details = FakeIdeone.submission_details(client, link)
+            details['result'] = 20
+            return details
+        client.submission_details = submission_details
+
+    def process(self, inbox, client):
+        cb.process_pipelined(inbox, None, client=client,
+                             sleep=self.clock.sleep, clock=self.clock.time)
+
+    def test_open_and_probe(self):
+        self.breaker.failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.failure()
+        self.assertFalse(self.breaker.allow())
+        # Once the timeout is over a single probe is let through, and a
+        # failed probe opens the breaker again.
+        self.clock.sleep(60)
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.failure()
+        self.assertTrue(self.breaker.opened())
+        self.clock.sleep(60)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.success()
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.allow())
+
+    def test_slow_calls(self):
+        for _ in range(2):
+            with self.breaker.guard():
+                self.clock.sleep(31)
+        self.assertTrue(self.breaker.opened())
+
+    def test_parked_and_retried(self):
+        client = FakeIdeone(self.clock)
+        self.internal_errors(client)
+        inbox = [Comment('print({})'.format(i), self.clock) for i in range(4)]
+        self.process(inbox, client)
+        # The second internal error opens the breaker, and the mentions
+        # that haven't been answered yet are left unread.
+        self.assertEqual(inbox[0]._marked_read, 1)
+        for new in inbox[1:]:
+            self.assertEqual(new._marked_read, 0)
+            self.assertIsNone(new._replied_at)
+            self.assertEqual(cb.JOURNAL.get(new.id)[2], 0)
+        self.assertIsNone(cb.JOURNAL.link(inbox[1].id))
+        # Nothing is sent to ideone until the timeout is over. Then a
+        # single probe is let through, and the rest follow once it
+        # succeeds. Mentions that were parked while their submissions
+        # were running are polled by their links rather than submitted
+        # again.
+        del client.submission_details
+        client.calls = []
+        unread = lambda: [new for new in inbox if not new._marked_read]
+        self.process(unread(), client)
+        self.assertEqual(client.calls, [])
+        self.clock.sleep(60)
+        self.process(unread(), client)
+        self.assertEqual(client.calls.count('create_submission'), 1)
+        self.assertEqual(len(unread()), 2)
+        self.process(unread(), client)
+        self.assertEqual(client.calls.count('create_submission'), 1)
+        for new in inbox[1:]:
+            self.assertEqual(new._marked_read, 1)
+            self.assertIn("Output:", new._reply_text)
+
+    def test_client_errors(self):
+        # Once a client has been discarded after a transport error, new
+        # clients can't be created either while ideone is down.
+        def factory():
+            raise IOError("Connection refused")
+        cb.CLIENTS = cb.ClientPool(1, factory=factory)
+        for _ in range(2):
+            self.assertRaises(IOError, cb.compile, "print(1)", 'python')
+        self.assertTrue(self.breaker.opened())
+        self.assertRaises(cb.BackendUnavailable, cb.compile, "print(1)",
+                          'python')
+
+    def test_parked_without_submitting(self):
+        client = FakeIdeone(self.clock)
+        cb.CLIENTS = cb.ClientPool(1, factory=lambda: client)
+        cb.JOURNAL = cb.WorkJournal(max_attempts=1)
+        self.breaker.failure()
+        self.breaker.failure()
+        new = Comment('print(1)', self.clock)
+        for _ in range(3):
+            cb.process_inbox([new], None)
+        self.assertEqual(client.calls, [])
+        self.assertEqual(new._marked_read, 0)
+        self.assertEqual(cb.METRICS.snapshot()['counters']['parked_total'], 3)
+
+    def test_parked_not_counted(self):
+        # The whole inbox is fetched, since parked mentions stay unread,
+        # and they aren't counted as activity when checked again.
+        class Reddit(object):
+            limits = []
+            def get_unread(self, limit=100):
+                self.limits.append(limit)
+                return iter(unread())
+        client = FakeIdeone(self.clock)
+        cb.CLIENTS = cb.ClientPool(1, factory=lambda: client)
+        cb.SUBREDDIT = ''
+        cb.WORKERS = 1
+        self.breaker.failure()
+        self.breaker.failure()
+        inbox = [Comment('print({})'.format(i), self.clock) for i in range(3)]
+        unread = lambda: [new for new in inbox if not new._marked_read]
+        r = Reddit()
+        self.assertEqual(cb.check_inbox(r), 0)
+        self.assertEqual(cb.check_inbox(r), 0)
+        self.assertEqual(Reddit.limits, [None, None])
+        self.assertEqual(len(unread()), 3)
+        # Once ideone recovers they are processed and counted again.
+        self.clock.sleep(60)
+        self.assertEqual(cb.check_inbox(r), 3)
+        self.assertEqual(unread(), [])
+
+    def tearDown(self):
+        reload(cb)
+        cb.LOG_FILE = LOG_FILE
+        cb.RATE_LIMITER = cb.RateLimiter({})
+
+
+if __name__ == "__main__":
+    unittest.main(exit=False)